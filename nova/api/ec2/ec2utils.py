@@ -18,11 +18,11 @@
 
 import re
 
+from nova.compute import utils as compute_utils
 from nova import context
 from nova import db
 from nova import exception
 from nova import flags
-from nova.network import model as network_model
 from nova.openstack.common import log as logging
 from nova import utils
 
@@ -107,12 +107,7 @@ def get_ip_info_for_instance_from_nw_info(nw_info):
 def get_ip_info_for_instance(context, instance):
     """Return a dictionary of IP information for an instance"""
 
-    info_cache = instance['info_cache'] or {}
-    cached_nwinfo = info_cache.get('network_info')
-    # Make sure empty response is turned into []
-    if not cached_nwinfo:
-        cached_nwinfo = []
-    nw_info = network_model.NetworkInfo.hydrate(cached_nwinfo)
+    nw_info = compute_utils.get_nw_info_for_instance(instance)
     return get_ip_info_for_instance_from_nw_info(nw_info)
 
 
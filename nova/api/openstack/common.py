@@ -442,22 +442,33 @@ class ViewBuilder(object):
                            collection_name)
         return "%s?%s" % (url, dict_to_query_str(params))
 
+    def _get_project_url(self, request, bookmark=False):
+        """Return the url of the project's resources.
+
+        Links are built for every item of a listing, so the url is worked
+        out once and kept for the rest of the request.
+        """
+        link_prefix = FLAGS.osapi_compute_link_prefix
+        prefixes = request.environ.setdefault('nova.link_prefixes', {})
+        key = (bookmark, link_prefix)
+        if key not in prefixes:
+            base_url = request.application_url
+            if bookmark:
+                base_url = remove_version_from_href(base_url)
+            base_url = self._update_link_prefix(base_url, link_prefix)
+            prefixes[key] = os.path.join(base_url,
+                                    request.environ["nova.context"].project_id)
+        return prefixes[key]
+
     def _get_href_link(self, request, identifier, collection_name):
         """Return an href string pointing to this object."""
-        prefix = self._update_link_prefix(request.application_url,
-                                          FLAGS.osapi_compute_link_prefix)
-        return os.path.join(prefix,
-                            request.environ["nova.context"].project_id,
+        return os.path.join(self._get_project_url(request),
                             collection_name,
                             str(identifier))
 
     def _get_bookmark_link(self, request, identifier, collection_name):
         """Create a URL that refers to a specific resource."""
-        base_url = remove_version_from_href(request.application_url)
-        base_url = self._update_link_prefix(base_url,
-                                            FLAGS.osapi_compute_link_prefix)
-        return os.path.join(base_url,
-                            request.environ["nova.context"].project_id,
+        return os.path.join(self._get_project_url(request, bookmark=True),
                             collection_name,
                             str(identifier))
 
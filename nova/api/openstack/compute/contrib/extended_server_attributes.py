@@ -43,9 +43,10 @@ class ExtendedServerAttributesController(wsgi.Controller):
         except TypeError:
             return
 
-    def _extend_server(self, context, server, instance):
+    def _extend_server(self, context, server, instance,
+                       hypervisor_hostname):
         key = "%s:hypervisor_hostname" % Extended_server_attributes.alias
-        server[key] = self._get_hypervisor_hostname(context, instance)
+        server[key] = hypervisor_hostname
 
         for attr in ['host', 'name']:
             if attr == 'name':
@@ -65,7 +66,10 @@ class ExtendedServerAttributesController(wsgi.Controller):
             db_instance = req.get_db_instance(server['id'])
             # server['id'] is guaranteed to be in the cache due to
             # the core API adding it in its 'show' method.
-            self._extend_server(context, server, db_instance)
+            hypervisor_hostname = self._get_hypervisor_hostname(context,
+                                                                db_instance)
+            self._extend_server(context, server, db_instance,
+                                hypervisor_hostname)
 
     @wsgi.extends
     def detail(self, req, resp_obj):
@@ -74,12 +78,21 @@ class ExtendedServerAttributesController(wsgi.Controller):
             # Attach our slave template to the response object
             resp_obj.attach(xml=ExtendedServerAttributesTemplate())
 
+            # NOTE: many servers share a host, so only look up the
+            # compute node of each host once for the whole listing.
+            hypervisor_hostnames = {}
             servers = list(resp_obj.obj['servers'])
             for server in servers:
                 db_instance = req.get_db_instance(server['id'])
                 # server['id'] is guaranteed to be in the cache due to
                 # the core API adding it in its 'detail' method.
-                self._extend_server(context, server, db_instance)
+                host = db_instance['host']
+                if host not in hypervisor_hostnames:
+                    hypervisor_hostnames[host] = \
+                            self._get_hypervisor_hostname(context,
+                                                          db_instance)
+                self._extend_server(context, server, db_instance,
+                                    hypervisor_hostnames[host])
 
 
 class Extended_server_attributes(extensions.ExtensionDescriptor):
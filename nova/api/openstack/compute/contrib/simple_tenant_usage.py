@@ -104,8 +104,37 @@ class SimpleTenantUsageController(object):
             # instance hasn't launched, so no charge
             return 0
 
+    def _tenant_usage_totals_for_period(self, context, period_start,
+                                        period_stop, tenant_id=None):
+        """Builds the tenant summaries from totals computed in the db."""
+        compute_api = api.API()
+        totals = compute_api.get_usage_by_window(context,
+                                                 period_start,
+                                                 period_stop,
+                                                 tenant_id)
+        rval = []
+        for total in totals:
+            summary = {}
+            summary['tenant_id'] = total['project_id']
+            summary['total_local_gb_usage'] = total['local_gb_hours']
+            summary['total_vcpus_usage'] = total['vcpus_hours']
+            summary['total_memory_mb_usage'] = total['memory_mb_hours']
+            summary['total_hours'] = total['hours']
+            summary['start'] = period_start
+            summary['stop'] = period_stop
+            rval.append(summary)
+
+        return rval
+
     def _tenant_usages_for_period(self, context, period_start,
                                   period_stop, tenant_id=None, detailed=True):
+        if not detailed:
+            # NOTE: the per server rows aren't wanted, so there is no need
+            # to pull every instance active in the period out of the db.
+            return self._tenant_usage_totals_for_period(context,
+                                                        period_start,
+                                                        period_stop,
+                                                        tenant_id)
 
         compute_api = api.API()
         instances = compute_api.get_active_by_window(context,
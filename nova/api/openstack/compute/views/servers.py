@@ -96,7 +96,7 @@ class ViewBuilder(common.ViewBuilder):
                 "tenant_id": instance.get("project_id") or "",
                 "user_id": instance.get("user_id") or "",
                 "metadata": self._get_metadata(instance),
-                "hostId": self._get_host_id(instance) or "",
+                "hostId": self._get_host_id(request, instance) or "",
                 "image": self._get_image(request, instance),
                 "flavor": self._get_flavor(request, instance),
                 "created": timeutils.isotime(instance["created_at"]),
@@ -150,12 +150,18 @@ class ViewBuilder(common.ViewBuilder):
                                         instance.get("task_state"))
 
     @staticmethod
-    def _get_host_id(instance):
+    def _get_host_id(request, instance):
         host = instance.get("host")
         project = str(instance.get("project_id"))
         if host:
-            sha_hash = hashlib.sha224(project + host)  # pylint: disable=E1101
-            return sha_hash.hexdigest()
+            # NOTE: listings put many servers of a project on the same
+            # host, so the hashes are kept for the rest of the request.
+            host_ids = request.environ.setdefault('nova.host_ids', {})
+            key = (project, host)
+            if key not in host_ids:
+                # pylint: disable=E1101
+                host_ids[key] = hashlib.sha224(project + host).hexdigest()
+            return host_ids[key]
 
     def _get_addresses(self, request, instance):
         context = request.environ["nova.context"]
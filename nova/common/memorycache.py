@@ -16,49 +16,166 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-"""Super simple fake memcache client."""
+"""Super simple fake memcache client.
 
+Entries are kept in insertion/access order so the least recently used
+one can be evicted in O(1) once the cache is full, and expiry times are
+kept in a heap so that expired entries are purged without walking the
+whole cache on every lookup.
+"""
+
+import heapq
+import threading
+
+from nova import flags
+from nova.openstack.common import cfg
 from nova.openstack.common import timeutils
 
 
+memorycache_opts = [
+    cfg.IntOpt('memorycache_max_size',
+               default=10000,
+               help='Maximum number of entries kept by the in process '
+                    'cache before least recently used ones are evicted. '
+                    '0 means unlimited'),
+    ]
+
+FLAGS = flags.FLAGS
+FLAGS.register_opts(memorycache_opts)
+
+# Indexes into the linked list nodes stored in Client._map
+_PREV, _NEXT, _KEY, _TIMEOUT, _VALUE = range(5)
+
+
 class Client(object):
     """Replicates a tiny subset of memcached client interface."""
 
     def __init__(self, *args, **kwargs):
-        """Ignores the passed in args."""
-        self.cache = {}
+        """Ignores the passed in args other than max_size."""
+        self.max_size = kwargs.get('max_size', FLAGS.memorycache_max_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._map = {}
+        self._expiry = []
+        # Circular doubly linked list, least recently used entry first.
+        self._root = root = []
+        root[:] = [root, root, None, 0, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, node):
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+
+    def _append(self, node):
+        root = self._root
+        last = root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = root
+        last[_NEXT] = root[_PREV] = node
+
+    def _remove(self, key):
+        node = self._map.pop(key)
+        self._unlink(node)
+        return node
+
+    def _expunge(self, now):
+        """Drops every entry whose timeout has passed."""
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            timeout, key = heapq.heappop(expiry)
+            node = self._map.get(key)
+            # The key may have been reset or deleted since it was queued.
+            if node is not None and node[_TIMEOUT] == timeout:
+                self._remove(key)
+
+    def _compact(self):
+        """Rebuilds the expiry heap when stale entries dominate it."""
+        if len(self._expiry) <= 2 * len(self._map) + 64:
+            return
+        self._expiry = [(node[_TIMEOUT], key)
+                        for key, node in self._map.iteritems()
+                        if node[_TIMEOUT]]
+        heapq.heapify(self._expiry)
+
+    def _lookup(self, key):
+        """Returns the live node for a key, marking it recently used."""
+        self._expunge(timeutils.utcnow_ts())
+        node = self._map.get(key)
+        if node is not None:
+            self._unlink(node)
+            self._append(node)
+        return node
 
     def get(self, key):
         """Retrieves the value for a key or None.
 
         this expunges expired keys during each get"""
 
-        for k in self.cache.keys():
-            (timeout, _value) = self.cache[k]
-            if timeout and timeutils.utcnow_ts() >= timeout:
-                del self.cache[k]
-
-        return self.cache.get(key, (0, None))[1]
+        with self._lock:
+            node = self._lookup(key)
+            if node is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return node[_VALUE]
 
-    def set(self, key, value, time=0, min_compress_len=0):
-        """Sets the value for a key."""
+    def _store(self, key, value, time):
         timeout = 0
         if time != 0:
             timeout = timeutils.utcnow_ts() + time
-        self.cache[key] = (timeout, value)
+            heapq.heappush(self._expiry, (timeout, key))
+        if key in self._map:
+            self._remove(key)
+        node = [None, None, key, timeout, value]
+        self._map[key] = node
+        self._append(node)
+        if self.max_size:
+            while len(self._map) > self.max_size:
+                self._remove(self._root[_NEXT][_KEY])
+                self.evictions += 1
+        self._compact()
         return True
 
+    def set(self, key, value, time=0, min_compress_len=0):
+        """Sets the value for a key."""
+        with self._lock:
+            self._expunge(timeutils.utcnow_ts())
+            return self._store(key, value, time)
+
     def add(self, key, value, time=0, min_compress_len=0):
         """Sets the value for a key if it doesn't exist."""
-        if not self.get(key) is None:
-            return False
-        return self.set(key, value, time, min_compress_len)
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            return self._store(key, value, time)
 
     def incr(self, key, delta=1):
         """Increments the value for a key."""
-        value = self.get(key)
-        if value is None:
-            return None
-        new_value = int(value) + delta
-        self.cache[key] = (self.cache[key][0], str(new_value))
-        return new_value
+        with self._lock:
+            node = self._lookup(key)
+            if node is None:
+                return None
+            new_value = int(node[_VALUE]) + delta
+            node[_VALUE] = str(new_value)
+            return new_value
+
+    def delete(self, key, time=0):
+        """Deletes the value for a key."""
+        with self._lock:
+            if key in self._map:
+                self._remove(key)
+            return 1
+
+    def get_stats(self):
+        """Returns hit/miss counters in the memcache client format."""
+        with self._lock:
+            stats = {'curr_items': len(self._map),
+                     'limit_maxitems': self.max_size,
+                     'get_hits': self.hits,
+                     'get_misses': self.misses,
+                     'evictions': self.evictions}
+        return [('memorycache', stats)]
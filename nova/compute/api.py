@@ -22,7 +22,9 @@
 networking and storage of VMs, and compute hosts on which they run)."""
 
 import base64
+import datetime
 import functools
+import itertools
 import re
 import string
 import time
@@ -33,6 +35,7 @@ from nova.compute import instance_types
 from nova.compute import power_state
 from nova.compute import rpcapi as compute_rpcapi
 from nova.compute import task_states
+from nova.compute import utils as compute_utils
 from nova.compute import vm_states
 from nova.consoleauth import rpcapi as consoleauth_rpcapi
 from nova import crypto
@@ -1041,6 +1044,69 @@ class API(base.Base):
         return self.db.instance_get_active_by_window(context, begin, end,
                                                      project_id)
 
+    def _get_rolled_up_window(self, context, begin, end):
+        """Find the run of rolled up audit periods ending closest to end.
+
+        Returns a (begin, end) tuple, or None when no complete audit period
+        inside the window has been rolled up yet.
+        """
+        def period_ending_by(timestamp):
+            # NOTE: last_completed_audit_period only returns periods ending
+            # strictly before the timestamp.
+            return utils.last_completed_audit_period(
+                    before=timestamp + datetime.timedelta(microseconds=1))
+
+        rolled_begin = rolled_end = None
+        period_begin, period_end = period_ending_by(end)
+        while period_begin >= begin:
+            if not compute_utils.has_usage_been_rolled_up(context,
+                                                          period_begin,
+                                                          period_end):
+                break
+            rolled_begin = period_begin
+            if rolled_end is None:
+                rolled_end = period_end
+            period_begin, period_end = period_ending_by(period_begin)
+
+        if rolled_begin is None:
+            return None
+        return rolled_begin, rolled_end
+
+    def get_usage_by_window(self, context, begin, end, project_id=None):
+        """Get per project usage totals for instances active in a window.
+
+        Closed audit periods which have been rolled up are read from the
+        rollups; only the rest of the window is computed from the
+        instances.
+        """
+        rolled_up = self._get_rolled_up_window(context, begin, end)
+        if not rolled_up:
+            return self.db.instance_usage_get_by_window(context, begin, end,
+                                                        project_id)
+
+        rolled_begin, rolled_end = rolled_up
+        usages = [self.db.instance_usage_rollup_get_by_window(
+                context, rolled_begin, rolled_end, project_id)]
+        if begin < rolled_begin:
+            usages.append(self.db.instance_usage_get_by_window(
+                    context, begin, rolled_begin, project_id))
+        if rolled_end < end:
+            usages.append(self.db.instance_usage_get_by_window(
+                    context, rolled_end, end, project_id))
+
+        totals = {}
+        for usage in itertools.chain(*usages):
+            total = totals.setdefault(usage['project_id'],
+                                      {'project_id': usage['project_id'],
+                                       'hours': 0,
+                                       'local_gb_hours': 0,
+                                       'memory_mb_hours': 0,
+                                       'vcpus_hours': 0})
+            for key in ('hours', 'local_gb_hours', 'memory_mb_hours',
+                        'vcpus_hours'):
+                total[key] += usage[key]
+        return [totals[key] for key in sorted(totals)]
+
     #NOTE(bcwaldon): this doesn't really belong in this class
     def get_instance_type(self, context, instance_type_id):
         """Get an instance type by instance type id."""
@@ -2290,50 +2356,37 @@ class SecurityGroupAPI(base.Base):
         handle = getattr(self.sgh, 'trigger_%s_refresh' % event)
         handle(*args)
 
+    def _refresh_instances_by_host(self, context, instances):
+        """Send each compute host a single request to refresh the rules of
+        all of the given instances it is running.
+        """
+        instances_by_host = {}
+        for instance in instances:
+            if instance['host']:
+                instances_by_host.setdefault(instance['host'],
+                                             []).append(instance)
+
+        for host, host_instances in instances_by_host.iteritems():
+            self.security_group_rpcapi.refresh_instances_security_rules(
+                    context, host, host_instances)
+
     def trigger_rules_refresh(self, context, id):
         """Called when a rule is added to or removed from a security_group."""
 
-        security_group = self.db.security_group_get(context, id)
-
-        for instance in security_group['instances']:
-            if instance['host'] is not None:
-                self.security_group_rpcapi.refresh_instance_security_rules(
-                        context, instance['host'], instance)
+        instances = self.db.security_group_instances_get_for_refresh(
+                context.elevated(), [id])
+        self._refresh_instances_by_host(context, instances)
 
     def trigger_members_refresh(self, context, group_ids):
         """Called when a security group gains a new or loses a member.
 
-        Sends an update request to each compute node for each instance for
-        which this is relevant.
+        Sends an update request to each compute node listing the instances
+        for which this is relevant, i.e. the members of every group with a
+        rule that references one of these groups as the grantee.
         """
-        # First, we get the security group rules that reference these groups as
-        # the grantee..
-        security_group_rules = set()
-        for group_id in group_ids:
-            security_group_rules.update(
-                self.db.security_group_rule_get_by_security_group_grantee(
-                                                                     context,
-                                                                     group_id))
-
-        # ..then we distill the rules into the groups to which they belong..
-        security_groups = set()
-        for rule in security_group_rules:
-            security_group = self.db.security_group_get(
-                                                    context,
-                                                    rule['parent_group_id'])
-            security_groups.add(security_group)
-
-        # ..then we find the instances that are members of these groups..
-        instances = set()
-        for security_group in security_groups:
-            for instance in security_group['instances']:
-                instances.add(instance)
-
-        # ..then we send a request to refresh the rules for each instance.
-        for instance in instances:
-            if instance['host']:
-                self.security_group_rpcapi.refresh_instance_security_rules(
-                        context, instance['host'], instance)
+        instances = self.db.security_group_grantee_instances_get_for_refresh(
+                context.elevated(), group_ids)
+        self._refresh_instances_by_host(context, instances)
 
     def parse_cidr(self, cidr):
         if cidr:
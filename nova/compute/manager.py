@@ -35,6 +35,7 @@ terminating it.
 """
 
 import contextlib
+import datetime
 import functools
 import socket
 import sys
@@ -72,6 +73,7 @@ from nova import quota
 from nova.scheduler import rpcapi as scheduler_rpcapi
 from nova import utils
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova import volume
 
 
@@ -131,6 +133,12 @@ compute_opts = [
                help="Action to take if a running deleted instance is detected."
                     "Valid options are 'noop', 'log' and 'reap'. "
                     "Set to 'noop' to disable."),
+    cfg.IntOpt("sync_power_state_interval",
+               default=10,
+               help="Number of periodic scheduler ticks to wait between "
+                    "full power state syncs. Drivers which emit lifecycle "
+                    "events keep power states current in between, so this "
+                    "can be raised for them."),
     cfg.IntOpt("image_cache_manager_interval",
                default=40,
                help="Number of periodic scheduler ticks to wait between "
@@ -139,6 +147,10 @@ compute_opts = [
                default=60,
                help="Number of seconds between instance info_cache self "
                         "healing updates"),
+    cfg.IntOpt("heal_instance_info_cache_batch_size",
+               default=50,
+               help="Number of instances whose info_cache is refreshed on "
+                    "each self healing update, stalest first"),
     cfg.BoolOpt('instance_usage_audit',
                default=False,
                help="Generate periodic compute.instance.exists notifications"),
@@ -247,7 +259,7 @@ def _get_image_meta(context, image_ref):
 class ComputeManager(manager.SchedulerDependentManager):
     """Manages the running instances from creation to destruction."""
 
-    RPC_API_VERSION = '1.43'
+    RPC_API_VERSION = '1.44'
 
     def __init__(self, compute_driver=None, *args, **kwargs):
         """Load configuration options and connect to the hypervisor."""
@@ -268,9 +280,9 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.network_api = network.API()
         self.volume_api = volume.API()
         self.network_manager = importutils.import_object(FLAGS.network_manager)
-        self._last_host_check = 0
-        self._last_bw_usage_poll = 0
-        self._last_info_cache_heal = 0
+        self._pending_power_states = {}
+        self._deferred_instance_updates = {}
+        self._power_state_events_running = False
         self.compute_api = compute.API()
         self.compute_rpcapi = compute_rpcapi.ComputeAPI()
         self.scheduler_rpcapi = scheduler_rpcapi.SchedulerAPI()
@@ -278,11 +290,24 @@ class ComputeManager(manager.SchedulerDependentManager):
         super(ComputeManager, self).__init__(service_name="compute",
                                              *args, **kwargs)
 
-    def _instance_update(self, context, instance_uuid, **kwargs):
-        """Update an instance in the database using kwargs as value."""
+    def _instance_update(self, context, instance_uuid, defer=False,
+                         **kwargs):
+        """Update an instance in the database using kwargs as value.
+
+        With defer=True the values are only remembered and get written,
+        with a single notification, by the next update of the instance
+        which is not deferred. Use it for intermediate states nobody acts
+        on, and make sure such an update follows. Returns None then.
+        """
+        if defer:
+            self._deferred_instance_updates.setdefault(instance_uuid,
+                                                       {}).update(kwargs)
+            return
 
+        values = self._deferred_instance_updates.pop(instance_uuid, {})
+        values.update(kwargs)
         (old_ref, instance_ref) = self.db.instance_update_and_get_original(
-                context, instance_uuid, kwargs)
+                context, instance_uuid, values)
         notifications.send_update(context, old_ref, instance_ref)
 
         return instance_ref
@@ -298,6 +323,7 @@ class ComputeManager(manager.SchedulerDependentManager):
 
     def init_host(self):
         """Initialization for a standalone compute service."""
+        self.driver.register_event_listener(self.handle_events)
         self.driver.init_host(host=self.host)
         context = nova.context.get_admin_context()
         instances = self.db.instance_get_all_by_host(context, self.host)
@@ -359,6 +385,44 @@ class ComputeManager(manager.SchedulerDependentManager):
         except exception.NotFound:
             return power_state.NOSTATE
 
+    def handle_events(self, event):
+        """Queue an event emitted by the virt driver for processing.
+
+        Lifecycle events are coalesced per instance, so only the latest
+        power state of each changed instance is applied.
+        """
+        if isinstance(event, virtevent.LifecycleEvent):
+            self._pending_power_states[event.uuid] = event.power_state
+            if not self._power_state_events_running:
+                self._power_state_events_running = True
+                greenthread.spawn_n(self._process_power_state_events)
+        else:
+            LOG.debug(_("Ignoring event %s"), event)
+
+    def _process_power_state_events(self):
+        """Apply queued lifecycle events until none are left."""
+        context = nova.context.get_admin_context()
+        try:
+            while self._pending_power_states:
+                uuid, vm_power_state = self._pending_power_states.popitem()
+                try:
+                    self.handle_lifecycle_event(context, uuid, vm_power_state)
+                except Exception:
+                    LOG.exception(_("Failed to process lifecycle event for "
+                                    "instance %s"), uuid)
+                greenthread.sleep(0)
+        finally:
+            self._power_state_events_running = False
+
+    def handle_lifecycle_event(self, context, uuid, vm_power_state):
+        """Sync one instance with a power state reported by the driver."""
+        try:
+            instance = self.db.instance_get_by_uuid(context, uuid)
+        except exception.InstanceNotFound:
+            LOG.debug(_("Lifecycle event for unknown instance %s"), uuid)
+            return
+        self._sync_instance_power_state(context, instance, vm_power_state)
+
     def get_console_topic(self, context, **kwargs):
         """Retrieves the console host for a project on this host.
 
@@ -403,6 +467,26 @@ class ComputeManager(manager.SchedulerDependentManager):
         """
         return self.driver.refresh_instance_security_rules(instance)
 
+    @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
+    def refresh_instances_security_rules(self, context, instances):
+        """Tell the virtualization driver to refresh security rules for
+        several instances on this host.
+
+        The firewall is applied once after all of them have been refreshed.
+        An instance failing to refresh does not stop the others.
+
+        """
+        self.driver.filter_defer_apply_on()
+        try:
+            for instance in instances:
+                try:
+                    self.driver.refresh_instance_security_rules(instance)
+                except Exception:
+                    LOG.exception(_('Failed to refresh security rules'),
+                                  instance=instance)
+        finally:
+            self.driver.filter_defer_apply_off()
+
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     def refresh_provider_fw_rules(self, context, **kwargs):
         """This call passes straight through to the virtualization driver."""
@@ -572,6 +656,8 @@ class ComputeManager(manager.SchedulerDependentManager):
                           instance_uuid=instance_uuid)
 
         if rescheduled:
+            # The build continues on another host
+            self._deferred_instance_updates.pop(instance_uuid, None)
             # log the original build error
             _log_original_error()
         else:
@@ -709,10 +795,14 @@ class ComputeManager(manager.SchedulerDependentManager):
         """Save the host and launched_on fields and log appropriately."""
         LOG.audit(_('Starting instance...'), context=context,
                   instance=instance)
+        # NOTE: The build states up to spawning are only written along with
+        # the spawning state, so a successful build costs two writes. The
+        # scheduler already saved the host, and if the build fails early
+        # the error state update writes them.
         self._instance_update(context, instance['uuid'],
                               host=self.host, launched_on=self.host,
                               vm_state=vm_states.BUILDING,
-                              task_state=None)
+                              task_state=None, defer=True)
 
     def _allocate_network(self, context, instance, requested_networks):
         """Allocate networks for an instance and return the network info"""
@@ -722,7 +812,8 @@ class ComputeManager(manager.SchedulerDependentManager):
             return network_model.NetworkInfo()
         self._instance_update(context, instance['uuid'],
                               vm_state=vm_states.BUILDING,
-                              task_state=task_states.NETWORKING)
+                              task_state=task_states.NETWORKING,
+                              defer=True)
         is_vpn = instance['image_ref'] == str(FLAGS.vpn_image_id)
         try:
             # allocate and get network info
@@ -743,7 +834,8 @@ class ComputeManager(manager.SchedulerDependentManager):
         """Set up the block device for an instance with error logging"""
         self._instance_update(context, instance['uuid'],
                               vm_state=vm_states.BUILDING,
-                              task_state=task_states.BLOCK_DEVICE_MAPPING)
+                              task_state=task_states.BLOCK_DEVICE_MAPPING,
+                              defer=True)
         try:
             return self._setup_block_device_mapping(context, instance)
         except Exception:
@@ -2495,55 +2587,42 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.destroy(instance, self._legacy_nw_info(network_info),
                             block_device_info)
 
-    @manager.periodic_task
+    @manager.periodic_task(spacing=FLAGS.heal_instance_info_cache_interval)
     def _heal_instance_info_cache(self, context):
-        """Called periodically.  On every call, try to update the
-        info_cache's network information for another instance by
-        calling to the network manager.
-
-        This is implemented by keeping a cache of uuids of instances
-        that live on this host.  On each call, we pop one off of a
-        list, pull the DB record, and try the call to the network API.
-        If anything errors, we don't care.  It's possible the instance
-        has been deleted, etc.
+        """Called periodically.  On every call, refresh the info_cache's
+        network information of the instances on this host which were
+        refreshed longest ago, heal_instance_info_cache_batch_size at a
+        time.
+
+        The network info of the whole batch is fetched with a single call
+        to the network API, which stores it in one transaction. Instances
+        whose network info fails are left out, so they don't hold up the
+        rest of the batch. If anything else errors, we don't care, the
+        instances stay the stalest ones and are tried again next time.
         """
-        heal_interval = FLAGS.heal_instance_info_cache_interval
-        if not heal_interval:
+        if not FLAGS.heal_instance_info_cache_interval:
             return
-        curr_time = time.time()
-        if self._last_info_cache_heal + heal_interval > curr_time:
+
+        instances = self.db.instance_get_all_by_host(context, self.host)
+        if not instances:
             return
-        self._last_info_cache_heal = curr_time
 
-        instance_uuids = getattr(self, '_instance_uuids_to_heal', None)
-        instance = None
+        def _last_healed(instance):
+            info_cache = instance['info_cache']
+            if not info_cache:
+                return datetime.datetime.min
+            return (info_cache['updated_at'] or info_cache['created_at'] or
+                    datetime.datetime.min)
 
-        while not instance or instance['host'] != self.host:
-            if instance_uuids:
-                try:
-                    instance = self.db.instance_get_by_uuid(context,
-                        instance_uuids.pop(0))
-                except exception.InstanceNotFound:
-                    # Instance is gone.  Try to grab another.
-                    continue
-            else:
-                # No more in our copy of uuids.  Pull from the DB.
-                db_instances = self.db.instance_get_all_by_host(
-                        context, self.host)
-                if not db_instances:
-                    # None.. just return.
-                    return
-                instance = db_instances.pop(0)
-                instance_uuids = [inst['uuid'] for inst in db_instances]
-                self._instance_uuids_to_heal = instance_uuids
-
-        # We have an instance now and it's ours
+        instances.sort(key=_last_healed)
+        batch = instances[:max(1, FLAGS.heal_instance_info_cache_batch_size)]
         try:
-            # Call to network API to get instance info.. this will
-            # force an update to the instance's info_cache
-            self.network_api.get_instance_nw_info(context, instance)
-            LOG.debug(_('Updated the info_cache for instance'),
-                      instance=instance)
+            # Call to network API to get the instances' info.. this will
+            # force an update to their info_caches
+            nw_infos = self.network_api.get_instances_nw_info(context, batch)
+            LOG.debug(_('Updated the info_cache of %(healed)d of %(count)d '
+                        'instances'),
+                      {'healed': len(nw_infos), 'count': len(batch)})
         except Exception:
             # We don't care about any failures
             pass
@@ -2651,6 +2730,12 @@ class ComputeManager(manager.SchedulerDependentManager):
                                         'on host %s') % self.host,
                                       instance=instance)
                         errors += 1
+                try:
+                    compute_utils.rollup_instance_usage(context, begin, end,
+                                                        self.host)
+                except Exception:
+                    LOG.exception(_('Failed to roll up instance usage '
+                                    'on host %s') % self.host)
                 compute_utils.finish_instance_usage_audit(context,
                                               begin, end,
                                               self.host, errors,
@@ -2661,50 +2746,41 @@ class ComputeManager(manager.SchedulerDependentManager):
                                               num_instances,
                                               time.time() - start_time))
 
-    @manager.periodic_task
+    @manager.periodic_task(spacing=FLAGS.bandwith_poll_interval)
     def _poll_bandwidth_usage(self, context, start_time=None, stop_time=None):
         if not start_time:
             start_time = utils.last_completed_audit_period()[1]
 
-        curr_time = time.time()
-        if curr_time - self._last_bw_usage_poll > FLAGS.bandwith_poll_interval:
-            self._last_bw_usage_poll = curr_time
-            LOG.info(_("Updating bandwidth usage cache"))
+        LOG.info(_("Updating bandwidth usage cache"))
 
-            instances = self.db.instance_get_all_by_host(context, self.host)
-            try:
-                bw_usage = self.driver.get_all_bw_usage(instances, start_time,
-                        stop_time)
-            except NotImplementedError:
-                # NOTE(mdragon): Not all hypervisors have bandwidth polling
-                # implemented yet.  If they don't it doesn't break anything,
-                # they just don't get the info in the usage events.
-                return
+        instances = self.db.instance_get_all_by_host(context, self.host)
+        try:
+            bw_usage = self.driver.get_all_bw_usage(instances, start_time,
+                    stop_time)
+        except NotImplementedError:
+            # NOTE(mdragon): Not all hypervisors have bandwidth polling
+            # implemented yet.  If they don't it doesn't break anything,
+            # they just don't get the info in the usage events.
+            return
 
-            refreshed = timeutils.utcnow()
-            for usage in bw_usage:
-                # Allow switching of greenthreads between queries.
-                greenthread.sleep(0)
-                self.db.bw_usage_update(context,
-                                        usage['uuid'],
-                                        usage['mac_address'],
-                                        start_time,
-                                        usage['bw_in'], usage['bw_out'],
-                                        last_refreshed=refreshed)
+        usages = [{'uuid': usage['uuid'],
+                   'mac': usage['mac_address'],
+                   'bw_in': usage['bw_in'],
+                   'bw_out': usage['bw_out']} for usage in bw_usage]
+        self.db.bw_usage_update_many(context, start_time, usages,
+                                     last_refreshed=timeutils.utcnow())
 
-    @manager.periodic_task
+    @manager.periodic_task(spacing=FLAGS.host_state_interval)
     def _report_driver_status(self, context):
-        curr_time = time.time()
-        if curr_time - self._last_host_check > FLAGS.host_state_interval:
-            self._last_host_check = curr_time
-            LOG.info(_("Updating host status"))
-            # This will grab info about the host and queue it
-            # to be sent to the Schedulers.
-            capabilities = self.driver.get_host_stats(refresh=True)
-            capabilities['host_ip'] = FLAGS.my_ip
-            self.update_service_capabilities(capabilities)
-
-    @manager.periodic_task(ticks_between_runs=10)
+        LOG.info(_("Updating host status"))
+        # This will grab info about the host and queue it
+        # to be sent to the Schedulers.
+        capabilities = self.driver.get_host_stats(refresh=True)
+        capabilities['host_ip'] = FLAGS.my_ip
+        self.update_service_capabilities(capabilities)
+
+    @manager.periodic_task(
+        ticks_between_runs=FLAGS.sync_power_state_interval)
     def _sync_power_states(self, context):
         """Align power states between the database and the hypervisor.
 
@@ -2714,6 +2790,11 @@ class ComputeManager(manager.SchedulerDependentManager):
         loop, one database record at a time, checking if the hypervisor has the
         same power state as is in the database. We call eventlet.sleep(0) after
         each loop to allow the periodic task eventlet to do other work.
+        The hypervisor power states are fetched up front in one call when
+        the driver supports it, rather than with one get_info() per instance.
+
+        Drivers which emit lifecycle events have changes applied as they
+        happen by handle_events(), so for them this is only a safety net.
 
         If the instance is not found on the hypervisor, but is in the database,
         then a stop() API will be called on the instance.
@@ -2723,6 +2804,11 @@ class ComputeManager(manager.SchedulerDependentManager):
         num_vm_instances = self.driver.get_num_instances()
         num_db_instances = len(db_instances)
 
+        try:
+            vm_power_states = self.driver.get_all_power_states()
+        except NotImplementedError:
+            vm_power_states = None
+
         if num_vm_instances != num_db_instances:
             LOG.warn(_("Found %(num_db_instances)s in the database and "
                        "%(num_vm_instances)s on the hypervisor.") % locals())
@@ -2730,118 +2816,127 @@ class ComputeManager(manager.SchedulerDependentManager):
         for db_instance in db_instances:
             # Allow other periodic tasks to do some work...
             greenthread.sleep(0)
-            db_power_state = db_instance['power_state']
             if db_instance['task_state'] is not None:
                 LOG.info(_("During sync_power_state the instance has a "
                            "pending task. Skip."), instance=db_instance)
                 continue
             # No pending tasks. Now try to figure out the real vm_power_state.
-            try:
-                vm_instance = self.driver.get_info(db_instance)
-                vm_power_state = vm_instance['state']
-            except exception.InstanceNotFound:
-                vm_power_state = power_state.NOSTATE
+            if vm_power_states is not None:
+                vm_power_state = vm_power_states.get(db_instance['name'],
+                                                     power_state.NOSTATE)
+            else:
+                try:
+                    vm_instance = self.driver.get_info(db_instance)
+                    vm_power_state = vm_instance['state']
+                except exception.InstanceNotFound:
+                    vm_power_state = power_state.NOSTATE
             # Note(maoy): the above get_info call might take a long time,
             # for example, because of a broken libvirt driver.
             # We re-query the DB to get the latest instance info to minimize
             # (not eliminate) race condition.
             u = self.db.instance_get_by_uuid(context,
                                              db_instance['uuid'])
-            db_power_state = u["power_state"]
-            vm_state = u['vm_state']
-            if self.host != u['host']:
-                # on the sending end of nova-compute _sync_power_state
-                # may have yielded to the greenthread performing a live
-                # migration; this in turn has changed the resident-host
-                # for the VM; However, the instance is still active, it
-                # is just in the process of migrating to another host.
-                # This implies that the compute source must relinquish
-                # control to the compute destination.
-                LOG.info(_("During the sync_power process the "
-                           "instance has moved from "
-                           "host %(src)s to host %(dst)s") %
-                           {'src': self.host,
-                            'dst': u['host']},
+            self._sync_instance_power_state(context, u, vm_power_state)
+
+    def _sync_instance_power_state(self, context, db_instance, vm_power_state):
+        """Align the power state of one freshly read instance record with
+        the power state reported by the hypervisor.
+        """
+        db_power_state = db_instance["power_state"]
+        vm_state = db_instance['vm_state']
+        if self.host != db_instance['host']:
+            # on the sending end of nova-compute _sync_power_state
+            # may have yielded to the greenthread performing a live
+            # migration; this in turn has changed the resident-host
+            # for the VM; However, the instance is still active, it
+            # is just in the process of migrating to another host.
+            # This implies that the compute source must relinquish
+            # control to the compute destination.
+            LOG.info(_("During the sync_power process the "
+                       "instance has moved from "
+                       "host %(src)s to host %(dst)s") %
+                       {'src': self.host,
+                        'dst': db_instance['host']},
+                     instance=db_instance)
+            return
+        elif db_instance['task_state'] is not None:
+            # on the receiving end of nova-compute, it could happen
+            # that the DB instance already report the new resident
+            # but the actual VM has not showed up on the hypervisor
+            # yet. In this case, let's allow the loop to continue
+            # and run the state sync in a later round
+            LOG.info(_("During sync_power_state the instance has a "
+                       "pending task. Skip."), instance=db_instance)
+            return
+        if vm_power_state != db_power_state:
+            # power_state is always updated from hypervisor to db
+            self._instance_update(context,
+                                  db_instance['uuid'],
+                                  power_state=vm_power_state)
+            db_power_state = vm_power_state
+        # Note(maoy): Now resolve the discrepancy between vm_state and
+        # vm_power_state. We go through all possible vm_states.
+        if vm_state in (vm_states.BUILDING,
+                        vm_states.RESCUED,
+                        vm_states.RESIZED,
+                        vm_states.SUSPENDED,
+                        vm_states.PAUSED,
+                        vm_states.ERROR):
+            # TODO(maoy): we ignore these vm_state for now.
+            pass
+        elif vm_state == vm_states.ACTIVE:
+            # The only rational power state should be RUNNING
+            if vm_power_state in (power_state.NOSTATE,
+                                   power_state.SHUTDOWN,
+                                   power_state.CRASHED):
+                LOG.warn(_("Instance shutdown by itself. Calling "
+                           "the stop API."), instance=db_instance)
+                try:
+                    # Note(maoy): here we call the API instead of
+                    # brutally updating the vm_state in the database
+                    # to allow all the hooks and checks to be performed.
+                    self.compute_api.stop(context, db_instance)
+                except Exception:
+                    # Note(maoy): there is no need to propergate the error
+                    # because the same power_state will be retrieved next
+                    # time and retried.
+                    # For example, there might be another task scheduled.
+                    LOG.exception(_("error during stop() in "
+                                    "sync_power_state."),
+                                  instance=db_instance)
+            elif vm_power_state in (power_state.PAUSED,
+                                    power_state.SUSPENDED):
+                LOG.warn(_("Instance is paused or suspended "
+                           "unexpectedly. Calling "
+                           "the stop API."), instance=db_instance)
+                try:
+                    self.compute_api.stop(context, db_instance)
+                except Exception:
+                    LOG.exception(_("error during stop() in "
+                                    "sync_power_state."),
+                                  instance=db_instance)
+        elif vm_state == vm_states.STOPPED:
+            if vm_power_state not in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN,
+                                      power_state.CRASHED):
+                LOG.warn(_("Instance is not stopped. Calling "
+                           "the stop API."), instance=db_instance)
+                try:
+                    # Note(maoy): this assumes that the stop API is
+                    # idempotent.
+                    self.compute_api.stop(context, db_instance)
+                except Exception:
+                    LOG.exception(_("error during stop() in "
+                                    "sync_power_state."),
+                                  instance=db_instance)
+        elif vm_state in (vm_states.SOFT_DELETED,
+                          vm_states.DELETED):
+            if vm_power_state not in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN):
+                # Note(maoy): this should be taken care of periodically in
+                # _cleanup_running_deleted_instances().
+                LOG.warn(_("Instance is not (soft-)deleted."),
                          instance=db_instance)
-                continue
-            elif u['task_state'] is not None:
-                # on the receiving end of nova-compute, it could happen
-                # that the DB instance already report the new resident
-                # but the actual VM has not showed up on the hypervisor
-                # yet. In this case, let's allow the loop to continue
-                # and run the state sync in a later round
-                LOG.info(_("During sync_power_state the instance has a "
-                           "pending task. Skip."), instance=db_instance)
-                continue
-            if vm_power_state != db_power_state:
-                # power_state is always updated from hypervisor to db
-                self._instance_update(context,
-                                      db_instance['uuid'],
-                                      power_state=vm_power_state)
-                db_power_state = vm_power_state
-            # Note(maoy): Now resolve the discrepancy between vm_state and
-            # vm_power_state. We go through all possible vm_states.
-            if vm_state in (vm_states.BUILDING,
-                            vm_states.RESCUED,
-                            vm_states.RESIZED,
-                            vm_states.SUSPENDED,
-                            vm_states.PAUSED,
-                            vm_states.ERROR):
-                # TODO(maoy): we ignore these vm_state for now.
-                pass
-            elif vm_state == vm_states.ACTIVE:
-                # The only rational power state should be RUNNING
-                if vm_power_state in (power_state.NOSTATE,
-                                       power_state.SHUTDOWN,
-                                       power_state.CRASHED):
-                    LOG.warn(_("Instance shutdown by itself. Calling "
-                               "the stop API."), instance=db_instance)
-                    try:
-                        # Note(maoy): here we call the API instead of
-                        # brutally updating the vm_state in the database
-                        # to allow all the hooks and checks to be performed.
-                        self.compute_api.stop(context, db_instance)
-                    except Exception:
-                        # Note(maoy): there is no need to propergate the error
-                        # because the same power_state will be retrieved next
-                        # time and retried.
-                        # For example, there might be another task scheduled.
-                        LOG.exception(_("error during stop() in "
-                                        "sync_power_state."),
-                                      instance=db_instance)
-                elif vm_power_state in (power_state.PAUSED,
-                                        power_state.SUSPENDED):
-                    LOG.warn(_("Instance is paused or suspended "
-                               "unexpectedly. Calling "
-                               "the stop API."), instance=db_instance)
-                    try:
-                        self.compute_api.stop(context, db_instance)
-                    except Exception:
-                        LOG.exception(_("error during stop() in "
-                                        "sync_power_state."),
-                                      instance=db_instance)
-            elif vm_state == vm_states.STOPPED:
-                if vm_power_state not in (power_state.NOSTATE,
-                                          power_state.SHUTDOWN,
-                                          power_state.CRASHED):
-                    LOG.warn(_("Instance is not stopped. Calling "
-                               "the stop API."), instance=db_instance)
-                    try:
-                        # Note(maoy): this assumes that the stop API is
-                        # idempotent.
-                        self.compute_api.stop(context, db_instance)
-                    except Exception:
-                        LOG.exception(_("error during stop() in "
-                                        "sync_power_state."),
-                                      instance=db_instance)
-            elif vm_state in (vm_states.SOFT_DELETED,
-                              vm_states.DELETED):
-                if vm_power_state not in (power_state.NOSTATE,
-                                          power_state.SHUTDOWN):
-                    # Note(maoy): this should be taken care of periodically in
-                    # _cleanup_running_deleted_instances().
-                    LOG.warn(_("Instance is not (soft-)deleted."),
-                             instance=db_instance)
 
     @manager.periodic_task
     def _reclaim_queued_deletes(self, context):
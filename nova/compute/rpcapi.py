@@ -124,6 +124,7 @@ class ComputeAPI(nova.openstack.common.rpc.proxy.RpcProxy):
                finish_resize(), confirm_resize(), revert_resize() and
                finish_revert_resize()
         1.43 - Add migrate_data to live_migration()
+        1.44 - Adds refresh_instances_security_rules()
     '''
 
     BASE_RPC_API_VERSION = '1.0'
@@ -540,6 +541,7 @@ class SecurityGroupAPI(nova.openstack.common.rpc.proxy.RpcProxy):
 
         1.0 - Initial version.
         1.41 - Adds refresh_instance_security_rules()
+        1.44 - Adds refresh_instances_security_rules()
     '''
 
     BASE_RPC_API_VERSION = '1.0'
@@ -567,3 +569,10 @@ class SecurityGroupAPI(nova.openstack.common.rpc.proxy.RpcProxy):
                 topic=_compute_topic(self.topic, ctxt, instance['host'],
                 instance),
                 version='1.41')
+
+    def refresh_instances_security_rules(self, ctxt, host, instances):
+        instances_p = jsonutils.to_primitive(instances)
+        self.cast(ctxt, self.make_msg('refresh_instances_security_rules',
+                instances=instances_p),
+                topic=_compute_topic(self.topic, ctxt, host, None),
+                version='1.44')
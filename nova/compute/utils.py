@@ -16,18 +16,32 @@
 
 """Compute-related Utilities and helpers."""
 
+from nova.common import memorycache
 from nova import db
 from nova import exception
 from nova import flags
 from nova.network import model as network_model
 from nova import notifications
+from nova.openstack.common import cfg
+from nova.openstack.common import excutils
 from nova.openstack.common import log
 from nova.openstack.common.notifier import api as notifier_api
 from nova import utils
 
+compute_utils_opts = [
+    cfg.IntOpt('network_info_cache_size',
+               default=1000,
+               help='Number of hydrated instance network info caches kept '
+                    'in process for building API responses. 0 disables '
+                    'this cache'),
+    ]
+
 FLAGS = flags.FLAGS
+FLAGS.register_opts(compute_utils_opts)
 LOG = log.getLogger(__name__)
 
+_NW_INFO_CACHE = None
+
 
 def notify_usage_exists(context, instance_ref, current_period=False,
                         ignore_missing_network_data=True,
@@ -47,6 +61,8 @@ def notify_usage_exists(context, instance_ref, current_period=False,
     :param extra_usage_info: Dictionary containing extra values to add or
         override in the notification if not None.
     """
+    if not notifications.enabled():
+        return
 
     audit_start, audit_end = notifications.audit_period_bounds(current_period)
 
@@ -89,6 +105,8 @@ def notify_about_instance_usage(context, instance, event_suffix,
     :param host: Compute host for the instance, if specified.  Default is
         FLAGS.host
     """
+    if not notifications.enabled():
+        return
 
     if not host:
         host = FLAGS.host
@@ -99,15 +117,34 @@ def notify_about_instance_usage(context, instance, event_suffix,
     usage_info = notifications.info_from_instance(context, instance,
             network_info, system_metadata, **extra_usage_info)
 
-    notifier_api.notify(context, 'compute.%s' % host,
-                        'compute.instance.%s' % event_suffix,
-                        notifier_api.INFO, usage_info)
+    notifications.notify(context, 'compute.%s' % host,
+                         'compute.instance.%s' % event_suffix,
+                         notifier_api.INFO, usage_info)
 
 
 def get_nw_info_for_instance(instance):
+    """Returns the hydrated network info cached for an instance.
+
+    Hydrating means parsing the cached json and building the network
+    model, so the result is memoized on the json itself. The returned
+    NetworkInfo may be shared between callers and must not be modified.
+    """
+    global _NW_INFO_CACHE
+
     info_cache = instance['info_cache'] or {}
     cached_nwinfo = info_cache.get('network_info') or []
-    return network_model.NetworkInfo.hydrate(cached_nwinfo)
+    if not isinstance(cached_nwinfo, basestring) or \
+            not FLAGS.network_info_cache_size:
+        return network_model.NetworkInfo.hydrate(cached_nwinfo)
+
+    if _NW_INFO_CACHE is None:
+        _NW_INFO_CACHE = memorycache.Client(
+                max_size=FLAGS.network_info_cache_size)
+    nw_info = _NW_INFO_CACHE.get(cached_nwinfo)
+    if nw_info is None:
+        nw_info = network_model.NetworkInfo.hydrate(cached_nwinfo)
+        _NW_INFO_CACHE.set(cached_nwinfo, nw_info)
+    return nw_info
 
 
 def has_audit_been_run(context, host, timestamp=None):
@@ -128,3 +165,44 @@ def start_instance_usage_audit(context, begin, end, host, num_instances):
 def finish_instance_usage_audit(context, begin, end, host, errors, message):
     db.task_log_end_task(context, "instance_usage_audit", begin, end, host,
                          errors, message)
+
+
+def has_usage_been_rolled_up(context, begin, end):
+    """Whether the usage of an audit period has been rolled up."""
+    # NOTE: task_log periods are strings, and comparing them against a
+    # datetime makes sqlalchemy bind it with a different format.
+    task_logs = db.task_log_get_all(context.elevated(),
+                                    "instance_usage_rollup",
+                                    str(begin), str(end), state="DONE")
+    return any(not task_log['errors'] for task_log in task_logs)
+
+
+def rollup_instance_usage(context, begin, end, host):
+    """Materialize the usage of all instances over an audit period.
+
+    The first host to audit a period rolls it up for every host at once,
+    so an instance moving between hosts before they have all audited the
+    period is still counted exactly once.
+
+    If this fails the rollup task ends with an error, and the usage of the
+    period keeps being computed from the instances.
+    """
+    period_beginning, period_ending = str(begin), str(end)
+    if db.task_log_get_all(context, "instance_usage_rollup",
+                           period_beginning, period_ending):
+        return
+    db.task_log_begin_task(context, "instance_usage_rollup",
+                           period_beginning, period_ending, host,
+                           message="Instance usage rollup started...")
+    try:
+        rollups = db.instance_usage_rollup_create(context, begin, end, host)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            db.task_log_end_task(context, "instance_usage_rollup",
+                                 period_beginning, period_ending, host, 1,
+                                 "Instance usage rollup failed on host "
+                                 "%s." % host)
+    db.task_log_end_task(context, "instance_usage_rollup",
+                         period_beginning, period_ending, host, 0,
+                         "Instance usage rollup wrote %d rows on host "
+                         "%s." % (rollups, host))
@@ -629,6 +629,36 @@ def instance_get_active_by_window_joined(context, begin, end=None,
                                               project_id, host)
 
 
+def instance_usage_get_by_window(context, begin, end, project_id=None):
+    """Get per project usage totals for instances active during a window.
+
+    Specifying a project_id will filter for a certain project.
+    """
+    return IMPL.instance_usage_get_by_window(context, begin, end,
+                                             project_id)
+
+
+def instance_usage_rollup_create(context, begin, end, host):
+    """Roll up the usage of all instances over a closed period.
+
+    The rows record host as the host which wrote them. Any rollup
+    previously written for the period is replaced. Returns the number of
+    rollup rows written.
+    """
+    return IMPL.instance_usage_rollup_create(context, begin, end, host)
+
+
+def instance_usage_rollup_get_by_window(context, begin, end,
+                                        project_id=None):
+    """Get per project usage totals from rollups within a window.
+
+    Only rollups whose period lies entirely inside the window are counted.
+    Specifying a project_id will filter for a certain project.
+    """
+    return IMPL.instance_usage_rollup_get_by_window(context, begin, end,
+                                                    project_id)
+
+
 def instance_get_all_by_project(context, project_id):
     """Get all instances belonging to a project."""
     return IMPL.instance_get_all_by_project(context, project_id)
@@ -639,6 +669,16 @@ def instance_get_all_by_host(context, host):
     return IMPL.instance_get_all_by_host(context, host)
 
 
+def instance_get_all_for_image_cache(context, host=None):
+    """Get the image cache fields of all instances, optionally on a host."""
+    return IMPL.instance_get_all_for_image_cache(context, host)
+
+
+def instance_count_by_image(context):
+    """Get the number of instances using each image."""
+    return IMPL.instance_count_by_image(context)
+
+
 def instance_get_all_by_host_and_not_type(context, host, type_id=None):
     """Get all instances belonging to a host with a different type_id."""
     return IMPL.instance_get_all_by_host_and_not_type(context, host, type_id)
@@ -740,6 +780,15 @@ def instance_info_cache_update(context, instance_uuid, values):
     return IMPL.instance_info_cache_update(context, instance_uuid, values)
 
 
+def instance_info_cache_update_many(context, values_by_uuid):
+    """Update many instance info cache records in one transaction.
+
+    :param values_by_uuid: = dict of column values to update, keyed by
+                             the uuid of the info cache's instance
+    """
+    return IMPL.instance_info_cache_update_many(context, values_by_uuid)
+
+
 def instance_info_cache_delete(context, instance_uuid):
     """Deletes an existing instance_info_cache record
 
@@ -1396,6 +1445,24 @@ def security_group_rule_get_by_security_group_grantee(context,
                                                              security_group_id)
 
 
+def security_group_instances_get_for_refresh(context, security_group_ids):
+    """Get the instances, on any host, which are members of any of the
+    given security groups.
+    """
+    return IMPL.security_group_instances_get_for_refresh(context,
+                                                         security_group_ids)
+
+
+def security_group_grantee_instances_get_for_refresh(context,
+                                                     security_group_ids):
+    """Get the instances, on any host, which are members of any security
+    group holding a rule that grants access to one of the given security
+    groups.
+    """
+    return IMPL.security_group_grantee_instances_get_for_refresh(context,
+            security_group_ids)
+
+
 def security_group_rule_destroy(context, security_group_rule_id):
     """Deletes a security group rule."""
     return IMPL.security_group_rule_destroy(context, security_group_rule_id)
@@ -1608,6 +1675,16 @@ def bw_usage_update(context, uuid, mac, start_period, bw_in, bw_out,
             bw_out, last_refreshed=last_refreshed)
 
 
+def bw_usage_update_many(context, start_period, usages, last_refreshed=None):
+    """Update cached bandwidth usage for many instances' networks at once.
+
+    usages is a list of dicts with uuid, mac, bw_in and bw_out keys.
+    Creates new records as needed.
+    """
+    return IMPL.bw_usage_update_many(context, start_period, usages,
+            last_refreshed=last_refreshed)
+
+
 ####################
 
 
@@ -26,6 +26,7 @@ import functools
 import warnings
 
 from nova import block_device
+from nova.compute import task_states
 from nova.compute import vm_states
 from nova import db
 from nova.db.sqlalchemy import models
@@ -36,12 +37,17 @@ from nova.openstack.common import log as logging
 from nova.openstack.common import timeutils
 from nova import utils
 from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import DateTime
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.sql.expression import asc
+from sqlalchemy.sql.expression import case
 from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import extract
+from sqlalchemy.sql.expression import literal
 from sqlalchemy.sql.expression import literal_column
 from sqlalchemy.sql import func
 
@@ -1675,6 +1681,134 @@ def instance_get_active_by_window_joined(context, begin, end=None,
     return query.all()
 
 
+def _seconds_since(column, reference):
+    """Returns an expression for the seconds elapsed from reference to column.
+
+    Date arithmetic isn't portable, so this picks the right form for the
+    configured database.
+    """
+    db_string = FLAGS.sql_connection.split(':')[0].split('+')[0]
+    reference = literal(reference, type_=DateTime)
+    if db_string == 'mysql':
+        return func.timestampdiff(literal_column('SECOND'), reference, column)
+    if db_string == 'postgresql':
+        return extract('epoch', column - reference)
+    return (func.julianday(column) - func.julianday(reference)) * 86400.0
+
+
+def _instance_usage_query(session, begin, end, *columns):
+    """Returns a query totalling instance usage during a window.
+
+    Instance uptime is clipped to the window and weighted by the flavor
+    of the instance in the database, so no instance rows are loaded. The
+    totals are grouped by the given instance columns.
+    """
+    delta = end - begin
+    period = delta.days * 24 * 3600 + delta.seconds + \
+             delta.microseconds / 1000000.0
+
+    launched_at = models.Instance.launched_at
+    terminated_at = models.Instance.terminated_at
+    start = case([(launched_at < begin, literal(0.0))],
+                 else_=_seconds_since(launched_at, begin))
+    stop = case([(or_(terminated_at == None, terminated_at > end),
+                  literal(period))],
+                else_=_seconds_since(terminated_at, begin))
+    hours = (stop - start) / 3600.0
+
+    instance_type = models.InstanceTypes
+    local_gb = instance_type.root_gb + instance_type.ephemeral_gb
+
+    columns = columns + (
+            func.sum(hours).label('hours'),
+            func.sum(hours * local_gb).label('local_gb_hours'),
+            func.sum(hours * instance_type.memory_mb).label('memory_mb_hours'),
+            func.sum(hours * instance_type.vcpus).label('vcpus_hours'))
+    return session.query(*columns).\
+                    join((instance_type,
+                          models.Instance.instance_type_id ==
+                              instance_type.id)).\
+                    filter(instance_type.deleted == False).\
+                    filter(or_(terminated_at == None,
+                               terminated_at > begin)).\
+                    filter(launched_at < end)
+
+
+def _usage_totals(row):
+    return {'project_id': row.project_id,
+            'hours': float(row.hours or 0),
+            'local_gb_hours': float(row.local_gb_hours or 0),
+            'memory_mb_hours': float(row.memory_mb_hours or 0),
+            'vcpus_hours': float(row.vcpus_hours or 0)}
+
+
+@require_context
+def instance_usage_get_by_window(context, begin, end, project_id=None):
+    """Return per project usage totals for instances active during window."""
+    session = get_session()
+    query = _instance_usage_query(session, begin, end,
+                                  models.Instance.project_id)
+    if project_id:
+        query = query.filter(models.Instance.project_id == project_id)
+    query = query.group_by(models.Instance.project_id).\
+                  order_by(models.Instance.project_id)
+
+    return [_usage_totals(row) for row in query.all()]
+
+
+@require_admin_context
+def instance_usage_rollup_create(context, begin, end, host):
+    """Materialize the usage of all instances during a period."""
+    session = get_session()
+    with session.begin():
+        session.query(models.InstanceUsageRollup).\
+                filter_by(period_beginning=begin).\
+                filter_by(period_ending=end).\
+                filter_by(deleted=False).\
+                update({'deleted': True,
+                        'deleted_at': timeutils.utcnow(),
+                        'updated_at': literal_column('updated_at')})
+
+        query = _instance_usage_query(session, begin, end,
+                                      models.Instance.project_id,
+                                      models.Instance.instance_type_id).\
+                        group_by(models.Instance.project_id,
+                                 models.Instance.instance_type_id)
+        rows = query.all()
+        for row in rows:
+            rollup = models.InstanceUsageRollup()
+            rollup.update(_usage_totals(row))
+            rollup.update({'host': host,
+                           'instance_type_id': row.instance_type_id,
+                           'period_beginning': begin,
+                           'period_ending': end})
+            rollup.save(session=session)
+    return len(rows)
+
+
+@require_context
+def instance_usage_rollup_get_by_window(context, begin, end,
+                                        project_id=None):
+    """Return per project usage totals for rollups within a window."""
+    rollup = models.InstanceUsageRollup
+    query = model_query(context, rollup.project_id,
+                        func.sum(rollup.hours).label('hours'),
+                        func.sum(rollup.local_gb_hours).\
+                            label('local_gb_hours'),
+                        func.sum(rollup.memory_mb_hours).\
+                            label('memory_mb_hours'),
+                        func.sum(rollup.vcpus_hours).label('vcpus_hours'),
+                        read_deleted="no").\
+                    filter(rollup.period_beginning >= begin).\
+                    filter(rollup.period_ending <= end)
+    if project_id:
+        query = query.filter(rollup.project_id == project_id)
+    query = query.group_by(rollup.project_id).\
+                  order_by(rollup.project_id)
+
+    return [_usage_totals(row) for row in query.all()]
+
+
 @require_admin_context
 def _instance_get_all_query(context, project_only=False):
     return model_query(context, models.Instance, project_only=project_only).\
@@ -1689,6 +1823,55 @@ def instance_get_all_by_host(context, host):
     return _instance_get_all_query(context).filter_by(host=host).all()
 
 
+@require_admin_context
+def instance_get_all_for_image_cache(context, host=None):
+    """Returns the few instance fields the image cache manager looks at.
+
+    Only the needed columns are selected and no relations are joined, so
+    this stays cheap even when every compute node runs it periodically.
+
+    With a host, instances being resized are returned whatever their host
+    is, as the source of a resize keeps their old disk until it is
+    confirmed or reverted.
+    """
+    columns = [models.Instance.id, models.Instance.uuid,
+               models.Instance.host, models.Instance.image_ref,
+               models.Instance.task_state, models.Instance.vm_state]
+    query = model_query(context, *columns, read_deleted="no")
+    if host is not None:
+        resize_states = [task_states.RESIZE_PREP,
+                         task_states.RESIZE_MIGRATING,
+                         task_states.RESIZE_MIGRATED,
+                         task_states.RESIZE_FINISH]
+        query = query.filter(or_(
+                models.Instance.host == host,
+                models.Instance.task_state.in_(resize_states),
+                models.Instance.vm_state == vm_states.RESIZED))
+
+    result = []
+    for instance_id, uuid, inst_host, image_ref, task_state, vm_state in \
+            query.all():
+        # NOTE: the name is derived from the template, so build it from
+        # a detached model holding the selected columns.
+        name = models.Instance(id=instance_id, uuid=uuid).name
+        result.append({'name': name,
+                       'uuid': uuid,
+                       'host': inst_host,
+                       'image_ref': image_ref,
+                       'task_state': task_state,
+                       'vm_state': vm_state})
+    return result
+
+
+@require_admin_context
+def instance_count_by_image(context):
+    """Returns a dict of image_ref to the number of instances using it."""
+    query = model_query(context, models.Instance.image_ref,
+                        func.count(models.Instance.id), read_deleted="no").\
+                    group_by(models.Instance.image_ref)
+    return dict(query.all())
+
+
 @require_admin_context
 def instance_get_all_by_host_and_not_type(context, host, type_id=None):
     return _instance_get_all_query(context).filter_by(host=host).\
@@ -1939,6 +2122,43 @@ def instance_info_cache_update(context, instance_uuid, values,
     return info_cache
 
 
+@require_context
+def instance_info_cache_update_many(context, values_by_uuid):
+    """Update many instance info cache records in one transaction.
+
+    :param values_by_uuid: = dict of column values to update, keyed by
+                             the uuid of the info cache's instance
+    """
+    if not values_by_uuid:
+        return
+
+    cache_uuid = models.InstanceInfoCache.instance_uuid
+    # NOTE: Unchanged values make no UPDATE, so updated_at is set explicitly
+    # for callers telling fresh caches from stale ones by it
+    now = timeutils.utcnow()
+    session = get_session()
+    with session.begin():
+        info_caches = session.query(models.InstanceInfoCache).\
+                              filter(cache_uuid.in_(values_by_uuid.keys())).\
+                              all()
+        info_caches = dict((info_cache['instance_uuid'], info_cache)
+                           for info_cache in info_caches)
+
+        for instance_uuid, values in values_by_uuid.iteritems():
+            info_cache = info_caches.get(instance_uuid)
+            if info_cache is None:
+                info_cache = models.InstanceInfoCache()
+                info_cache.update(values)
+                info_cache['instance_uuid'] = instance_uuid
+            elif info_cache['deleted']:
+                # NOTE(tr3buchet): let's leave it alone if it's already deleted
+                continue
+            else:
+                info_cache.update(values)
+                info_cache['updated_at'] = now
+            session.add(info_cache)
+
+
 @require_context
 def instance_info_cache_delete(context, instance_uuid, session=None):
     """Deletes an existing instance_info_cache record
@@ -3785,6 +4005,40 @@ def security_group_rule_get_by_security_group_grantee(context,
                          all()
 
 
+def _security_group_members_query(context, security_group_ids):
+    """Instances on a host which belong to any of the given groups."""
+    assoc = models.SecurityGroupInstanceAssociation
+    return model_query(context, models.Instance, read_deleted="no").\
+            join((assoc, assoc.instance_uuid == models.Instance.uuid)).\
+            filter(assoc.security_group_id.in_(security_group_ids)).\
+            filter(assoc.deleted == False).\
+            filter(models.Instance.host != None).\
+            distinct()
+
+
+@require_admin_context
+def security_group_instances_get_for_refresh(context, security_group_ids):
+    if not security_group_ids:
+        return []
+    return _security_group_members_query(context, security_group_ids).all()
+
+
+@require_admin_context
+def security_group_grantee_instances_get_for_refresh(context,
+                                                     security_group_ids):
+    if not security_group_ids:
+        return []
+    # The groups holding a rule which grants access to any of the given
+    # groups, resolved by the database in the same statement.
+    parent_ids = model_query(context,
+                             models.SecurityGroupIngressRule.parent_group_id,
+                             read_deleted="no").\
+                    filter(models.SecurityGroupIngressRule.group_id.in_(
+                                                    security_group_ids)).\
+                    subquery()
+    return _security_group_members_query(context, parent_ids).all()
+
+
 @require_context
 def security_group_rule_create(context, values):
     security_group_rule_ref = models.SecurityGroupIngressRule()
@@ -4426,6 +4680,60 @@ def bw_usage_update(context, uuid, mac, start_period, bw_in, bw_out,
         bwusage.save(session=session)
 
 
+@require_context
+def bw_usage_update_many(context, start_period, usages, last_refreshed=None,
+                         session=None):
+    if not usages:
+        return
+    if not session:
+        session = get_session()
+
+    if last_refreshed is None:
+        last_refreshed = timeutils.utcnow()
+
+    # Only the last sample for each (uuid, mac) pair counts.
+    samples = {}
+    for usage in usages:
+        samples[(usage['uuid'], usage['mac'])] = usage
+
+    table = models.BandwidthUsage.__table__
+    with session.begin():
+        # NOTE: Look up every existing row for the period in one query, then
+        # write the whole sample with one executemany update and one
+        # executemany insert rather than a transaction per mac.
+        uuids = set(uuid for uuid, _mac in samples)
+        rows = model_query(context, models.BandwidthUsage.id,
+                           models.BandwidthUsage.uuid,
+                           models.BandwidthUsage.mac,
+                           session=session, read_deleted="yes").\
+                      filter_by(start_period=start_period).\
+                      filter(models.BandwidthUsage.uuid.in_(uuids)).\
+                      all()
+        existing = dict(((row.uuid, row.mac), row.id) for row in rows)
+
+        updates = []
+        inserts = []
+        for key, usage in samples.iteritems():
+            values = {'last_refreshed': last_refreshed,
+                      'bw_in': usage['bw_in'],
+                      'bw_out': usage['bw_out']}
+            if key in existing:
+                values['_id'] = existing[key]
+                updates.append(values)
+            else:
+                values.update(uuid=usage['uuid'],
+                              mac=usage['mac'],
+                              start_period=start_period)
+                inserts.append(values)
+
+        if updates:
+            session.execute(table.update().
+                                where(table.c.id == bindparam('_id')),
+                            updates)
+        if inserts:
+            session.execute(table.insert(), inserts)
+
+
 ####################
 
 
@@ -0,0 +1,68 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer
+from sqlalchemy import Index, MetaData, String, Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    # create new table
+    rollups = Table('instance_usage_rollups', meta,
+            Column('created_at', DateTime(timezone=False)),
+            Column('updated_at', DateTime(timezone=False)),
+            Column('deleted_at', DateTime(timezone=False)),
+            Column('deleted',
+                    Boolean(create_constraint=True, name=None)),
+            Column('id', Integer(),
+                    primary_key=True,
+                    nullable=False,
+                    autoincrement=True),
+            Column('host', String(255), index=True, nullable=False),
+            Column('project_id', String(255), index=True),
+            Column('instance_type_id', Integer()),
+            Column('period_beginning', DateTime(timezone=False),
+                                       nullable=False),
+            Column('period_ending', DateTime(timezone=False),
+                                    nullable=False),
+            Column('hours', Float(), default=0),
+            Column('local_gb_hours', Float(), default=0),
+            Column('memory_mb_hours', Float(), default=0),
+            Column('vcpus_hours', Float(), default=0),
+            )
+    try:
+        rollups.create()
+    except Exception:
+        meta.drop_all(tables=[rollups])
+        raise
+
+    Index('instance_usage_rollups_period_idx',
+          rollups.c.period_beginning,
+          rollups.c.period_ending).create(migrate_engine)
+
+    if migrate_engine.name == "mysql":
+        migrate_engine.execute("ALTER TABLE instance_usage_rollups "
+                "Engine=InnoDB")
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    rollups = Table('instance_usage_rollups', meta, autoload=True)
+    rollups.drop()
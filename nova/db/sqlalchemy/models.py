@@ -993,3 +993,18 @@ class TaskLog(BASE, NovaBase):
     message = Column(String(255), nullable=False)
     task_items = Column(Integer(), default=0)
     errors = Column(Integer(), default=0)
+
+
+class InstanceUsageRollup(BASE, NovaBase):
+    """Flavor weighted usage of a project over an audit period"""
+    __tablename__ = 'instance_usage_rollups'
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    host = Column(String(255), nullable=False)
+    project_id = Column(String(255))
+    instance_type_id = Column(Integer)
+    period_beginning = Column(DateTime, nullable=False)
+    period_ending = Column(DateTime, nullable=False)
+    hours = Column(Float, default=0)
+    local_gb_hours = Column(Float, default=0)
+    memory_mb_hours = Column(Float, default=0)
+    vcpus_hours = Column(Float, default=0)
@@ -53,8 +53,16 @@ This module provides Manager, a base class for managers.
 
 """
 
+import sys
+import time
+
+import eventlet
+from eventlet import greenpool
+
 from nova.db import base
+from nova import exception
 from nova import flags
+from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
 from nova.openstack.common.plugin import pluginmanager
 from nova.openstack.common.rpc import dispatcher as rpc_dispatcher
@@ -62,7 +70,15 @@ from nova.scheduler import rpcapi as scheduler_rpcapi
 from nova import version
 
 
+manager_opts = [
+    cfg.IntOpt('periodic_task_workers',
+               default=4,
+               help='Number of periodic tasks of a service run concurrently'),
+    ]
+
 FLAGS = flags.FLAGS
+FLAGS.register_opts(manager_opts)
+flags.DECLARE('periodic_interval', 'nova.service')
 
 
 LOG = logging.getLogger(__name__)
@@ -73,14 +89,22 @@ def periodic_task(*args, **kwargs):
 
     This decorator can be used in two ways:
 
-        1. Without arguments '@periodic_task', this will be run on every tick
-           of the periodic scheduler.
+        1. Without arguments '@periodic_task', this will be run every
+           periodic_interval seconds.
 
-        2. With arguments, @periodic_task(ticks_between_runs=N), this will be
-           run on every N ticks of the periodic scheduler.
+        2. With arguments, @periodic_task(spacing=N), this will be run at
+           most once every N seconds. A timeout=N argument makes the
+           scheduler give up on a run of the task taking more than N
+           seconds.
+
+    The older @periodic_task(ticks_between_runs=N) is run every N + 1
+    periodic_interval seconds, starting N + 1 periodic_interval seconds
+    after the service starts.
     """
     def decorator(f):
         f._periodic_task = True
+        f._periodic_spacing = kwargs.pop('spacing', 0)
+        f._periodic_timeout = kwargs.pop('timeout', None)
         f._ticks_between_runs = kwargs.pop('ticks_between_runs', 0)
         return f
 
@@ -102,6 +126,12 @@ def periodic_task(*args, **kwargs):
         return decorator(args[0])
 
 
+def _min_idle(idle_for, seconds):
+    if idle_for is None:
+        return seconds
+    return min(idle_for, seconds)
+
+
 class ManagerMeta(type):
     def __init__(cls, names, bases, dict_):
         """Metaclass that allows us to collect decorated periodic tasks."""
@@ -116,17 +146,11 @@ class ManagerMeta(type):
         except AttributeError:
             cls._periodic_tasks = []
 
-        try:
-            cls._ticks_to_skip = cls._ticks_to_skip.copy()
-        except AttributeError:
-            cls._ticks_to_skip = {}
-
         for value in cls.__dict__.values():
             if getattr(value, '_periodic_task', False):
                 task = value
                 name = task.__name__
                 cls._periodic_tasks.append((name, task))
-                cls._ticks_to_skip[name] = task._ticks_between_runs
 
 
 class Manager(base.Base):
@@ -139,6 +163,11 @@ class Manager(base.Base):
         if not host:
             host = FLAGS.host
         self.host = host
+        self._periodic_last_run = {}
+        self._periodic_stats = {}
+        self._periodic_running = {}
+        self._periodic_pool = greenpool.GreenPool(
+                max(1, FLAGS.periodic_task_workers))
         self.load_plugins()
         super(Manager, self).__init__(db_driver)
 
@@ -154,28 +183,111 @@ class Manager(base.Base):
         '''
         return rpc_dispatcher.RpcDispatcher([self])
 
-    def periodic_tasks(self, context, raise_on_error=False):
-        """Tasks to be run at a periodic interval."""
-        for task_name, task in self._periodic_tasks:
+    @staticmethod
+    def _periodic_spacing(task):
+        if task._ticks_between_runs:
+            return (task._ticks_between_runs + 1) * FLAGS.periodic_interval
+        return task._periodic_spacing or FLAGS.periodic_interval
+
+    def _run_periodic_task(self, context, task_name, task, lateness):
+        full_task_name = '.'.join([self.__class__.__name__, task_name])
+        LOG.debug(_("Running periodic task %(full_task_name)s"), locals())
+
+        stats = self._periodic_stats.setdefault(task_name,
+                {'runs': 0, 'failures': 0, 'runtime': 0.0, 'lateness': 0.0})
+        start = time.time()
+        timeout = eventlet.Timeout(task._periodic_timeout)
+        try:
+            task(self, context)
+        except eventlet.Timeout, e:
+            if e is not timeout:
+                raise
+            stats['failures'] += 1
+            raise exception.NovaException(
+                    _("%(full_task_name)s timed out after %(seconds)ds") %
+                    {'full_task_name': full_task_name,
+                     'seconds': task._periodic_timeout})
+        except Exception:
+            stats['failures'] += 1
+            raise
+        finally:
+            timeout.cancel()
+            stats['runs'] += 1
+            stats['runtime'] = time.time() - start
+            stats['lateness'] = lateness
+            LOG.debug(_("Periodic task %(full_task_name)s took %(runtime).2fs,"
+                        " started %(lateness).2fs late"),
+                      dict(stats, full_task_name=full_task_name))
+
+    def _periodic_task_done(self, thread, task_name, log_errors):
+        del self._periodic_running[task_name]
+        if not log_errors:
+            return
+        try:
+            thread.wait()
+        except Exception as e:
             full_task_name = '.'.join([self.__class__.__name__, task_name])
+            LOG.exception(_("Error during %(full_task_name)s: %(e)s"),
+                          locals())
 
-            ticks_to_skip = self._ticks_to_skip[task_name]
-            if ticks_to_skip > 0:
-                LOG.debug(_("Skipping %(full_task_name)s, %(ticks_to_skip)s"
-                            " ticks left until next run"), locals())
-                self._ticks_to_skip[task_name] -= 1
-                continue
+    def periodic_tasks(self, context, raise_on_error=False):
+        """Starts the periodic tasks which are due in the background.
 
-            self._ticks_to_skip[task_name] = task._ticks_between_runs
-            LOG.debug(_("Running periodic task %(full_task_name)s"), locals())
+        Tasks run concurrently, up to periodic_task_workers at a time. A
+        task still running from an earlier call is not started again, so
+        a slow task only delays its own next run.
+
+        Returns how many seconds may pass before a task is due again, or
+        None if there are no periodic tasks. With raise_on_error the tasks
+        started are waited for, and the first error they raise is raised.
+        """
+        now = time.time()
+        idle_for = None
+        started = []
+        for task_name, task in self._periodic_tasks:
+            spacing = self._periodic_spacing(task)
+            # Tasks spaced in ticks have always waited for their first run
+            last_run = self._periodic_last_run.setdefault(task_name,
+                    now if task._ticks_between_runs else None)
+
+            lateness = 0.0
+            if last_run is not None:
+                next_run = last_run + spacing
+                if next_run > now:
+                    idle_for = _min_idle(idle_for, next_run - now)
+                    continue
+                lateness = now - next_run
+
+            if task_name in self._periodic_running:
+                LOG.debug(_("Skipping periodic task %(task_name)s, its "
+                            "previous run has not finished"), locals())
+                idle_for = _min_idle(idle_for, spacing)
+                continue
+            if not self._periodic_pool.free():
+                # Retry once a worker may have become free
+                idle_for = _min_idle(idle_for, FLAGS.periodic_interval)
+                continue
 
-            try:
-                task(self, context)
-            except Exception as e:
-                if raise_on_error:
-                    raise
-                LOG.exception(_("Error during %(full_task_name)s: %(e)s"),
-                              locals())
+            self._periodic_last_run[task_name] = now
+            idle_for = _min_idle(idle_for, spacing)
+            thread = self._periodic_pool.spawn(self._run_periodic_task,
+                                               context, task_name, task,
+                                               lateness)
+            self._periodic_running[task_name] = thread
+            thread.link(self._periodic_task_done, task_name,
+                        not raise_on_error)
+            started.append(thread)
+
+        if raise_on_error:
+            exc_info = None
+            for thread in started:
+                try:
+                    thread.wait()
+                except Exception:
+                    exc_info = exc_info or sys.exc_info()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return idle_for
 
     def init_host(self):
         """Handle initialization if this is a standalone service.
@@ -80,6 +80,20 @@ def update_instance_cache_with_nw_info(api, context, instance,
         LOG.debug(_('kwargs: %s') % (kwargs or {}))
 
 
+def update_instances_cache_with_nw_info(api, context, nw_infos):
+    """Stores many instances' network info in one transaction.
+
+    :param nw_infos: dict of NetworkInfo keyed by instance uuid
+    """
+    try:
+        caches = dict((instance_uuid, {'network_info': nw_info.json()})
+                      for instance_uuid, nw_info in nw_infos.iteritems())
+        api.db.instance_info_cache_update_many(context, caches)
+    except Exception:
+        LOG.exception(_('Failed storing info caches of %d instances'),
+                      len(nw_infos))
+
+
 class API(base.Base):
     """API for interacting with the network manager."""
 
@@ -303,6 +317,29 @@ class API(base.Base):
 
         return network_model.NetworkInfo.hydrate(nw_info)
 
+    def get_instances_nw_info(self, context, instances):
+        """Returns network info for many instances at once, refreshing
+        their info caches on the way.
+
+        :returns: dict of NetworkInfo keyed by instance uuid
+        """
+        args = {'instances': [{'instance_id': instance['id'],
+                               'instance_uuid': instance['uuid'],
+                               'rxtx_factor':
+                                   instance['instance_type']['rxtx_factor'],
+                               'host': instance['host'],
+                               'project_id': instance['project_id']}
+                              for instance in instances]}
+        nw_infos = rpc.call(context, FLAGS.network_topic,
+                            {'method': 'get_instances_nw_info',
+                             'args': args})
+
+        nw_infos = dict((instance_uuid, network_model.NetworkInfo.hydrate(
+                                            nw_info))
+                        for instance_uuid, nw_info in nw_infos.iteritems())
+        update_instances_cache_with_nw_info(self, context, nw_infos)
+        return nw_infos
+
     def validate_networks(self, context, requested_networks):
         """validate the networks passed at the time of creating
         the server
@@ -1031,6 +1031,42 @@ class NetworkManager(manager.SchedulerDependentManager):
                                                          rxtx_factor, host)
         return nw_info
 
+    @wrap_check_policy
+    def get_instances_nw_info(self, context, instances):
+        """Creates network info lists for many instances at once.
+
+        :param instances: list of dicts with the arguments
+                          get_instance_nw_info takes for each instance
+        :returns: dict of network info lists keyed by instance uuid,
+                  instances whose network info failed are left out
+        """
+        network_cache = {}
+        nw_infos = {}
+        for instance in instances:
+            instance_uuid = instance['instance_uuid']
+            try:
+                vifs = self.db.virtual_interface_get_by_instance(context,
+                                                                 instance_uuid)
+                networks = {}
+                for vif in vifs:
+                    network_id = vif.get('network_id')
+                    if network_id is None:
+                        continue
+                    if network_id not in network_cache:
+                        network_cache[network_id] = self._get_network_by_id(
+                                context, network_id)
+                    networks[vif['uuid']] = network_cache[network_id]
+
+                nw_infos[instance_uuid] = self.build_network_info_model(
+                        context, vifs, networks, instance['rxtx_factor'],
+                        instance['host'])
+            except Exception:
+                # One broken instance must not keep the others from
+                # getting their network info
+                LOG.exception(_('Failed to get network info'),
+                              instance_uuid=instance_uuid)
+        return nw_infos
+
     def build_network_info_model(self, context, vifs, networks,
                                  rxtx_factor, instance_host):
         """Builds a NetworkInfo object containing all network information
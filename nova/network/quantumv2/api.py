@@ -19,6 +19,7 @@ from nova.db import base
 from nova import exception
 from nova import flags
 from nova.network.api import refresh_cache
+from nova.network.api import update_instances_cache_with_nw_info
 from nova.network import model as network_model
 from nova.network import quantumv2
 from nova.openstack.common import cfg
@@ -132,6 +133,26 @@ class API(base.Base):
         nw_info = self._build_network_info_model(context, instance, networks)
         return network_model.NetworkInfo.hydrate(nw_info)
 
+    def get_instances_nw_info(self, context, instances):
+        """Returns network info for many instances at once, refreshing
+        their info caches in one transaction.
+
+        :returns: dict of NetworkInfo keyed by instance uuid, instances
+                  whose network info failed are left out
+        """
+        nw_infos = {}
+        for instance in instances:
+            try:
+                nw_infos[instance['uuid']] = self._get_instance_nw_info(
+                        context, instance)
+            except Exception:
+                # One broken instance must not keep the others from
+                # getting their network info
+                LOG.exception(_('Failed to get network info'),
+                              instance=instance)
+        update_instances_cache_with_nw_info(self, context, nw_infos)
+        return nw_infos
+
     def add_fixed_ip_to_instance(self, context, instance, network_id):
         """Add a fixed ip to the instance from specified network."""
         raise NotImplementedError()
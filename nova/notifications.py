@@ -19,6 +19,9 @@
 the system.
 """
 
+import eventlet
+from eventlet import queue
+
 import nova.context
 from nova import db
 from nova import exception
@@ -26,6 +29,7 @@ from nova import flags
 from nova import network
 from nova.network import model as network_model
 from nova.openstack.common import cfg
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log
 from nova.openstack.common.notifier import api as notifier_api
 from nova.openstack.common import timeutils
@@ -45,9 +49,119 @@ notify_any_opt = cfg.BoolOpt('notify_on_any_change', default=False,
          'state changes.  Valid values are False for no notifications, '
          'True for notifications on any instance changes.')
 
+notify_send_opts = [
+    cfg.BoolOpt('notification_send_async',
+                default=False,
+                help='Queue notifications for a background sender instead '
+                     'of sending them before returning to the caller'),
+    cfg.IntOpt('notification_queue_size',
+               default=1000,
+               help='Maximum number of notifications waiting for the '
+                    'background sender, further ones are dropped'),
+    ]
+
 FLAGS = flags.FLAGS
 FLAGS.register_opt(notify_state_opt)
 FLAGS.register_opt(notify_any_opt)
+FLAGS.register_opts(notify_send_opts)
+
+_NO_OP_DRIVER = 'nova.openstack.common.notifier.no_op_notifier'
+
+_stats = {'skipped': 0, 'sent': 0, 'dropped': 0}
+_queue = None
+_sender = None
+
+
+def enabled():
+    """Returns True if notifications are sent anywhere.
+
+    Callers can check this to avoid building a costly payload which would
+    only be thrown away.
+    """
+    return any(driver != _NO_OP_DRIVER
+               for driver in FLAGS.notification_driver)
+
+
+def notify(context, publisher_id, event_type, priority, payload):
+    """Sends a notification through the configured notifier.
+
+    Nothing is sent when enabled() is False. With notification_send_async
+    set, the notification is queued for a background sender rather than
+    sent before returning.
+    """
+    if priority not in notifier_api.log_levels:
+        raise notifier_api.BadPriorityException(
+            _('%s not in valid priorities') % priority)
+
+    if not enabled():
+        _stats['skipped'] += 1
+        return
+
+    if not FLAGS.notification_send_async:
+        notifier_api.notify(context, publisher_id, event_type, priority,
+                            payload)
+        _stats['sent'] += 1
+        return
+
+    # The payload may change after we return, so convert it now
+    payload = jsonutils.to_primitive(payload, convert_instances=True)
+    _queue_notification((context, publisher_id, event_type, priority,
+                         payload))
+
+
+def get_stats():
+    """Returns counters of the notifications handled by this process.
+
+    skipped: not sent because no driver would send them anywhere
+    sent: handed to the notifier
+    queued: waiting for the background sender
+    dropped: discarded because the background sender's queue was full
+    """
+    stats = dict(_stats)
+    stats['queued'] = _queue.qsize() if _queue is not None else 0
+    return stats
+
+
+def _queue_notification(notification):
+    """Hands a notification to the background sender, starting it if
+    needed.
+    """
+    global _queue, _sender
+    if _queue is None:
+        _queue = queue.LightQueue(FLAGS.notification_queue_size)
+    if _sender is None or _sender.dead:
+        _sender = eventlet.spawn(_send_queued_notifications)
+    try:
+        _queue.put_nowait(notification)
+    except queue.Full:
+        # Waiting for room would slow the caller down to the speed of the
+        # notification system, losing the notification is the lesser evil
+        _stats['dropped'] += 1
+        LOG.warn(_("Notification queue is full, dropping %s notification"),
+                 notification[2])
+
+
+def _send_queued_notifications():
+    while True:
+        notification = _queue.get()
+        try:
+            notifier_api.notify(*notification)
+        except Exception:
+            LOG.exception(_("Failed to send queued %s notification"),
+                          notification[2])
+        else:
+            _stats['sent'] += 1
+
+
+def _reset_sender():
+    """Used by unit tests to stop the background sender."""
+    global _queue, _sender
+    if _sender is not None:
+        _sender.kill()
+    _queue = None
+    _sender = None
+    for key in _stats:
+        _stats[key] = 0
 
 
 def send_update(context, old_instance, new_instance, service=None, host=None):
@@ -59,6 +173,10 @@ def send_update(context, old_instance, new_instance, service=None, host=None):
         # skip all this if updates are disabled
         return
 
+    if not enabled():
+        # or if they would not be sent anywhere
+        return
+
     update_with_state_change = False
 
     old_vm_state = old_instance["vm_state"]
@@ -104,6 +222,10 @@ def send_update_with_states(context, instance, old_vm_state, new_vm_state,
         # skip all this if updates are disabled
         return
 
+    if not enabled():
+        # or if they would not be sent anywhere
+        return
+
     fire_update = True
     # send update notification by default
 
@@ -166,7 +288,7 @@ def _send_instance_update_notification(context, instance, old_vm_state=None,
 
     publisher_id = notifier_api.publisher_id(service, host)
 
-    notifier_api.notify(context, publisher_id, 'compute.instance.update',
+    notify(context, publisher_id, 'compute.instance.update',
             notifier_api.INFO, payload)
 
 
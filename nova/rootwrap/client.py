@@ -0,0 +1,123 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 OpenStack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Client side of nova-rootwrap-daemon, see nova.rootwrap.daemon."""
+
+import json
+import socket
+
+from eventlet.green import subprocess
+from eventlet import semaphore
+
+from nova import exception
+from nova.rootwrap import daemon
+
+
+class Client(object):
+    """Runs commands through a nova-rootwrap-daemon it starts on demand."""
+
+    def __init__(self, config_file):
+        self.start_command = ['sudo', 'nova-rootwrap-daemon', config_file]
+        self._lock = semaphore.Semaphore()
+        self._process = None
+        self._socket_path = None
+        self._authkey = None
+
+    def _ensure_daemon(self):
+        """Starts the daemon unless it runs already.
+
+        Returns the socket path and authkey of the daemon.
+        """
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                return self._socket_path, self._authkey
+            self._process = None
+            process = subprocess.Popen(self.start_command,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       close_fds=True)
+            line = process.stdout.readline()
+            if not line:
+                process.wait()
+                raise EnvironmentError(
+                        _('nova-rootwrap-daemon exited with %d on startup')
+                        % process.returncode)
+            info = json.loads(line)
+            self._socket_path = info['socket']
+            self._authkey = info['authkey']
+            self._process = process
+            return self._socket_path, self._authkey
+
+    def _forget_daemon(self):
+        with self._lock:
+            if self._process is not None:
+                # Closing its stdin makes the daemon exit
+                self._process.stdin.close()
+                self._process = None
+
+    def _connect(self):
+        """Returns a socket connected to the daemon and its authkey.
+
+        A daemon which can't be connected to has not seen any command, so
+        it is replaced once.
+        """
+        socket_path, authkey = self._ensure_daemon()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            sock.close()
+            self._forget_daemon()
+            socket_path, authkey = self._ensure_daemon()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(socket_path)
+            except socket.error:
+                sock.close()
+                raise
+        return sock, authkey
+
+    def _run(self, args, stdin):
+        sock, authkey = self._connect()
+        try:
+            daemon.send_message(sock, {'authkey': authkey,
+                                       'args': args,
+                                       'stdin_len': len(stdin)},
+                                stdin)
+            reply = daemon.recv_message(sock)
+            stdout = daemon.recv_payload(sock, reply['stdout_len'])
+            stderr = daemon.recv_payload(sock, reply['stderr_len'])
+            return reply['returncode'], stdout, stderr
+        except (EOFError, socket.error), e:
+            # The command may have run already, so running it again could
+            # do its work twice
+            raise exception.ProcessExecutionError(
+                    stderr=str(e) or _('connection closed'),
+                    cmd=' '.join(args),
+                    description=_('Lost the connection to '
+                                  'nova-rootwrap-daemon'))
+        finally:
+            sock.close()
+
+    def execute(self, args, process_input=None):
+        """Runs args as root.
+
+        Returns a (returncode, stdout, stderr) tuple. Commands are never
+        sent twice: ProcessExecutionError is raised if the daemon does not
+        reply to one.
+        """
+        return self._run(args, process_input or '')
@@ -0,0 +1,199 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 OpenStack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Long-lived root wrapper serving commands over a local socket.
+
+nova-rootwrap-daemon loads the filters once and then runs the commands it
+is sent, so callers no longer pay for sudo, a new interpreter and parsing
+every filter file on each command.
+
+The daemon listens on a unix socket in a directory only the calling user
+can enter. A connection is only served if the peer runs as that user and
+presents the key the daemon printed on its stdout when it started. The
+daemon exits once its stdin is closed.
+
+Each message is a length prefixed JSON header, possibly followed by raw
+payloads whose lengths are given in the header.
+"""
+
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+from nova.rootwrap import wrapper
+
+
+RC_UNAUTHORIZED = 99
+RC_EXEC_FAILED = 96
+
+_LENGTH = struct.Struct('>I')
+# NOTE: Not exposed by the socket module on python 2, this is the Linux value
+_SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+_UCRED = struct.Struct('3i')
+
+
+def send_message(sock, header, *payloads):
+    data = json.dumps(header)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+    for payload in payloads:
+        sock.sendall(payload)
+
+
+def recv_payload(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def recv_message(sock):
+    (size,) = _LENGTH.unpack(recv_payload(sock, _LENGTH.size))
+    return json.loads(recv_payload(sock, size))
+
+
+def _constant_time_compare(first, second):
+    if len(first) != len(second):
+        return False
+    result = 0
+    for x, y in zip(first, second):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class RootwrapDaemon(object):
+    """Runs the commands allowed by filters for a single user."""
+
+    def __init__(self, filters, allowed_uid, authkey):
+        self.index = wrapper.FilterIndex(filters)
+        self.allowed_uid = allowed_uid
+        self.authkey = authkey
+
+    def serve(self, server):
+        """Handles connections on server until it is shut down, then waits
+        for the commands still running."""
+        threads = []
+        while True:
+            try:
+                conn, _addr = server.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+            threads = [t for t in threads if t.is_alive()] + [thread]
+
+        for thread in threads:
+            thread.join()
+
+    def _peer_uid(self, conn):
+        creds = conn.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _UCRED.size)
+        _pid, uid, _gid = _UCRED.unpack(creds)
+        return uid
+
+    def handle(self, conn):
+        try:
+            if self._peer_uid(conn) not in (self.allowed_uid, 0):
+                return
+            request = recv_message(conn)
+            if not _constant_time_compare(str(request.get('authkey', '')),
+                                          self.authkey):
+                return
+            stdin = recv_payload(conn, request['stdin_len'])
+            userargs = [arg.encode('utf-8') for arg in request['args']]
+
+            returncode, stdout, stderr = self.run(userargs, stdin)
+            send_message(conn, {'returncode': returncode,
+                                'stdout_len': len(stdout),
+                                'stderr_len': len(stderr)},
+                         stdout, stderr)
+        except (EOFError, KeyError, ValueError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def run(self, userargs, stdin):
+        """Runs userargs if a filter allows it.
+
+        Returns a (returncode, stdout, stderr) tuple.
+        """
+        filtermatch = self.index.match(userargs)
+        if not filtermatch:
+            return (RC_UNAUTHORIZED, '',
+                    "Unauthorized command: %s" % ' '.join(userargs))
+
+        command = filtermatch.get_command(userargs)
+        try:
+            obj = subprocess.Popen(command,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True,
+                                   env=filtermatch.get_environment(userargs))
+        except OSError, e:
+            return (RC_EXEC_FAILED, '',
+                    "Failed to execute %s: %s" % (command[0], e))
+        stdout, stderr = obj.communicate(stdin)
+        return obj.returncode, stdout, stderr
+
+
+def _shutdown_on_eof(stream, server):
+    while stream.read(4096):
+        pass
+    server.shutdown(socket.SHUT_RDWR)
+    server.close()
+
+
+def daemon_start(filters_path):
+    """Serves the user which started us through sudo until our stdin is
+    closed.
+    """
+    filters = wrapper.load_filters(filters_path)
+    allowed_uid = int(os.environ.get('SUDO_UID', os.getuid()))
+    authkey = os.urandom(32).encode('hex')
+
+    tmpdir = tempfile.mkdtemp(prefix='nova-rootwrap-')
+    try:
+        os.chown(tmpdir, allowed_uid, -1)
+        socket_path = os.path.join(tmpdir, 'rootwrap.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        os.chmod(socket_path, 0600)
+        os.chown(socket_path, allowed_uid, -1)
+        server.listen(128)
+
+        sys.stdout.write(json.dumps({'socket': socket_path,
+                                     'authkey': authkey}) + '\n')
+        sys.stdout.flush()
+
+        watcher = threading.Thread(target=_shutdown_on_eof,
+                                   args=(sys.stdin, server))
+        watcher.daemon = True
+        watcher.start()
+
+        RootwrapDaemon(filters, allowed_uid, authkey).serve(server)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -44,10 +44,21 @@ class CommandFilter(object):
         """Returns specific environment to set, None if none"""
         return None
 
+    def get_exec_name(self):
+        """Returns the only command (1st argument) this filter can match,
+        or None if it may match several."""
+        return os.path.basename(self.exec_path)
+
 
 class RegExpFilter(CommandFilter):
     """Command filter doing regexp matching for every argument"""
 
+    def get_exec_name(self):
+        # A pattern without any special character only matches itself
+        if self.args and not re.search(r'[][\\.^$*+?{}()|]', self.args[0]):
+            return self.args[0]
+        return None
+
     def match(self, userargs):
         # Early skip if command or number of args don't match
         if (len(self.args) != len(userargs)):
@@ -88,6 +99,9 @@ class DnsmasqFilter(CommandFilter):
         env['NETWORK_ID'] = userargs[1].split('=')[-1]
         return env
 
+    def get_exec_name(self):
+        return None
+
 
 class KillFilter(CommandFilter):
     """Specific filter for the kill calls.
@@ -70,3 +70,29 @@ def match_filter(filters, userargs):
 
     # No filter matched or first missing executable
     return found_filter
+
+
+class FilterIndex(object):
+    """Filters grouped by the command they can match.
+
+    Meant for long-lived root wrappers, which load their filters once:
+    matching a command then only goes through the filters for that command
+    (plus those which may match any command), in their original order.
+    """
+
+    def __init__(self, filters):
+        names = [f.get_exec_name() for f in filters]
+        self._any = [f for f, name in zip(filters, names) if name is None]
+        self._by_name = {}
+        for exec_name in set(names):
+            if exec_name is not None:
+                self._by_name[exec_name] = [
+                    f for f, name in zip(filters, names)
+                    if name in (exec_name, None)]
+
+    def match(self, userargs):
+        """Returns the filter match_filter() would pick, or None."""
+        if not userargs:
+            return None
+        candidates = self._by_name.get(userargs[0], self._any)
+        return match_filter(candidates, userargs)
@@ -438,9 +438,9 @@ class Service(object):
             else:
                 initial_delay = None
 
-            periodic = utils.LoopingCall(self.periodic_tasks)
-            periodic.start(interval=self.periodic_interval,
-                           initial_delay=initial_delay)
+            periodic = utils.DynamicLoopingCall(self.periodic_tasks)
+            periodic.start(initial_delay=initial_delay,
+                           periodic_interval_max=self.periodic_interval)
             self.timers.append(periodic)
 
     def _create_service_ref(self, context):
@@ -525,7 +525,8 @@ class Service(object):
     def periodic_tasks(self, raise_on_error=False):
         """Tasks to be run at a periodic interval."""
         ctxt = context.get_admin_context()
-        self.manager.periodic_tasks(ctxt, raise_on_error=raise_on_error)
+        return self.manager.periodic_tasks(ctxt,
+                                           raise_on_error=raise_on_error)
 
     def report_state(self):
         """Update the state of this service in the datastore."""
@@ -18,6 +18,7 @@ import webob
 
 from nova.api.openstack.compute.contrib import extended_server_attributes
 from nova import compute
+from nova import db
 from nova import exception
 from nova import flags
 from nova.openstack.common import jsonutils
@@ -90,6 +91,26 @@ class ExtendedServerAttributesTest(test.TestCase):
                                     host='host-%s' % (i + 1),
                                     instance_name='instance-%s' % (i + 1))
 
+    def test_detail_looks_up_each_host_once(self):
+        def fake_compute_get_all(*args, **kwargs):
+            return [fakes.stub_instance(i, uuid=UUID1[:-1] + str(i),
+                                        host="host-%s" % (i % 2))
+                    for i in xrange(1, 7)]
+
+        hosts = []
+
+        def fake_compute_node_get_by_host(context, host):
+            hosts.append(host)
+            return {'hypervisor_hostname': 'hyper-%s' % host}
+
+        self.stubs.Set(compute.api.API, 'get_all', fake_compute_get_all)
+        self.stubs.Set(db, 'compute_node_get_by_host',
+                       fake_compute_node_get_by_host)
+        res = self._make_request('/v2/fake/servers/detail')
+
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(sorted(hosts), ['host-0', 'host-1'])
+
     def test_no_instance_passthrough_404(self):
 
         def fake_compute_get(*args, **kwargs):
@@ -76,6 +76,16 @@ def fake_instance_get_active_by_window(self, context, begin, end, project_id):
                                          for x in xrange(TENANTS * SERVERS)]
 
 
+def fake_get_usage_by_window(self, context, begin, end, project_id):
+    return [{'project_id': "faketenant_%s" % x,
+             'instances': SERVERS,
+             'hours': SERVERS * HOURS,
+             'local_gb_hours': SERVERS * (ROOT_GB + EPHEMERAL_GB) * HOURS,
+             'memory_mb_hours': SERVERS * MEMORY_MB * HOURS,
+             'vcpus_hours': SERVERS * VCPUS * HOURS}
+            for x in xrange(TENANTS)]
+
+
 class SimpleTenantUsageTest(test.TestCase):
     def setUp(self):
         super(SimpleTenantUsageTest, self).setUp()
@@ -83,6 +93,8 @@ class SimpleTenantUsageTest(test.TestCase):
                        fake_instance_type_get)
         self.stubs.Set(api.API, "get_active_by_window",
                        fake_instance_get_active_by_window)
+        self.stubs.Set(api.API, "get_usage_by_window",
+                       fake_get_usage_by_window)
         self.admin_context = context.RequestContext('fakeadmin_0',
                                                     'faketenant_0',
                                                     is_admin=True)
@@ -143,6 +155,15 @@ class SimpleTenantUsageTest(test.TestCase):
         for i in xrange(TENANTS):
             self.assertEqual(usages[i].get('server_usages'), None)
 
+    def test_verify_simple_index_skips_instance_rows(self):
+        def fake_get_active_by_window(*args, **kwargs):
+            self.fail('simple index should not fetch instances')
+
+        self.stubs.Set(api.API, "get_active_by_window",
+                       fake_get_active_by_window)
+        usages = self._get_tenant_usages(detailed='0')
+        self.assertEqual(len(usages), TENANTS)
+
     def test_verify_simple_index_empty_param(self):
         # NOTE(lzyeval): 'detailed=&start=..&end=..'
         usages = self._get_tenant_usages()
@@ -23,6 +23,7 @@ import iso8601
 from lxml import etree
 import webob
 
+from nova.api.openstack import common
 import nova.api.openstack.compute
 from nova.api.openstack.compute import ips
 from nova.api.openstack.compute import servers
@@ -3313,6 +3314,24 @@ class ServersViewBuilderTest(test.TestCase):
         result = self.view_builder._get_flavor(self.request, self.instance)
         self.assertEqual(result, {})
 
+    def test_get_host_id_memoized_per_request(self):
+        self.instance['host'] = 'fake_host'
+        host_id = self.view_builder._get_host_id(self.request, self.instance)
+        self.assertEqual(host_id, self.view_builder._get_host_id(
+                self.request, self.instance))
+        self.assertEqual(len(self.request.environ['nova.host_ids']), 1)
+        self.assertEqual(self.view_builder._get_host_id(
+                self.request, {'host': None, 'project_id': 'fake'}), None)
+
+    def test_link_prefix_computed_once_per_request(self):
+        self.view_builder._get_links(self.request, self.uuid, 'servers')
+        self.mox.StubOutWithMock(common, 'remove_version_from_href')
+        self.mox.ReplayAll()
+        links = self.view_builder._get_links(self.request, 'other',
+                                             'servers')
+        self.assertEqual(links[1]['href'],
+                         'http://localhost/fake/servers/other')
+
     def test_build_server(self):
         self_link = "http://localhost/v2/fake/servers/%s" % self.uuid
         bookmark_link = "http://localhost/fake/servers/%s" % self.uuid
@@ -25,6 +25,7 @@ import functools
 import sys
 import time
 
+from eventlet import greenthread
 import mox
 
 import nova
@@ -35,6 +36,7 @@ from nova.compute import manager as compute_manager
 from nova.compute import power_state
 from nova.compute import rpcapi as compute_rpcapi
 from nova.compute import task_states
+from nova.compute import utils as compute_utils
 from nova.compute import vm_states
 from nova import context
 from nova import db
@@ -368,6 +370,42 @@ class ComputeTestCase(BaseTestCase):
         self._assert_state({'vm_state': vm_states.ERROR,
                             'task_state': None})
 
+    def test_run_instance_coalesces_build_states(self):
+        """The states before spawning are written with the spawning state"""
+        updates = []
+        orig_update = db.instance_update_and_get_original
+
+        def fake_update(context, instance_uuid, values):
+            updates.append(values)
+            return orig_update(context, instance_uuid, values)
+
+        self.stubs.Set(db, 'instance_update_and_get_original', fake_update)
+        instance_uuid = self._create_instance({'host': None})
+        self.compute.run_instance(self.context, instance_uuid=instance_uuid)
+
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(updates[0]['host'], self.compute.host)
+        self.assertEqual(updates[0]['task_state'], task_states.SPAWNING)
+        self.assertEqual(updates[1]['vm_state'], vm_states.ACTIVE)
+        self.assertEqual(self.compute._deferred_instance_updates, {})
+        self._assert_state({'vm_state': vm_states.ACTIVE,
+                            'task_state': None})
+
+    def test_run_instance_network_fail_writes_deferred_states(self):
+        def fake(*args, **kwargs):
+            raise test.TestingException()
+        self.stubs.Set(self.compute.network_api, 'allocate_for_instance',
+                       fake)
+        self.flags(stub_network=False)
+        instance_uuid = self._create_instance({'host': None})
+        self.assertRaises(test.TestingException, self.compute.run_instance,
+                          self.context, instance_uuid=instance_uuid)
+
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEqual(instance['host'], self.compute.host)
+        self.assertEqual(instance['vm_state'], vm_states.ERROR)
+        self.assertEqual(self.compute._deferred_instance_updates, {})
+
     def test_can_terminate_on_error_state(self):
         """Make sure that the instance can be terminated in ERROR state"""
         elevated = context.get_admin_context()
@@ -1898,6 +1936,92 @@ class ComputeTestCase(BaseTestCase):
         self.assertEqual(len(instances), 1)
         self.assertEqual(task_states.STOPPING, instances[0]['task_state'])
 
+    def test_lifecycle_event_updates_power_state(self):
+        instance = jsonutils.to_primitive(self._create_fake_instance())
+        self.compute.run_instance(self.context, instance=instance)
+        self.compute.driver.register_event_listener(
+            self.compute.handle_events)
+
+        self.mox.StubOutWithMock(self.compute.compute_api, 'stop')
+        self.compute.compute_api.stop(mox.IgnoreArg(), mox.IgnoreArg())
+        self.mox.ReplayAll()
+
+        self.compute.driver.test_set_power_state(instance,
+                                                 power_state.PAUSED)
+        self.compute.driver.test_set_power_state(instance,
+                                                 power_state.SHUTDOWN)
+        greenthread.sleep(0)
+
+        instance = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(instance['power_state'], power_state.SHUTDOWN)
+
+    def test_sync_power_states_uses_bulk_power_states(self):
+        instance = jsonutils.to_primitive(self._create_fake_instance())
+        self.compute.run_instance(self.context, instance=instance)
+
+        self.mox.StubOutWithMock(self.compute.driver, 'get_info')
+        self.mox.ReplayAll()
+
+        ctxt = context.get_admin_context()
+        self.compute._sync_power_states(ctxt)
+
+        instance = db.instance_get_by_uuid(ctxt, instance['uuid'])
+        self.assertEqual(instance['power_state'], power_state.RUNNING)
+
+    def test_refresh_instances_security_rules_defers_apply(self):
+        instances = [{'uuid': 'fake-uuid1'}, {'uuid': 'fake-uuid2'}]
+        self.mox.StubOutWithMock(self.compute.driver, 'filter_defer_apply_on')
+        self.mox.StubOutWithMock(self.compute.driver,
+                                 'refresh_instance_security_rules')
+        self.mox.StubOutWithMock(self.compute.driver,
+                                 'filter_defer_apply_off')
+        self.compute.driver.filter_defer_apply_on()
+        for instance in instances:
+            self.compute.driver.refresh_instance_security_rules(instance)
+        self.compute.driver.filter_defer_apply_off()
+        self.mox.ReplayAll()
+
+        self.compute.refresh_instances_security_rules(self.context,
+                                                      instances)
+
+    def test_refresh_instances_security_rules_survives_failure(self):
+        instances = [{'uuid': 'fake-uuid1'}, {'uuid': 'fake-uuid2'}]
+        self.mox.StubOutWithMock(self.compute.driver, 'filter_defer_apply_on')
+        self.mox.StubOutWithMock(self.compute.driver,
+                                 'refresh_instance_security_rules')
+        self.mox.StubOutWithMock(self.compute.driver,
+                                 'filter_defer_apply_off')
+        self.compute.driver.filter_defer_apply_on()
+        self.compute.driver.refresh_instance_security_rules(
+                instances[0]).AndRaise(
+                        exception.InstanceNotFound(instance_id='fake-uuid1'))
+        self.compute.driver.refresh_instance_security_rules(instances[1])
+        self.compute.driver.filter_defer_apply_off()
+        self.mox.ReplayAll()
+
+        self.compute.refresh_instances_security_rules(self.context,
+                                                      instances)
+
+    def test_poll_bandwidth_usage_writes_one_batch(self):
+        start_time = timeutils.utcnow()
+
+        def fake_get_all_bw_usage(instances, start_time, stop_time=None):
+            return [{'uuid': 'fake_uuid', 'mac_address': 'fake_mac%d' % i,
+                     'bw_in': i, 'bw_out': 2 * i} for i in xrange(3)]
+
+        self.stubs.Set(self.compute.driver, 'get_all_bw_usage',
+                       fake_get_all_bw_usage)
+        self.mox.StubOutWithMock(self.compute.db, 'bw_usage_update')
+        self.mox.StubOutWithMock(self.compute.db, 'bw_usage_update_many')
+        self.compute.db.bw_usage_update_many(mox.IgnoreArg(), start_time,
+                [{'uuid': 'fake_uuid', 'mac': 'fake_mac%d' % i,
+                  'bw_in': i, 'bw_out': 2 * i} for i in xrange(3)],
+                last_refreshed=mox.IgnoreArg())
+        self.mox.ReplayAll()
+
+        ctxt = context.get_admin_context()
+        self.compute._poll_bandwidth_usage(ctxt, start_time)
+
     def test_add_instance_fault(self):
         exc_info = None
         instance_uuid = str(utils.gen_uuid())
@@ -2030,80 +2154,57 @@ class ComputeTestCase(BaseTestCase):
         self.assertEqual(val, [instance1])
 
     def test_heal_instance_info_cache(self):
-        # Update on every call for the test
-        self.flags(heal_instance_info_cache_interval=-1)
+        self.flags(heal_instance_info_cache_batch_size=2)
         ctxt = context.get_admin_context()
 
-        instance_map = {}
-        instances = []
-        for x in xrange(5):
-            uuid = 'fake-uuid-%s' % x
-            instance_map[uuid] = {'uuid': uuid, 'host': FLAGS.host}
-            instances.append(instance_map[uuid])
+        def _cache(updated_at, created_at=datetime.datetime(2012, 1, 1)):
+            return {'updated_at': updated_at, 'created_at': created_at}
+
+        instances = [
+            {'uuid': 'fake-uuid-0',
+             'info_cache': _cache(datetime.datetime(2012, 5, 1))},
+            {'uuid': 'fake-uuid-1',
+             'info_cache': _cache(datetime.datetime(2012, 3, 1))},
+            {'uuid': 'fake-uuid-2', 'info_cache': None},
+            {'uuid': 'fake-uuid-3',
+             'info_cache': _cache(datetime.datetime(2012, 4, 1))},
+            {'uuid': 'fake-uuid-4',
+             'info_cache': _cache(None, datetime.datetime(2012, 2, 1))}]
 
-        call_info = {'get_all_by_host': 0, 'get_by_uuid': 0,
-                'get_nw_info': 0, 'expected_instance': None}
+        call_info = {'get_all_by_host': 0, 'batches': []}
 
         def fake_instance_get_all_by_host(context, host):
             call_info['get_all_by_host'] += 1
             return instances[:]
 
-        def fake_instance_get_by_uuid(context, instance_uuid):
-            if instance_uuid not in instance_map:
-                raise exception.InstanceNotFound
-            call_info['get_by_uuid'] += 1
-            return instance_map[instance_uuid]
-
         # NOTE(comstud): Override the stub in setUp()
-        def fake_get_instance_nw_info(context, instance):
-            # Note that this exception gets caught in compute/manager
-            # and is ignored.  However, the below increment of
-            # 'get_nw_info' won't happen, and you'll get an assert
-            # failure checking it below.
-            self.assertEqual(instance, call_info['expected_instance'])
-            call_info['get_nw_info'] += 1
+        def fake_get_instances_nw_info(context, batch):
+            call_info['batches'].append([inst['uuid'] for inst in batch])
+            return dict((inst['uuid'], []) for inst in batch)
 
         self.stubs.Set(db, 'instance_get_all_by_host',
                 fake_instance_get_all_by_host)
-        self.stubs.Set(db, 'instance_get_by_uuid',
-                fake_instance_get_by_uuid)
-        self.stubs.Set(self.compute.network_api, 'get_instance_nw_info',
-                fake_get_instance_nw_info)
+        self.stubs.Set(self.compute.network_api, 'get_instances_nw_info',
+                fake_get_instances_nw_info)
 
-        call_info['expected_instance'] = instances[0]
         self.compute._heal_instance_info_cache(ctxt)
         self.assertEqual(call_info['get_all_by_host'], 1)
-        self.assertEqual(call_info['get_by_uuid'], 0)
-        self.assertEqual(call_info['get_nw_info'], 1)
+        self.assertEqual(call_info['batches'],
+                         [['fake-uuid-2', 'fake-uuid-4']])
 
-        call_info['expected_instance'] = instances[1]
-        self.compute._heal_instance_info_cache(ctxt)
-        self.assertEqual(call_info['get_all_by_host'], 1)
-        self.assertEqual(call_info['get_by_uuid'], 1)
-        self.assertEqual(call_info['get_nw_info'], 2)
-
-        # Make an instance switch hosts
-        instances[2]['host'] = 'not-me'
-        # Make an instance disappear
-        instance_map.pop(instances[3]['uuid'])
-        # '2' and '3' should be skipped..
-        call_info['expected_instance'] = instances[4]
+        # Failures are ignored
+        def fake_get_instances_nw_info_fails(context, batch):
+            raise test.TestingException()
+
+        self.stubs.Set(self.compute.network_api, 'get_instances_nw_info',
+                fake_get_instances_nw_info_fails)
         self.compute._heal_instance_info_cache(ctxt)
-        self.assertEqual(call_info['get_all_by_host'], 1)
-        # Incremented for '2' and '4'.. '3' caused a raise above.
-        self.assertEqual(call_info['get_by_uuid'], 3)
-        self.assertEqual(call_info['get_nw_info'], 3)
-        # Should be no more left.
-        self.assertEqual(len(self.compute._instance_uuids_to_heal), 0)
-
-        # This should cause a DB query now so we get first instance
-        # back again
-        call_info['expected_instance'] = instances[0]
+        self.assertEqual(call_info['get_all_by_host'], 2)
+
+        # Disabled when the interval is 0
+        self.flags(heal_instance_info_cache_interval=0)
         self.compute._heal_instance_info_cache(ctxt)
         self.assertEqual(call_info['get_all_by_host'], 2)
-        # Stays the same, beacuse the instance came from the DB
-        self.assertEqual(call_info['get_by_uuid'], 3)
-        self.assertEqual(call_info['get_nw_info'], 4)
 
     def test_poll_unconfirmed_resizes(self):
         instances = [{'uuid': 'fake_uuid1', 'vm_state': vm_states.RESIZED,
@@ -2319,6 +2420,43 @@ class ComputeAPITestCase(BaseTestCase):
         self.assertEqual(instance['task_state'], None)
         return instance, instance_uuid
 
+    def test_get_usage_by_window_uses_rollups(self):
+        self.flags(instance_usage_audit_period='day')
+        ctxt = context.get_admin_context()
+        self._create_fake_instance(
+                {'launched_at': datetime.datetime(2012, 1, 1)})
+        self._create_fake_instance(
+                {'launched_at': datetime.datetime(2012, 1, 2, 6),
+                 'terminated_at': datetime.datetime(2012, 1, 3, 18)})
+        begin = datetime.datetime(2012, 1, 1, 12)
+        end = datetime.datetime(2012, 1, 4, 12)
+        expected = self.compute_api.get_usage_by_window(ctxt, begin, end)
+
+        for day in (2, 3):
+            compute_utils.start_instance_usage_audit(
+                    ctxt, datetime.datetime(2012, 1, day),
+                    datetime.datetime(2012, 1, day + 1), 'fake_host', 2)
+            compute_utils.rollup_instance_usage(
+                    ctxt, datetime.datetime(2012, 1, day),
+                    datetime.datetime(2012, 1, day + 1), 'fake_host')
+
+        windows = []
+        orig_usage_get = db.instance_usage_get_by_window
+
+        def fake_usage_get(context, begin, end, project_id=None):
+            windows.append((begin, end))
+            return orig_usage_get(context, begin, end, project_id)
+
+        self.stubs.Set(db, 'instance_usage_get_by_window', fake_usage_get)
+        usages = self.compute_api.get_usage_by_window(ctxt, begin, end)
+        self.assertEqual(windows,
+                         [(begin, datetime.datetime(2012, 1, 2)),
+                          (datetime.datetime(2012, 1, 4), end)])
+        self.assertEqual(len(usages), 1)
+        for key in ('hours', 'vcpus_hours', 'memory_mb_hours',
+                    'local_gb_hours'):
+            self.assertAlmostEqual(usages[0][key], expected[0][key], 3)
+
     def test_create_with_too_little_ram(self):
         """Test an instance type with too little memory"""
 
@@ -4027,76 +4165,63 @@ class ComputeAPITestCase(BaseTestCase):
                                      "/tmp/test", "File Contents")
         db.instance_destroy(self.context, instance['uuid'])
 
+    def _expect_secgroup_refresh(self, host, instances):
+        topic = rpc.queue_get_for(self.context, FLAGS.compute_topic, host)
+        rpc.cast(self.context, topic,
+                {"method": "refresh_instances_security_rules",
+                 "args": {'instances': jsonutils.to_primitive(instances)},
+                 "version": '1.44'})
+
     def test_secgroup_refresh(self):
         instance = self._create_fake_instance()
 
-        def rule_get(*args, **kwargs):
-            mock_rule = FakeModel({'parent_group_id': 1})
-            return [mock_rule]
-
-        def group_get(*args, **kwargs):
-            mock_group = FakeModel({'instances': [instance]})
-            return mock_group
+        def instances_get(context, group_ids):
+            self.assertEqual(group_ids, [1])
+            return [instance]
 
-        self.stubs.Set(
-                   self.compute_api.db,
-                   'security_group_rule_get_by_security_group_grantee',
-                   rule_get)
-        self.stubs.Set(self.compute_api.db, 'security_group_get', group_get)
+        self.stubs.Set(self.compute_api.db,
+                       'security_group_grantee_instances_get_for_refresh',
+                       instances_get)
 
         self.mox.StubOutWithMock(rpc, 'cast')
-        topic = rpc.queue_get_for(self.context, FLAGS.compute_topic,
-                                  instance['host'])
-        rpc.cast(self.context, topic,
-                {"method": "refresh_instance_security_rules",
-                 "args": {'instance': jsonutils.to_primitive(instance)},
-                 "version": '1.41'})
+        self._expect_secgroup_refresh(instance['host'], [instance])
         self.mox.ReplayAll()
 
         self.security_group_api.trigger_members_refresh(self.context, [1])
 
-    def test_secgroup_refresh_once(self):
-        instance = self._create_fake_instance()
+    def test_secgroup_refresh_groups_by_host(self):
+        instance1 = self._create_fake_instance({'host': 'host1'})
+        instance2 = self._create_fake_instance({'host': 'host1'})
+        instance3 = self._create_fake_instance({'host': 'host2'})
+        instance4 = self._create_fake_instance({'host': None})
 
-        def rule_get(*args, **kwargs):
-            mock_rule = FakeModel({'parent_group_id': 1})
-            return [mock_rule]
+        def instances_get(context, group_ids):
+            return [instance1, instance2, instance3, instance4]
 
-        def group_get(*args, **kwargs):
-            mock_group = FakeModel({'instances': [instance]})
-            return mock_group
+        self.stubs.Set(self.compute_api.db,
+                       'security_group_grantee_instances_get_for_refresh',
+                       instances_get)
 
-        self.stubs.Set(
-                   self.compute_api.db,
-                   'security_group_rule_get_by_security_group_grantee',
-                   rule_get)
-        self.stubs.Set(self.compute_api.db, 'security_group_get', group_get)
+        casts = []
 
-        self.mox.StubOutWithMock(rpc, 'cast')
-        topic = rpc.queue_get_for(self.context, FLAGS.compute_topic,
-                                  instance['host'])
-        rpc.cast(self.context, topic,
-                {"method": "refresh_instance_security_rules",
-                 "args": {'instance': jsonutils.to_primitive(instance)},
-                 "version": '1.41'})
-        self.mox.ReplayAll()
+        def fake_refresh(ctxt, host, instances):
+            casts.append((host, [i['uuid'] for i in instances]))
 
+        self.stubs.Set(self.security_group_api.security_group_rpcapi,
+                       'refresh_instances_security_rules', fake_refresh)
         self.security_group_api.trigger_members_refresh(self.context, [1, 2])
 
-    def test_secgroup_refresh_none(self):
-        def rule_get(*args, **kwargs):
-            mock_rule = FakeModel({'parent_group_id': 1})
-            return [mock_rule]
+        self.assertEqual(sorted(casts),
+                [('host1', [instance1['uuid'], instance2['uuid']]),
+                 ('host2', [instance3['uuid']])])
 
-        def group_get(*args, **kwargs):
-            mock_group = FakeModel({'instances': []})
-            return mock_group
+    def test_secgroup_refresh_none(self):
+        def instances_get(context, group_ids):
+            return []
 
-        self.stubs.Set(
-                   self.compute_api.db,
-                   'security_group_rule_get_by_security_group_grantee',
-                   rule_get)
-        self.stubs.Set(self.compute_api.db, 'security_group_get', group_get)
+        self.stubs.Set(self.compute_api.db,
+                       'security_group_grantee_instances_get_for_refresh',
+                       instances_get)
 
         self.mox.StubOutWithMock(rpc, 'cast')
         self.mox.ReplayAll()
@@ -4106,54 +4231,32 @@ class ComputeAPITestCase(BaseTestCase):
     def test_secrule_refresh(self):
         instance = self._create_fake_instance()
 
-        def group_get(*args, **kwargs):
-            mock_group = FakeModel({'instances': [instance]})
-            return mock_group
+        def instances_get(context, group_ids):
+            self.assertEqual(group_ids, [1])
+            return [instance]
 
-        self.stubs.Set(self.compute_api.db, 'security_group_get', group_get)
+        self.stubs.Set(self.compute_api.db,
+                       'security_group_instances_get_for_refresh',
+                       instances_get)
 
         self.mox.StubOutWithMock(rpc, 'cast')
-        topic = rpc.queue_get_for(self.context, FLAGS.compute_topic,
-                                  instance['host'])
-        rpc.cast(self.context, topic,
-                {"method": "refresh_instance_security_rules",
-                 "args": {'instance': jsonutils.to_primitive(instance)},
-                 "version": '1.41'})
+        self._expect_secgroup_refresh(instance['host'], [instance])
         self.mox.ReplayAll()
 
-        self.security_group_api.trigger_rules_refresh(self.context, [1])
-
-    def test_secrule_refresh_once(self):
-        instance = self._create_fake_instance()
-
-        def group_get(*args, **kwargs):
-            mock_group = FakeModel({'instances': [instance]})
-            return mock_group
-
-        self.stubs.Set(self.compute_api.db, 'security_group_get', group_get)
-
-        self.mox.StubOutWithMock(rpc, 'cast')
-        topic = rpc.queue_get_for(self.context, FLAGS.compute_topic,
-                                  instance['host'])
-        rpc.cast(self.context, topic,
-                {"method": "refresh_instance_security_rules",
-                 "args": {'instance': jsonutils.to_primitive(instance)},
-                 "version": '1.41'})
-        self.mox.ReplayAll()
-
-        self.security_group_api.trigger_rules_refresh(self.context, [1, 2])
+        self.security_group_api.trigger_rules_refresh(self.context, 1)
 
     def test_secrule_refresh_none(self):
-        def group_get(*args, **kwargs):
-            mock_group = FakeModel({'instances': []})
-            return mock_group
+        def instances_get(context, group_ids):
+            return []
 
-        self.stubs.Set(self.compute_api.db, 'security_group_get', group_get)
+        self.stubs.Set(self.compute_api.db,
+                       'security_group_instances_get_for_refresh',
+                       instances_get)
 
         self.mox.StubOutWithMock(rpc, 'cast')
         self.mox.ReplayAll()
 
-        self.security_group_api.trigger_rules_refresh(self.context, [1, 2])
+        self.security_group_api.trigger_rules_refresh(self.context, 1)
 
 
 def fake_rpc_method(context, topic, msg, do_cast=True):
@@ -4805,6 +4908,7 @@ class ComputeReschedulingExceptionTestCase(BaseTestCase):
                 self.compute._run_instance, self.context,
                 filter_properties=filter_properties, request_spec=request_spec,
                 instance=self.fake_instance)
+        self.assertEqual(self.compute._deferred_instance_updates, {})
 
     def test_exception_context_cleared(self):
         """Test with no rescheduling and an additional exception occurs
@@ -17,12 +17,16 @@
 
 """Tests For miscellaneous util methods used with compute."""
 
+import datetime
+
 from nova.compute import instance_types
 from nova.compute import utils as compute_utils
 from nova import context
 from nova import db
 from nova import flags
+from nova.network import model as network_model
 from nova.openstack.common import importutils
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common.notifier import api as notifier_api
 from nova.openstack.common.notifier import test_notifier
@@ -217,3 +221,113 @@ class UsageInfoTestCase(test.TestCase):
         self.assertEquals(payload['image_ref_url'], image_ref_url)
         self.compute.terminate_instance(self.context,
                 instance_uuid=instance['uuid'])
+
+
+class UsageRollupTestCase(test.TestCase):
+
+    def setUp(self):
+        super(UsageRollupTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.begin = datetime.datetime(2012, 1, 1)
+        self.end = datetime.datetime(2012, 2, 1)
+
+    def test_rollup_instance_usage(self):
+        self.assertFalse(compute_utils.has_usage_been_rolled_up(
+                self.context, self.begin, self.end))
+        compute_utils.rollup_instance_usage(self.context, self.begin,
+                                            self.end, 'host1')
+        self.assertTrue(compute_utils.has_usage_been_rolled_up(
+                self.context, self.begin, self.end))
+        self.assertFalse(compute_utils.has_usage_been_rolled_up(
+                self.context, self.end, datetime.datetime(2012, 3, 1)))
+
+    def test_rollup_counts_instance_moved_between_audits(self):
+        instance_type = instance_types.get_instance_type_by_name('m1.tiny')
+        instance = db.instance_create(self.context,
+                {'host': 'host1', 'project_id': 'fake',
+                 'instance_type_id': instance_type['id'],
+                 'launched_at': self.begin})
+        compute_utils.rollup_instance_usage(self.context, self.begin,
+                                            self.end, 'host1')
+        # The instance moves before host2 audits the period
+        db.instance_update(self.context, instance['uuid'],
+                           {'host': 'host2'})
+        compute_utils.rollup_instance_usage(self.context, self.begin,
+                                            self.end, 'host2')
+
+        usages = db.instance_usage_rollup_get_by_window(
+                self.context, self.begin, self.end)
+        self.assertEqual(len(usages), 1)
+        self.assertAlmostEqual(usages[0]['hours'], 31 * 24, 3)
+
+    def test_rollup_instance_usage_fails(self):
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_create')
+        db.instance_usage_rollup_create(self.context, self.begin, self.end,
+                                        'host1').AndRaise(
+                                            test.TestingException())
+        self.mox.ReplayAll()
+        self.assertRaises(test.TestingException,
+                          compute_utils.rollup_instance_usage,
+                          self.context, self.begin, self.end, 'host1')
+
+        task_log = db.task_log_get(self.context, "instance_usage_rollup",
+                                   str(self.begin), str(self.end), 'host1')
+        self.assertEqual(task_log['state'], 'DONE')
+        self.assertEqual(task_log['errors'], 1)
+        self.assertFalse(compute_utils.has_usage_been_rolled_up(
+                self.context, self.begin, self.end))
+
+    def test_rollup_instance_usage_only_once(self):
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_create')
+        db.instance_usage_rollup_create(self.context, self.begin, self.end,
+                                        'host1').AndReturn(0)
+        self.mox.ReplayAll()
+        for host in ('host1', 'host1', 'host2'):
+            compute_utils.rollup_instance_usage(self.context, self.begin,
+                                                self.end, host)
+
+
+class NetworkInfoCacheTestCase(test.TestCase):
+
+    def setUp(self):
+        super(NetworkInfoCacheTestCase, self).setUp()
+        self.stubs.Set(compute_utils, '_NW_INFO_CACHE', None)
+        nw_info = fake_network.fake_get_instance_nw_info(self.stubs, 1, 1,
+                                                         spectacular=True)
+        self.json = jsonutils.dumps(nw_info)
+        self.hydrate_calls = 0
+        orig_hydrate = network_model.NetworkInfo.hydrate
+
+        def fake_hydrate(cls, network_info):
+            self.hydrate_calls += 1
+            return orig_hydrate(network_info)
+
+        self.stubs.Set(network_model.NetworkInfo, 'hydrate',
+                       classmethod(fake_hydrate))
+
+    def test_hydrated_once_while_unchanged(self):
+        instance = {'info_cache': {'network_info': self.json}}
+        first = compute_utils.get_nw_info_for_instance(instance)
+        second = compute_utils.get_nw_info_for_instance(instance)
+        self.assertTrue(first is second)
+        self.assertEqual(self.hydrate_calls, 1)
+        self.assertEqual(first.fixed_ips(), second.fixed_ips())
+
+    def test_changed_cache_is_rehydrated(self):
+        instance = {'info_cache': {'network_info': self.json}}
+        compute_utils.get_nw_info_for_instance(instance)
+        instance = {'info_cache': {'network_info': '[]'}}
+        nw_info = compute_utils.get_nw_info_for_instance(instance)
+        self.assertEqual(nw_info, [])
+        self.assertEqual(self.hydrate_calls, 2)
+
+    def test_cache_disabled(self):
+        self.flags(network_info_cache_size=0)
+        instance = {'info_cache': {'network_info': self.json}}
+        compute_utils.get_nw_info_for_instance(instance)
+        compute_utils.get_nw_info_for_instance(instance)
+        self.assertEqual(self.hydrate_calls, 2)
+
+    def test_missing_info_cache(self):
+        nw_info = compute_utils.get_nw_info_for_instance({'info_cache': None})
+        self.assertEqual(nw_info, [])
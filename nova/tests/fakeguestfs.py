@@ -0,0 +1,90 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Stand in for the libguestfs python bindings, keeping files in memory."""
+
+
+class GuestFS(object):
+
+    def __init__(self):
+        self.drives = []
+        self.running = False
+        self.closed = False
+        self.mounts = []
+        self.files = {}
+
+    def add_drive_opts(self, file, *args, **kwargs):
+        self.drives.append((file, kwargs.get('format')))
+
+    def launch(self):
+        self.running = True
+
+    def inspect_os(self):
+        return ['/dev/guestvgf/lv_root']
+
+    def inspect_get_mountpoints(self, dev):
+        return [['/boot', '/dev/vda1'], ['/', '/dev/guestvgf/lv_root']]
+
+    def mount_options(self, options, device, mntpoint):
+        if device == '/dev/missing':
+            raise RuntimeError('mount: %s: No such device' % device)
+        self.mounts.append((mntpoint, device))
+        if mntpoint == '/':
+            self.files['/etc/passwd'] = {
+                'content': 'root:x:0:0:root:/root:/bin/bash\n',
+                'mode': 0644, 'uid': 0, 'gid': 0}
+            self.files['/etc/shadow'] = {
+                'content': 'root:$1$oldpass:15000:0:99999:7:::\n',
+                'mode': 0600, 'uid': 0, 'gid': 0}
+
+    def umount_all(self):
+        self.mounts = []
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def mkdir_p(self, path):
+        if path not in self.files:
+            self.files[path] = {'isdir': True, 'mode': 0700,
+                                'uid': 100, 'gid': 100}
+
+    def exists(self, path):
+        return path in self.files
+
+    def read_file(self, path):
+        return self.files[path]['content']
+
+    def write(self, path, content):
+        self.files.setdefault(path, {'mode': 0644, 'uid': 100, 'gid': 100})
+        self.files[path]['content'] = content
+
+    def write_append(self, path, content):
+        self.files.setdefault(path, {'mode': 0644, 'uid': 100, 'gid': 100,
+                                     'content': ''})
+        self.files[path]['content'] += content
+
+    def stat(self, path):
+        return {'mode': 0100000 | self.files[path]['mode']}
+
+    def chmod(self, mode, path):
+        self.files[path]['mode'] = mode
+
+    def chown(self, uid, gid, path):
+        self.files[path]['uid'] = uid
+        self.files[path]['gid'] = gid
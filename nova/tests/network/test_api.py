@@ -79,3 +79,33 @@ class ApiTestCase(test.TestCase):
 
     def test_associate_unassociated_floating_ip(self):
         self._do_test_associate_floating_ip(None)
+
+    def test_get_instances_nw_info(self):
+        instances = [{'id': 1, 'uuid': 'uuid-1', 'host': 'host1',
+                      'project_id': 'fake-project',
+                      'instance_type': {'rxtx_factor': 1.0}},
+                     {'id': 2, 'uuid': 'uuid-2', 'host': 'host1',
+                      'project_id': 'fake-project',
+                      'instance_type': {'rxtx_factor': 1.0}}]
+        calls = []
+
+        def fake_rpc_call(context, topic, msg):
+            calls.append(msg)
+            return dict((instance['instance_uuid'], [])
+                        for instance in msg['args']['instances'])
+
+        def fake_instance_info_cache_update_many(context, values_by_uuid):
+            calls.append(values_by_uuid)
+
+        self.stubs.Set(rpc, 'call', fake_rpc_call)
+        self.stubs.Set(self.network_api.db, 'instance_info_cache_update_many',
+                       fake_instance_info_cache_update_many)
+
+        nw_infos = self.network_api.get_instances_nw_info(self.context,
+                                                          instances)
+
+        self.assertEqual(sorted(nw_infos.keys()), ['uuid-1', 'uuid-2'])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0]['method'], 'get_instances_nw_info')
+        self.assertEqual(calls[1], {'uuid-1': {'network_info': '[]'},
+                                    'uuid-2': {'network_info': '[]'}})
@@ -144,6 +144,64 @@ class FlatNetworkTestCase(test.TestCase):
         shutil.rmtree(self.tempdir)
         super(FlatNetworkTestCase, self).tearDown()
 
+    def test_get_instances_nw_info(self):
+        vifs = {'uuid-1': [{'uuid': 'vif-1', 'network_id': 1},
+                           {'uuid': 'vif-2', 'network_id': None}],
+                'uuid-2': [{'uuid': 'vif-3', 'network_id': 1}]}
+        fetched = []
+
+        def fake_vifs_get(context, instance_uuid):
+            return vifs[instance_uuid]
+
+        def fake_network_get(context, network_id):
+            fetched.append(network_id)
+            return {'id': network_id}
+
+        def fake_build_model(context, vifs, networks, rxtx_factor, host):
+            return (sorted(networks.keys()), rxtx_factor, host)
+
+        self.stubs.Set(db, 'virtual_interface_get_by_instance', fake_vifs_get)
+        self.stubs.Set(self.network, '_get_network_by_id', fake_network_get)
+        self.stubs.Set(self.network, 'build_network_info_model',
+                       fake_build_model)
+
+        instances = [{'instance_id': 1, 'instance_uuid': 'uuid-1',
+                      'rxtx_factor': 1.0, 'host': 'host1',
+                      'project_id': 'fake'},
+                     {'instance_id': 2, 'instance_uuid': 'uuid-2',
+                      'rxtx_factor': 2.0, 'host': 'host2',
+                      'project_id': 'fake'}]
+        nw_infos = self.network.get_instances_nw_info(self.context,
+                                                      instances)
+
+        self.assertEqual(nw_infos, {'uuid-1': (['vif-1'], 1.0, 'host1'),
+                                    'uuid-2': (['vif-3'], 2.0, 'host2')})
+        self.assertEqual(fetched, [1])
+
+    def test_get_instances_nw_info_skips_failing_instance(self):
+        def fake_vifs_get(context, instance_uuid):
+            if instance_uuid == 'uuid-1':
+                raise exception.NetworkNotFound(network_id=1)
+            return [{'uuid': 'vif-3', 'network_id': None}]
+
+        def fake_build_model(context, vifs, networks, rxtx_factor, host):
+            return [vif['uuid'] for vif in vifs]
+
+        self.stubs.Set(db, 'virtual_interface_get_by_instance', fake_vifs_get)
+        self.stubs.Set(self.network, 'build_network_info_model',
+                       fake_build_model)
+
+        instances = [{'instance_id': 1, 'instance_uuid': 'uuid-1',
+                      'rxtx_factor': 1.0, 'host': 'host1',
+                      'project_id': 'fake'},
+                     {'instance_id': 2, 'instance_uuid': 'uuid-2',
+                      'rxtx_factor': 1.0, 'host': 'host1',
+                      'project_id': 'fake'}]
+        nw_infos = self.network.get_instances_nw_info(self.context,
+                                                      instances)
+
+        self.assertEqual(nw_infos, {'uuid-2': ['vif-3']})
+
     def test_get_instance_nw_info(self):
         fake_get_instance_nw_info = fake_network.fake_get_instance_nw_info
 
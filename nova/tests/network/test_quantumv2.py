@@ -252,6 +252,35 @@ class TestQuantumv2(test.TestCase):
                                           networks=self.nets1)
         self._verify_nw_info(nw_inf, 0)
 
+    def test_get_instances_nw_info_skips_failing_instance(self):
+        api = quantumapi.API()
+        broken = {'project_id': self.instance['project_id'],
+                  'uuid': str(utils.gen_uuid()),
+                  'display_name': 'broken_instance'}
+        self.mox.StubOutWithMock(api.db, 'instance_info_cache_update_many')
+        self.moxed_client.list_ports(
+            tenant_id=broken['project_id'],
+            device_id=broken['uuid']).AndRaise(
+                Exception('quantum port error'))
+        self.moxed_client.list_ports(
+            tenant_id=self.instance['project_id'],
+            device_id=self.instance['uuid']).AndReturn(
+                {'ports': self.port_data1})
+        self.moxed_client.list_networks(
+            tenant_id=self.instance['project_id']).AndReturn(
+                {'networks': self.nets1})
+        self.moxed_client.list_subnets(
+            id=mox.SameElementsAs(['my_subid1'])).AndReturn(
+                {'subnets': self.subnet_data1})
+        api.db.instance_info_cache_update_many(mox.IgnoreArg(),
+            mox.Func(lambda caches: caches.keys() == [self.instance['uuid']]))
+        self.mox.ReplayAll()
+
+        nw_infos = api.get_instances_nw_info(self.context,
+                                             [broken, self.instance])
+        self.assertEqual(nw_infos.keys(), [self.instance['uuid']])
+        self._verify_nw_info(nw_infos[self.instance['uuid']], 0)
+
     def _allocate_for_instance(self, net_idx=1, **kwargs):
         api = quantumapi.API()
         self.mox.StubOutWithMock(api, 'get_instance_nw_info')
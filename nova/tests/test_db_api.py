@@ -21,6 +21,8 @@
 
 import datetime
 
+from nova.compute import task_states
+from nova.compute import vm_states
 from nova import context
 from nova import db
 from nova import exception
@@ -66,6 +68,32 @@ class DbApiTestCase(test.TestCase):
         result = db.instance_get_all_by_filters(self.context, {})
         self.assertEqual(2, len(result))
 
+    def test_instance_get_all_for_image_cache(self):
+        ctxt = context.get_admin_context()
+        inst1 = self.create_instances_with_args()
+        self.create_instances_with_args(host='host2', image_ref=2)
+        inst3 = self.create_instances_with_args(host='host2')
+        db.instance_destroy(ctxt, inst3['uuid'])
+
+        result = db.instance_get_all_for_image_cache(ctxt, host='host1')
+        self.assertEqual(1, len(result))
+        self.assertEqual(inst1['name'], result[0]['name'])
+        self.assertEqual('host1', result[0]['host'])
+        self.assertEqual('1', result[0]['image_ref'])
+
+        result = db.instance_get_all_for_image_cache(ctxt)
+        self.assertEqual(2, len(result))
+
+        self.assertEqual({'1': 1, '2': 1}, db.instance_count_by_image(ctxt))
+
+        # Instances resized away from host1 still use its images
+        self.create_instances_with_args(host='host2',
+                                        vm_state=vm_states.RESIZED)
+        self.create_instances_with_args(
+                host='host2', task_state=task_states.RESIZE_MIGRATED)
+        result = db.instance_get_all_for_image_cache(ctxt, host='host1')
+        self.assertEqual(3, len(result))
+
     def test_instance_get_all_by_filters_regex(self):
         self.create_instances_with_args(display_name='test1')
         self.create_instances_with_args(display_name='teeeest2')
@@ -113,6 +141,82 @@ class DbApiTestCase(test.TestCase):
         else:
             self.assertTrue(result[1].deleted)
 
+    def test_instance_usage_get_by_window(self):
+        ctxt = context.get_admin_context()
+        flavor = db.instance_type_get_by_name(ctxt, 'm1.small')
+        begin = datetime.datetime(2012, 1, 1)
+        end = datetime.datetime(2012, 1, 2)
+        hour = datetime.timedelta(hours=1)
+        # Clipped to the window on both sides: 24 hours.
+        self.create_instances_with_args(instance_type_id=flavor['id'],
+                                        launched_at=begin - hour)
+        # Launched and terminated within the window: 2 hours.
+        self.create_instances_with_args(instance_type_id=flavor['id'],
+                                        launched_at=begin + hour,
+                                        terminated_at=begin + 3 * hour)
+        # Outside the window.
+        self.create_instances_with_args(instance_type_id=flavor['id'],
+                                        launched_at=begin - 3 * hour,
+                                        terminated_at=begin - hour)
+        self.create_instances_with_args(instance_type_id=flavor['id'],
+                                        launched_at=end + hour)
+        # Another project: 12 hours.
+        self.create_instances_with_args(instance_type_id=flavor['id'],
+                                        project_id='other',
+                                        launched_at=end - 12 * hour)
+
+        usages = db.instance_usage_get_by_window(ctxt, begin, end)
+        self.assertEqual(['fake', 'other'],
+                         [usage['project_id'] for usage in usages])
+        usage = usages[0]
+        self.assertAlmostEqual(usage['hours'], 26, 3)
+        self.assertAlmostEqual(usage['vcpus_hours'],
+                               26 * flavor['vcpus'], 3)
+        self.assertAlmostEqual(usage['memory_mb_hours'],
+                               26 * flavor['memory_mb'], 3)
+        self.assertAlmostEqual(usage['local_gb_hours'],
+                               26 * (flavor['root_gb'] +
+                                     flavor['ephemeral_gb']), 3)
+
+        usages = db.instance_usage_get_by_window(ctxt, begin, end,
+                                                 project_id='other')
+        self.assertEqual(len(usages), 1)
+        self.assertAlmostEqual(usages[0]['hours'], 12, 3)
+
+    def test_instance_usage_rollup(self):
+        ctxt = context.get_admin_context()
+        small = db.instance_type_get_by_name(ctxt, 'm1.small')
+        tiny = db.instance_type_get_by_name(ctxt, 'm1.tiny')
+        begin = datetime.datetime(2012, 1, 1)
+        end = datetime.datetime(2012, 1, 2)
+        later = datetime.datetime(2012, 1, 3)
+        self.create_instances_with_args(instance_type_id=small['id'],
+                                        launched_at=begin)
+        self.create_instances_with_args(instance_type_id=tiny['id'],
+                                        launched_at=begin)
+        self.create_instances_with_args(instance_type_id=tiny['id'],
+                                        launched_at=begin, host='host2')
+
+        # Instances on every host are rolled up, grouped by flavor.
+        self.assertEqual(db.instance_usage_rollup_create(ctxt, begin, end,
+                                                         'host1'), 2)
+        # Rolling up again, from any host, replaces the rows instead of
+        # adding to them.
+        self.assertEqual(db.instance_usage_rollup_create(ctxt, begin, end,
+                                                         'host2'), 2)
+        db.instance_usage_rollup_create(ctxt, end, later, 'host1')
+
+        usages = db.instance_usage_rollup_get_by_window(ctxt, begin, end)
+        self.assertEqual(len(usages), 1)
+        self.assertAlmostEqual(usages[0]['hours'], 72, 3)
+        self.assertAlmostEqual(usages[0]['vcpus_hours'],
+                               24 * (small['vcpus'] + 2 * tiny['vcpus']), 3)
+
+        usages = db.instance_usage_rollup_get_by_window(ctxt, begin, later)
+        self.assertAlmostEqual(usages[0]['hours'], 144, 3)
+        self.assertEqual(db.instance_usage_rollup_get_by_window(
+                ctxt, begin, later, project_id='other'), [])
+
     def test_migration_get_unconfirmed_by_dest_compute(self):
         ctxt = context.get_admin_context()
 
@@ -518,6 +622,104 @@ class DbApiTestCase(test.TestCase):
         _compare(bw_usages[2], expected_bw_usages[2])
         timeutils.clear_time_override()
 
+    def test_security_group_instances_get_for_refresh(self):
+        ctxt = context.get_admin_context()
+        group1 = db.security_group_create(ctxt, {'name': 'group1'})
+        group2 = db.security_group_create(ctxt, {'name': 'group2'})
+        grantee = db.security_group_create(ctxt, {'name': 'grantee'})
+        db.security_group_rule_create(ctxt, {'parent_group_id': group1['id'],
+                                             'group_id': grantee['id']})
+
+        instance1 = db.instance_create(ctxt, {'host': 'host1'})
+        instance2 = db.instance_create(ctxt, {'host': 'host2'})
+        unscheduled = db.instance_create(ctxt, {})
+        for instance in (instance1, instance2, unscheduled):
+            db.instance_add_security_group(ctxt, instance['uuid'],
+                                           group1['id'])
+        db.instance_add_security_group(ctxt, instance1['uuid'], group2['id'])
+
+        def _uuids(instances):
+            return sorted(instance['uuid'] for instance in instances)
+
+        expected = sorted([instance1['uuid'], instance2['uuid']])
+        self.assertEqual(_uuids(db.security_group_instances_get_for_refresh(
+                ctxt, [group1['id'], group2['id']])), expected)
+        self.assertEqual(_uuids(
+                db.security_group_grantee_instances_get_for_refresh(
+                        ctxt, [grantee['id']])), expected)
+        self.assertEqual(
+                db.security_group_grantee_instances_get_for_refresh(
+                        ctxt, [group2['id']]), [])
+
+    def test_instance_info_cache_update_many(self):
+        ctxt = context.get_admin_context()
+        instance1 = db.instance_create(ctxt, {})
+        instance2 = db.instance_create(ctxt, {})
+        instance3 = db.instance_create(ctxt, {})
+        db.instance_info_cache_delete(ctxt, instance3['uuid'])
+
+        db.instance_info_cache_update_many(ctxt,
+                {instance1['uuid']: {'network_info': '[1]'},
+                 instance2['uuid']: {'network_info': '[2]'},
+                 instance3['uuid']: {'network_info': '[3]'}})
+
+        cache = db.instance_info_cache_get(ctxt, instance1['uuid'])
+        self.assertEqual(cache['network_info'], '[1]')
+        cache = db.instance_info_cache_get(ctxt, instance2['uuid'])
+        self.assertEqual(cache['network_info'], '[2]')
+        cache = db.instance_info_cache_get(ctxt, instance3['uuid'])
+        self.assertTrue(cache['deleted'])
+        self.assertNotEqual(cache['network_info'], '[3]')
+
+    def test_instance_info_cache_update_many_unchanged(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        db.instance_info_cache_update_many(ctxt,
+                {instance['uuid']: {'network_info': '[1]'}})
+        first = db.instance_info_cache_get(ctxt, instance['uuid'])
+
+        later = timeutils.utcnow() + datetime.timedelta(seconds=60)
+        timeutils.set_time_override(later)
+        self.addCleanup(timeutils.clear_time_override)
+        db.instance_info_cache_update_many(ctxt,
+                {instance['uuid']: {'network_info': '[1]'}})
+
+        cache = db.instance_info_cache_get(ctxt, instance['uuid'])
+        self.assertEqual(cache['network_info'], '[1]')
+        self.assertEqual(cache['updated_at'], later)
+        self.assertNotEqual(cache['updated_at'], first['updated_at'])
+
+    def test_bw_usage_update_many(self):
+        ctxt = context.get_admin_context()
+        now = timeutils.utcnow()
+        start_period = now - datetime.timedelta(seconds=10)
+        db.bw_usage_update(ctxt, 'fake_uuid1', 'fake_mac1', start_period,
+                           1, 2)
+        # A row from another period must be left alone.
+        db.bw_usage_update(ctxt, 'fake_uuid1', 'fake_mac1', now, 7, 8)
+
+        db.bw_usage_update_many(ctxt, start_period,
+                [{'uuid': 'fake_uuid1', 'mac': 'fake_mac1',
+                  'bw_in': 100, 'bw_out': 200},
+                 {'uuid': 'fake_uuid1', 'mac': 'fake_mac2',
+                  'bw_in': 300, 'bw_out': 400},
+                 {'uuid': 'fake_uuid2', 'mac': 'fake_mac3',
+                  'bw_in': 500, 'bw_out': 600}],
+                last_refreshed=now)
+
+        bw_usages = db.bw_usage_get_by_uuids(ctxt,
+                ['fake_uuid1', 'fake_uuid2'], start_period)
+        result = sorted((bw['uuid'], bw['mac'], bw['bw_in'], bw['bw_out'],
+                         bw['last_refreshed']) for bw in bw_usages)
+        self.assertEqual(result,
+                [('fake_uuid1', 'fake_mac1', 100, 200, now),
+                 ('fake_uuid1', 'fake_mac2', 300, 400, now),
+                 ('fake_uuid2', 'fake_mac3', 500, 600, now)])
+
+        bw_usages = db.bw_usage_get_by_uuids(ctxt, ['fake_uuid1'], now)
+        self.assertEqual(len(bw_usages), 1)
+        self.assertEqual(bw_usages[0]['bw_in'], 7)
+
 
 def _get_fake_aggr_values():
     return {'name': 'fake_aggregate',
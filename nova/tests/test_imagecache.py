@@ -25,6 +25,7 @@ import time
 
 from nova import test
 
+from nova.compute import task_states
 from nova.compute import vm_states
 from nova import db
 from nova import flags
@@ -48,6 +49,23 @@ class ImageCacheManagerTestCase(test.TestCase):
                                      'instance-00000003': '789',
                                      'banana-42-hamster': '444'}
 
+    def _fake_instances(self, instances):
+        """Stub the image cache queries to work off a list of instances."""
+        def fake_get_all(context, host=None):
+            return [i for i in instances if host in (None, i['host']) or
+                    i['vm_state'] == vm_states.RESIZED or
+                    i['task_state'] == task_states.RESIZE_MIGRATED]
+
+        def fake_count(context):
+            counts = {}
+            for instance in instances:
+                counts.setdefault(instance['image_ref'], 0)
+                counts[instance['image_ref']] += 1
+            return counts
+
+        self.stubs.Set(db, 'instance_get_all_for_image_cache', fake_get_all)
+        self.stubs.Set(db, 'instance_count_by_image', fake_count)
+
     def test_read_stored_checksum_missing(self):
         self.stubs.Set(os.path, 'exists', lambda x: False)
         csum = imagecache.read_stored_checksum('/tmp/foo')
@@ -144,25 +162,24 @@ class ImageCacheManagerTestCase(test.TestCase):
         self.assertFalse(unexpected in image_cache_manager.originals)
 
     def test_list_running_instances(self):
-        self.stubs.Set(db, 'instance_get_all',
-                       lambda x: [{'image_ref': '1',
-                                   'host': FLAGS.host,
-                                   'name': 'inst-1',
-                                   'uuid': '123',
-                                   'vm_state': '',
-                                   'task_state': ''},
-                                  {'image_ref': '2',
-                                   'host': FLAGS.host,
-                                   'name': 'inst-2',
-                                   'uuid': '456',
-                                   'vm_state': '',
-                                   'task_state': ''},
-                                  {'image_ref': '2',
-                                   'host': 'remotehost',
-                                   'name': 'inst-3',
-                                   'uuid': '789',
-                                   'vm_state': '',
-                                   'task_state': ''}])
+        self._fake_instances([{'image_ref': '1',
+                               'host': FLAGS.host,
+                               'name': 'inst-1',
+                               'uuid': '123',
+                               'vm_state': '',
+                               'task_state': ''},
+                              {'image_ref': '2',
+                               'host': FLAGS.host,
+                               'name': 'inst-2',
+                               'uuid': '456',
+                               'vm_state': '',
+                               'task_state': ''},
+                              {'image_ref': '2',
+                               'host': 'remotehost',
+                               'name': 'inst-3',
+                               'uuid': '789',
+                               'vm_state': '',
+                               'task_state': ''}])
 
         image_cache_manager = imagecache.ImageCacheManager()
 
@@ -173,20 +190,45 @@ class ImageCacheManagerTestCase(test.TestCase):
         self.assertTrue(image_cache_manager.used_images['1'] ==
                         (1, 0, ['inst-1']))
         self.assertTrue(image_cache_manager.used_images['2'] ==
-                        (1, 1, ['inst-2', 'inst-3']))
+                        (1, 1, ['inst-2']))
+        self.assertEqual(image_cache_manager.instance_names,
+                         set(['inst-1', 'inst-2']))
 
         self.assertEqual(len(image_cache_manager.image_popularity), 2)
         self.assertEqual(image_cache_manager.image_popularity['1'], 1)
         self.assertEqual(image_cache_manager.image_popularity['2'], 2)
 
+    def test_list_running_instances_shared_instances_path(self):
+        self.flags(image_cache_shared_instances_path=True)
+        self._fake_instances([{'image_ref': '1',
+                               'host': FLAGS.host,
+                               'name': 'inst-1',
+                               'uuid': '123',
+                               'vm_state': '',
+                               'task_state': ''},
+                              {'image_ref': '1',
+                               'host': 'remotehost',
+                               'name': 'inst-2',
+                               'uuid': '456',
+                               'vm_state': '',
+                               'task_state': ''}])
+
+        image_cache_manager = imagecache.ImageCacheManager()
+        image_cache_manager._list_running_instances(None)
+
+        self.assertTrue(image_cache_manager.used_images['1'] ==
+                        (1, 1, ['inst-1', 'inst-2']))
+        self.assertEqual(image_cache_manager.instance_names,
+                         set(['inst-1', 'inst-2']))
+        self.assertEqual(image_cache_manager.image_popularity['1'], 2)
+
     def test_list_resizing_instances(self):
-        self.stubs.Set(db, 'instance_get_all',
-                       lambda x: [{'image_ref': '1',
-                                   'host': FLAGS.host,
-                                   'name': 'inst-1',
-                                   'uuid': '123',
-                                   'vm_state': vm_states.RESIZED,
-                                   'task_state': None}])
+        self._fake_instances([{'image_ref': '1',
+                               'host': FLAGS.host,
+                               'name': 'inst-1',
+                               'uuid': '123',
+                               'vm_state': vm_states.RESIZED,
+                               'task_state': None}])
 
         image_cache_manager = imagecache.ImageCacheManager()
         image_cache_manager._list_running_instances(None)
@@ -200,6 +242,37 @@ class ImageCacheManagerTestCase(test.TestCase):
         self.assertEqual(len(image_cache_manager.image_popularity), 1)
         self.assertEqual(image_cache_manager.image_popularity['1'], 1)
 
+    def test_list_instances_resized_away(self):
+        self._fake_instances([{'image_ref': '1',
+                               'host': 'desthost',
+                               'name': 'inst-1',
+                               'uuid': '123',
+                               'vm_state': vm_states.RESIZED,
+                               'task_state': None},
+                              {'image_ref': '2',
+                               'host': 'desthost',
+                               'name': 'inst-2',
+                               'uuid': '456',
+                               'vm_state': '',
+                               'task_state': task_states.RESIZE_MIGRATED}])
+
+        with utils.tempdir() as tmpdir:
+            self.flags(instances_path=tmpdir)
+            os.mkdir(os.path.join(tmpdir, 'inst-1_resize'))
+
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager._list_running_instances(None)
+
+        # Only inst-1 was resized from this host, so only its base image
+        # counts as used here
+        self.assertEqual(image_cache_manager.used_images['1'],
+                         (1, 0, ['inst-1']))
+        self.assertEqual(image_cache_manager.used_images['2'],
+                         (0, 1, ['inst-2']))
+        self.assertEqual(image_cache_manager.instance_names,
+                         set(['inst-1', 'inst-1_resize',
+                              'inst-2', 'inst-2_resize']))
+
     def test_list_backing_images_small(self):
         self.stubs.Set(os, 'listdir',
                        lambda x: ['_base', 'instance-00000001',
@@ -477,6 +550,70 @@ class ImageCacheManagerTestCase(test.TestCase):
                 # side effect of creating the checksum
                 self.assertTrue(os.path.exists(info_fname))
 
+    def test_verify_checksum_skips_unchanged_file(self):
+        img = {'container_format': 'ami', 'id': '42'}
+
+        with utils.tempdir() as tmpdir:
+            self.flags(instances_path=tmpdir)
+            self.flags(image_info_filename_pattern=('$instances_path/'
+                                                    '%(image)s.info'))
+            fname, info_fname, testdata = self._make_checksum(tmpdir)
+            imagecache.write_stored_checksum(fname)
+            self.assertEqual(virtutils.read_stored_info(fname, 'sha1_stat'),
+                             imagecache.get_file_stat(fname))
+
+            info = virtutils.read_stored_info(fname)
+
+            self.mox.StubOutWithMock(imagecache, 'hash_file')
+            self.mox.ReplayAll()
+
+            image_cache_manager = imagecache.ImageCacheManager()
+            res = image_cache_manager._verify_checksum(img, fname)
+            self.assertTrue(res)
+            # Nothing was hashed, so the verification is not recorded again
+            self.assertEqual(virtutils.read_stored_info(fname), info)
+
+    def test_verify_checksum_io_budget(self):
+        img = {'container_format': 'ami', 'id': '42'}
+        self.flags(checksum_interval_seconds=0, checksum_io_budget_mb=1)
+
+        with utils.tempdir() as tmpdir:
+            self.flags(instances_path=tmpdir)
+            self.flags(image_info_filename_pattern=('$instances_path/'
+                                                    '%(image)s.info'))
+            fname, info_fname, testdata = self._make_checksum(tmpdir)
+            imagecache.write_stored_checksum(fname)
+
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager._checksum_budget = len(testdata) * 3 / 2
+            self.assertTrue(image_cache_manager._verify_checksum(img, fname))
+            self.assertEqual(image_cache_manager._verify_checksum(img, fname),
+                             None)
+
+    def test_verify_checksum_sampled(self):
+        img = {'container_format': 'ami', 'id': '42'}
+        self.flags(checksum_sample_blocks=2)
+
+        with self._intercept_log_messages() as stream:
+            with utils.tempdir() as tmpdir:
+                self.flags(instances_path=tmpdir)
+                self.flags(image_info_filename_pattern=('$instances_path/'
+                                                        '%(image)s.info'))
+                fname, info_fname, testdata = self._make_checksum(tmpdir)
+                imagecache.write_stored_checksum(fname)
+
+                image_cache_manager = imagecache.ImageCacheManager()
+                self.assertTrue(image_cache_manager._verify_checksum(img,
+                                                                     fname))
+
+                virtutils.write_stored_info(fname, field='sha1_sample',
+                                            value='banana')
+                self.assertFalse(image_cache_manager._verify_checksum(img,
+                                                                      fname))
+                log = stream.getvalue()
+                self.assertNotEqual(
+                    log.find('sampled image verification failed'), -1)
+
     @contextlib.contextmanager
     def _make_base_file(self, checksum=True):
         """Make a base file for testing."""
@@ -603,6 +740,29 @@ class ImageCacheManagerTestCase(test.TestCase):
             self.assertEquals(image_cache_manager.removable_base_files, [])
             self.assertEquals(image_cache_manager.corrupt_base_files, [])
 
+    def test_handle_base_image_used_deferred_checksum(self):
+        self.stubs.Set(virtutils, 'chown', lambda x, y: None)
+        self.flags(checksum_base_images=True, checksum_interval_seconds=0,
+                   checksum_io_budget_mb=1)
+        img = '123'
+
+        with self._make_base_file() as fname:
+            os.utime(fname, (-1, time.time() - 3601))
+            imagecache.write_stored_checksum(fname)
+
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager._checksum_budget = 0
+            image_cache_manager.unexplained_images = [fname]
+            image_cache_manager.used_images = {'123': (1, 0, ['banana-42'])}
+            image_cache_manager._handle_base_image(img, fname)
+
+            # The file was touched, but the next pass must still see it
+            # as unchanged rather than hashing it outside the budget.
+            self.assertTrue(os.stat(fname).st_mtime > time.time() - 3600)
+            self.assertEquals(virtutils.read_stored_info(fname, 'sha1_stat'),
+                              imagecache.get_file_stat(fname))
+            self.assertEquals(image_cache_manager.corrupt_base_files, [])
+
     def test_handle_base_image_used_remotely(self):
         img = '123'
 
@@ -764,19 +924,18 @@ class ImageCacheManagerTestCase(test.TestCase):
         self.stubs.Set(os.path, 'isfile', lambda x: isfile(x))
 
         # Fake the database call which lists running instances
-        self.stubs.Set(db, 'instance_get_all',
-                       lambda x: [{'image_ref': '1',
-                                   'host': FLAGS.host,
-                                   'name': 'instance-1',
-                                   'uuid': '123',
-                                   'vm_state': '',
-                                   'task_state': ''},
-                                  {'image_ref': '1',
-                                   'host': FLAGS.host,
-                                   'name': 'instance-2',
-                                   'uuid': '456',
-                                   'vm_state': '',
-                                   'task_state': ''}])
+        self._fake_instances([{'image_ref': '1',
+                               'host': FLAGS.host,
+                               'name': 'instance-1',
+                               'uuid': '123',
+                               'vm_state': '',
+                               'task_state': ''},
+                              {'image_ref': '1',
+                               'host': FLAGS.host,
+                               'name': 'instance-2',
+                               'uuid': '456',
+                               'vm_state': '',
+                               'task_state': ''}])
 
         image_cache_manager = imagecache.ImageCacheManager()
 
@@ -865,19 +1024,18 @@ class ImageCacheManagerTestCase(test.TestCase):
             os.mkdir(os.path.join(tmpdir, '_base'))
 
             # Fake the database call which lists running instances
-            self.stubs.Set(db, 'instance_get_all',
-                           lambda x: [{'image_ref': '1',
-                                       'host': FLAGS.host,
-                                       'name': 'instance-1',
-                                       'uuid': '123',
-                                       'vm_state': '',
-                                       'task_state': ''},
-                                      {'image_ref': '1',
-                                       'host': FLAGS.host,
-                                       'name': 'instance-2',
-                                       'uuid': '456',
-                                       'vm_state': '',
-                                       'task_state': ''}])
+            self._fake_instances([{'image_ref': '1',
+                                   'host': FLAGS.host,
+                                   'name': 'instance-1',
+                                   'uuid': '123',
+                                   'vm_state': '',
+                                   'task_state': ''},
+                                  {'image_ref': '1',
+                                   'host': FLAGS.host,
+                                   'name': 'instance-2',
+                                   'uuid': '456',
+                                   'vm_state': '',
+                                   'task_state': ''}])
 
             def touch(filename):
                 f = open(filename, 'w')
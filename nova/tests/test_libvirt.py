@@ -48,12 +48,14 @@ import nova.tests.image.fake
 from nova import utils
 from nova.virt.disk import api as disk
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova.virt import firewall as base_firewall
 from nova.virt import images
 from nova.virt.libvirt import config
 from nova.virt.libvirt import driver as libvirt_driver
 from nova.virt.libvirt import firewall
 from nova.virt.libvirt import imagebackend
+from nova.virt.libvirt import imagecache
 from nova.virt.libvirt import utils as libvirt_utils
 from nova.virt.libvirt import volume
 from nova.virt.libvirt import volume_nfs
@@ -1924,6 +1926,65 @@ class LibvirtConnTestCase(test.TestCase):
 
         db.instance_destroy(self.context, instance_ref['uuid'])
 
+    def test_lifecycle_events_are_dispatched(self):
+        uuid = 'cef19ce0-0ca2-11df-855d-b19fbce37686'
+        dom = self.mox.CreateMock(libvirt.virDomain)
+        dom.UUIDString().AndReturn(uuid)
+        self.mox.ReplayAll()
+
+        conn = libvirt_driver.LibvirtDriver(False)
+        conn._init_events_pipe()
+        self.addCleanup(conn._event_notify_send.close)
+        self.addCleanup(conn._event_notify_recv.close)
+        events = []
+        conn.register_event_listener(events.append)
+
+        conn._event_lifecycle_callback(None, dom,
+                                       libvirt.VIR_DOMAIN_EVENT_STOPPED, 0,
+                                       conn)
+        conn._event_lifecycle_callback(None, dom,
+                                       libvirt.VIR_DOMAIN_EVENT_DEFINED, 0,
+                                       conn)
+        conn._dispatch_events()
+
+        self.assertEqual(len(events), 1)
+        self.assertTrue(isinstance(events[0], virtevent.LifecycleEvent))
+        self.assertEqual(events[0].uuid, uuid)
+        self.assertEqual(events[0].power_state, power_state.SHUTDOWN)
+
+    def test_run_image_stages_concurrently(self):
+        conn = libvirt_driver.LibvirtDriver(False)
+        kernel_fetched = eventlet.event.Event()
+        ran = []
+
+        def fetch_kernel():
+            ran.append('kernel')
+            kernel_fetched.send()
+
+        def fetch_disk():
+            # Would never return if the stages ran one after another
+            kernel_fetched.wait()
+            ran.append('disk')
+
+        conn._run_image_stages({'uuid': 'fake-uuid'},
+                               [('disk', fetch_disk),
+                                ('kernel', fetch_kernel)])
+        self.assertEqual(ran, ['kernel', 'disk'])
+
+    def test_run_image_stages_raises_after_all_stages(self):
+        self.flags(libvirt_image_fetch_workers=1)
+        conn = libvirt_driver.LibvirtDriver(False)
+        ran = []
+
+        def fail():
+            raise exception.ImageNotFound(image_id='fake')
+
+        self.assertRaises(exception.ImageNotFound, conn._run_image_stages,
+                          {'uuid': 'fake-uuid'},
+                          [('kernel', fail),
+                           ('disk', lambda: ran.append('disk'))])
+        self.assertEqual(ran, ['disk'])
+
     def test_spawn_with_network_info(self):
         # Preparing mocks
         def fake_none(self, instance):
@@ -2065,11 +2126,11 @@ class LibvirtConnTestCase(test.TestCase):
             conn = libvirt_driver.LibvirtDriver(False)
 
             self.mox.StubOutWithMock(conn, "_wrapped_conn")
-            self.mox.StubOutWithMock(conn._wrapped_conn, "getCapabilities")
+            self.mox.StubOutWithMock(conn._wrapped_conn, "getLibVersion")
             self.mox.StubOutWithMock(libvirt.libvirtError, "get_error_code")
             self.mox.StubOutWithMock(libvirt.libvirtError, "get_error_domain")
 
-            conn._wrapped_conn.getCapabilities().AndRaise(
+            conn._wrapped_conn.getLibVersion().AndRaise(
                     libvirt.libvirtError("fake failure"))
 
             libvirt.libvirtError.get_error_code().AndReturn(error)
@@ -2081,6 +2142,53 @@ class LibvirtConnTestCase(test.TestCase):
 
             self.mox.UnsetStubs()
 
+    def test_host_capabilities_cached_per_connection(self):
+        conn = libvirt_driver.LibvirtDriver(False)
+        calls = []
+        real_connect = conn._connect
+
+        def fake_connect(uri, read_only):
+            wrapped = real_connect(uri, read_only)
+            real_caps = wrapped.getCapabilities
+
+            def fake_get_capabilities():
+                calls.append(uri)
+                return real_caps()
+
+            wrapped.getCapabilities = fake_get_capabilities
+            return wrapped
+
+        self.stubs.Set(conn, '_connect', fake_connect)
+
+        caps = conn.get_host_capabilities()
+        self.assertEqual(caps.host.cpu.model, 'Penryn')
+        self.assertTrue(conn.get_host_capabilities() is caps)
+        conn.get_guest_cpu_config()
+        self.assertEqual(len(calls), 1)
+
+        # A new connection has to read the capabilities again
+        self.stubs.Set(conn, '_test_connection', lambda: False)
+        conn._conn.listDomainsID()
+        self.assertFalse(conn.get_host_capabilities() is caps)
+        self.assertEqual(len(calls), 2)
+
+    def test_instance_type_looked_up_once(self):
+        conn = libvirt_driver.LibvirtDriver(False)
+        calls = []
+
+        def fake_get_instance_type(inst_type_id):
+            calls.append(inst_type_id)
+            return {'id': inst_type_id, 'memory_mb': 512}
+
+        self.stubs.Set(instance_types, 'get_instance_type',
+                       fake_get_instance_type)
+
+        for _i in range(3):
+            inst_type = conn._get_instance_type(2)
+        self.assertEqual(inst_type['memory_mb'], 512)
+        conn._get_instance_type(5)
+        self.assertEqual(calls, [2, 5])
+
     def test_volume_in_mapping(self):
         conn = libvirt_driver.LibvirtDriver(False)
         swap = {'device_name': '/dev/sdb',
@@ -2191,21 +2299,112 @@ class LibvirtConnTestCase(test.TestCase):
         self.assertFalse(result)
 
     def test_available_least_handles_missing(self):
-        """Ensure destroy calls managedSaveRemove for saved instance"""
-        conn = libvirt_driver.LibvirtDriver(False)
+        """Ensure domains vanishing while listed are ignored"""
+        def fake_lookup_by_id(dom_id):
+            raise libvirt.libvirtError('Domain not found')
 
-        def list_instances():
-            return ['fake']
-        self.stubs.Set(conn, 'list_instances', list_instances)
-
-        def get_info(instance_name):
-            raise exception.InstanceNotFound()
-        self.stubs.Set(conn, 'get_instance_disk_info', get_info)
+        self.create_fake_libvirt_mock(lookupByID=fake_lookup_by_id)
+        conn = libvirt_driver.LibvirtDriver(False)
+        self.stubs.Set(conn, 'list_instance_ids', lambda: [1])
 
         result = conn.get_disk_available_least()
         space = fake_libvirt_utils.get_fs_info(FLAGS.instances_path)['free']
         self.assertEqual(result, space / 1024 ** 3)
 
+    def _fake_sampled_domains(self):
+        GB = 1024 ** 3
+        xml = ("<domain type='kvm'><devices>"
+               "<disk type='file'><driver name='qemu' type='qcow2'/>"
+               "<source file='/test/%(name)s/disk'/></disk>"
+               "<disk type='block'><driver name='qemu' type='raw'/>"
+               "<source dev='/dev/volume'/></disk>"
+               "<disk type='file' device='cdrom'><target dev='hdc'/></disk>"
+               "</devices></domain>")
+        self.calls = {'XMLDesc': 0, 'vcpus': 0}
+        test_case = self
+
+        class FakeSampledDomain(object):
+            def __init__(self, name, vcpus):
+                self._name = name
+                self._vcpus = vcpus
+
+            def name(self):
+                return self._name
+
+            def UUIDString(self):
+                return 'uuid-%s' % self._name
+
+            def XMLDesc(self, flags):
+                test_case.calls['XMLDesc'] += 1
+                return xml % {'name': self._name}
+
+            def vcpus(self):
+                test_case.calls['vcpus'] += 1
+                return ([], [None] * self._vcpus)
+
+        self.domains = {1: FakeSampledDomain('inst1', 2),
+                        2: FakeSampledDomain('inst2', 4)}
+        self.create_fake_libvirt_mock(
+                lookupByID=lambda dom_id: self.domains[dom_id])
+        virt_sizes = {'/test/inst1/disk': 10 * GB,
+                      '/test/inst2/disk': 20 * GB}
+        self.stubs.Set(libvirt_driver.disk, 'get_disk_size',
+                       lambda path: virt_sizes[path])
+        self.stubs.Set(os.path, 'getsize', lambda path: GB)
+
+        conn = libvirt_driver.LibvirtDriver(False)
+        self.stubs.Set(conn, 'list_instance_ids',
+                       lambda: [0] + self.domains.keys())
+        return conn
+
+    def test_sample_domains_caches_static_data(self):
+        conn = self._fake_sampled_domains()
+        free_gb = (fake_libvirt_utils.get_fs_info(FLAGS.instances_path)
+                   ['free'] / 1024 ** 3)
+
+        self.assertEqual(conn.get_vcpu_used(), 6)
+        self.assertEqual(conn.get_disk_available_least(), free_gb - 28)
+        self.assertEqual(self.calls, {'XMLDesc': 2, 'vcpus': 2})
+
+        # A restarted domain gets a new id and is sampled again
+        self.domains[3] = self.domains.pop(2)
+        self.domains[3]._vcpus = 1
+        self.assertEqual(conn.get_vcpu_used(), 3)
+        self.assertEqual(self.calls, {'XMLDesc': 3, 'vcpus': 3})
+        self.assertEqual(sorted(conn._domain_samples.keys()),
+                         ['uuid-inst1', 'uuid-inst2'])
+
+        # Samples of domains which went away are dropped
+        del self.domains[3]
+        self.assertEqual(conn.get_vcpu_used(), 2)
+        self.assertEqual(conn._domain_samples.keys(), ['uuid-inst1'])
+
+    def test_update_available_resource_samples_domains_once(self):
+        conn = self._fake_sampled_domains()
+        listed = []
+        real_sample_domains = conn._sample_domains
+
+        def fake_sample_domains():
+            listed.append(True)
+            return real_sample_domains()
+
+        self.stubs.Set(conn, '_sample_domains', fake_sample_domains)
+        self.stubs.Set(conn, 'get_memory_mb_used', lambda: 0)
+        self.stubs.Set(conn, 'get_memory_mb_total', lambda: 1024)
+        self.stubs.Set(conn, 'get_hypervisor_type', lambda: 'QEMU')
+        self.stubs.Set(conn, 'get_hypervisor_version', lambda: 1)
+        self.stubs.Set(conn, 'get_hypervisor_hostname', lambda: 'compute1')
+        self.stubs.Set(conn, 'get_cpu_info', lambda: '{}')
+        service_ref = self.create_service(host='dummy')
+
+        conn.update_available_resource(self.context, 'dummy')
+
+        self.assertEqual(len(listed), 1)
+        compute_node = db.service_get(self.context,
+                                      service_ref['id'])['compute_node'][0]
+        self.assertEqual(compute_node['vcpus_used'], 6)
+        db.service_destroy(self.context, service_ref['id'])
+
     def test_cpu_info(self):
         conn = libvirt_driver.LibvirtDriver(True)
 
@@ -3465,6 +3664,71 @@ disk size: 4.4M''', ''))
         out = libvirt_utils.get_disk_backing_file('')
         self.assertEqual(out, 'c')
 
+    def _write_qcow2_header(self, path, size, backing_file=None):
+        backing_offset = backing_file and 72 or 0
+        header = images._QCOW2_HEADER.pack(images.QCOW2_MAGIC, 2,
+                                           backing_offset,
+                                           len(backing_file or ''),
+                                           16, size)
+        with open(path, 'wb') as f:
+            f.write(header)
+            if backing_file:
+                f.seek(backing_offset)
+                f.write(backing_file)
+
+    def test_read_image_header_qcow2(self):
+        with utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'disk')
+            self._write_qcow2_header(path, 10737418240, '/foo/bar/baz')
+            self.mox.StubOutWithMock(utils, 'execute')
+            self.mox.ReplayAll()
+
+            header = images.read_image_header(path)
+            self.assertEqual(header['format'], 'qcow2')
+            self.assertEqual(header['virtual_size'], 10737418240)
+            self.assertEqual(header['backing_file'], '/foo/bar/baz')
+            self.assertEqual(header['cluster_size'], 65536)
+            self.assertEqual(libvirt_utils.get_disk_backing_file(path), 'baz')
+            self.assertEqual(libvirt_utils.get_disk_size(path), 10737418240)
+            self.assertEqual(disk.get_disk_size(path), 10737418240)
+
+    def test_read_image_header_raw(self):
+        with utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'disk')
+            with open(path, 'wb') as f:
+                f.write('\0' * 4096)
+
+            header = images.read_image_header(path)
+            self.assertEqual(header['format'], 'raw')
+            self.assertEqual(header['virtual_size'], 4096)
+            self.assertEqual(header['backing_file'], None)
+
+    def test_read_image_header_other_format(self):
+        with utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'disk')
+            with open(path, 'wb') as f:
+                f.write('KDMV' + '\0' * 508)
+
+            self.assertEqual(images.read_image_header(path), None)
+
+    def test_read_image_header_cached_until_modified(self):
+        with utils.tempdir() as tmpdir:
+            path = os.path.join(tmpdir, 'disk')
+            self._write_qcow2_header(path, 1024)
+            os.utime(path, (1000, 1000))
+            images.read_image_header(path)
+
+            self.mox.StubOutWithMock(images, '_parse_image_header')
+            images._parse_image_header(path, mox.IgnoreArg()).AndReturn(
+                {'virtual_size': 2048})
+            self.mox.ReplayAll()
+
+            self.assertEqual(images.read_image_header(path)['virtual_size'],
+                             1024)
+            os.utime(path, (2000, 2000))
+            self.assertEqual(images.read_image_header(path)['virtual_size'],
+                             2048)
+
 
 class LibvirtDriverTestCase(test.TestCase):
     """Test for nova.virt.libvirt.libvirt_driver.LibvirtDriver."""
@@ -3533,7 +3797,8 @@ class LibvirtDriverTestCase(test.TestCase):
 
         self.assertRaises(AssertionError,
                           self.libvirtconnection.migrate_disk_and_power_off,
-                          None, ins_ref, '10.0.0.2', None, None)
+                          context.get_admin_context(), ins_ref, '10.0.0.2',
+                          None, None)
 
     def test_migrate_disk_and_power_off(self):
         """Test for nova.virt.libvirt.libvirt_driver.LivirtConnection
@@ -3569,16 +3834,106 @@ class LibvirtDriverTestCase(test.TestCase):
         self.stubs.Set(utils, 'execute', fake_execute)
 
         ins_ref = self._create_instance()
+        ctxt = context.get_admin_context()
         """ dest is different host case """
         out = self.libvirtconnection.migrate_disk_and_power_off(
-               None, ins_ref, '10.0.0.2', None, None)
+               ctxt, ins_ref, '10.0.0.2', None, None)
         self.assertEquals(out, disk_info_text)
 
         """ dest is same host case """
         out = self.libvirtconnection.migrate_disk_and_power_off(
-               None, ins_ref, '10.0.0.1', None, None)
+               ctxt, ins_ref, '10.0.0.1', None, None)
         self.assertEquals(out, disk_info_text)
 
+    _IMAGE_BASE = '9b5a0e6dc3bc7b1bd6a4d1b2d1c2d42ab8e94c61'
+
+    def _migrate_qcow2_overlay(self, dest_base_size, dest_checksum='abc',
+                               backing_file=_IMAGE_BASE):
+        disk_info = [{'type': 'qcow2', 'path': '/test/disk',
+                      'virt_disk_size': '10737418240',
+                      'backing_file': backing_file,
+                      'disk_size': '83886080'},
+                     {'type': 'raw', 'path': '/test/disk.local',
+                      'virt_disk_size': '10737418240',
+                      'backing_file': '',
+                      'disk_size': '83886080'}]
+        disk_info_text = jsonutils.dumps(disk_info)
+        self.executes = []
+        self.copied = []
+        self.progress = []
+
+        def fake_execute(*args, **kwargs):
+            self.executes.append(args)
+            if args[:3] == ('ssh', '10.0.0.2', 'stat'):
+                return '%s\n' % dest_base_size, ''
+            if args[:3] == ('ssh', '10.0.0.2', 'cat'):
+                return jsonutils.dumps({'sha1': dest_checksum}), ''
+            return '', ''
+
+        def fake_copy_image(src, dest, host=None):
+            self.copied.append((src, dest, host))
+
+        def fake_instance_update(ctxt, instance_uuid, values):
+            self.progress.append(values['progress'])
+
+        self.stubs.Set(self.libvirtconnection, 'get_instance_disk_info',
+                       lambda name: disk_info_text)
+        self.stubs.Set(self.libvirtconnection, '_destroy',
+                       lambda instance: None)
+        self.stubs.Set(self.libvirtconnection, 'get_host_ip_addr',
+                       lambda: '10.0.0.1')
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.stubs.Set(libvirt_utils, 'copy_image', fake_copy_image)
+        self.stubs.Set(db, 'instance_update', fake_instance_update)
+        self.stubs.Set(os.path, 'exists', lambda path: True)
+        self.stubs.Set(os.path, 'getsize', lambda path: 1024)
+        self.stubs.Set(imagecache, 'read_stored_checksum',
+                       lambda path: 'abc')
+
+        self.ins_ref = self._create_instance()
+        self.libvirtconnection.migrate_disk_and_power_off(
+               context.get_admin_context(), self.ins_ref, '10.0.0.2',
+               None, None)
+        self.assertEqual(self.progress, [33, 67, 100])
+        return [args for args in self.executes if args[0] == 'qemu-img']
+
+    def test_migrate_disk_ships_overlay_when_dest_has_base(self):
+        converts = self._migrate_qcow2_overlay(1024)
+        self.assertEqual(converts, [])
+        base_path = os.path.join(FLAGS.instances_path, '_base',
+                                 self._IMAGE_BASE)
+        ssh_cmds = [args for args in self.executes if args[0] == 'ssh']
+        self.assertEqual(ssh_cmds.index(('ssh', '10.0.0.2', 'touch', '-c',
+                                         base_path)),
+                         ssh_cmds.index(('ssh', '10.0.0.2', 'stat', '-c',
+                                         '%s', base_path)) - 1)
+        inst_base = os.path.join(FLAGS.instances_path, self.ins_ref['name'])
+        self.assertEqual(sorted(self.copied),
+                [(inst_base + '_resize/disk', '/test/disk', '10.0.0.2'),
+                 (inst_base + '_resize/disk.local', '/test/disk.local',
+                  '10.0.0.2')])
+
+    def test_migrate_disk_flattens_overlay_when_dest_lacks_base(self):
+        converts = self._migrate_qcow2_overlay(512)
+        self.assertEqual(len(converts), 1)
+        self.assertTrue(('/test/disk', '10.0.0.2') in
+                        [(dest, host) for src, dest, host in self.copied])
+        self.assertTrue(any(src.endswith('_rbase')
+                            for src, dest, host in self.copied))
+
+    def test_migrate_disk_flattens_overlay_when_dest_base_differs(self):
+        converts = self._migrate_qcow2_overlay(1024, dest_checksum='def')
+        self.assertEqual(len(converts), 1)
+
+    def test_migrate_disk_flattens_ephemeral_and_swap_overlays(self):
+        for backing_file in ('ephemeral_0_default', 'ephemeral_0_20_None',
+                             'swap_512'):
+            converts = self._migrate_qcow2_overlay(
+                    1024, backing_file=backing_file)
+            self.assertEqual(len(converts), 1)
+            self.assertFalse([args for args in self.executes
+                              if args[0] == 'ssh' and args[2] != 'mkdir'])
+
     def test_wait_for_running(self):
         """Test for nova.virt.libvirt.libvirt_driver.LivirtConnection
         ._wait_for_running. """
@@ -0,0 +1,100 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from nova.common import memorycache
+from nova.openstack.common import timeutils
+from nova import test
+
+
+class MemorycacheTestCase(test.TestCase):
+    def setUp(self):
+        super(MemorycacheTestCase, self).setUp()
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self.mc = memorycache.Client()
+
+    def test_set_get(self):
+        self.assertTrue(self.mc.set('foo', 'bar'))
+        self.assertEqual(self.mc.get('foo'), 'bar')
+        self.assertEqual(self.mc.get('missing'), None)
+
+    def test_expiry(self):
+        self.mc.set('short', 'a', time=5)
+        self.mc.set('long', 'b', time=20)
+        self.mc.set('forever', 'c')
+        timeutils.advance_time_seconds(5)
+        self.assertEqual(self.mc.get('short'), None)
+        self.assertEqual(self.mc.get('long'), 'b')
+        timeutils.advance_time_seconds(3600)
+        self.assertEqual(self.mc.get('long'), None)
+        self.assertEqual(self.mc.get('forever'), 'c')
+        self.assertEqual(len(self.mc), 1)
+
+    def test_reset_extends_expiry(self):
+        self.mc.set('foo', 'a', time=5)
+        timeutils.advance_time_seconds(4)
+        self.mc.set('foo', 'b', time=5)
+        timeutils.advance_time_seconds(4)
+        self.assertEqual(self.mc.get('foo'), 'b')
+
+    def test_lru_eviction(self):
+        self.flags(memorycache_max_size=2)
+        mc = memorycache.Client()
+        mc.set('a', 1)
+        mc.set('b', 2)
+        mc.get('a')
+        mc.set('c', 3)
+        self.assertEqual(mc.get('b'), None)
+        self.assertEqual(mc.get('a'), 1)
+        self.assertEqual(mc.get('c'), 3)
+        self.assertEqual(mc.evictions, 1)
+
+    def test_add(self):
+        self.assertTrue(self.mc.add('foo', 'a'))
+        self.assertFalse(self.mc.add('foo', 'b'))
+        self.assertEqual(self.mc.get('foo'), 'a')
+
+    def test_add_after_expiry(self):
+        self.mc.set('foo', 'a', time=1)
+        timeutils.advance_time_seconds(1)
+        self.assertTrue(self.mc.add('foo', 'b'))
+        self.assertEqual(self.mc.get('foo'), 'b')
+
+    def test_incr(self):
+        self.assertEqual(self.mc.incr('foo'), None)
+        self.mc.set('foo', '1', time=10)
+        self.assertEqual(self.mc.incr('foo'), 2)
+        self.assertEqual(self.mc.incr('foo', 3), 5)
+        self.assertEqual(self.mc.get('foo'), '5')
+        timeutils.advance_time_seconds(10)
+        self.assertEqual(self.mc.incr('foo'), None)
+
+    def test_delete(self):
+        self.mc.set('foo', 'a')
+        self.mc.delete('foo')
+        self.assertEqual(self.mc.get('foo'), None)
+
+    def test_stats(self):
+        self.mc.set('foo', 'a')
+        self.mc.get('foo')
+        self.mc.get('bar')
+        stats = self.mc.get_stats()[0][1]
+        self.assertEqual(stats['get_hits'], 1)
+        self.assertEqual(stats['get_misses'], 1)
+        self.assertEqual(stats['curr_items'], 1)
+
+    def test_expiry_heap_is_compacted(self):
+        for i in xrange(1000):
+            self.mc.set('foo', i, time=60)
+        self.assertTrue(len(self.mc._expiry) < 100)
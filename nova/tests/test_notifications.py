@@ -19,6 +19,8 @@
 
 import copy
 
+import eventlet
+
 from nova.compute import instance_types
 from nova.compute import task_states
 from nova.compute import vm_states
@@ -292,3 +294,63 @@ class NotificationsTestCase(test.TestCase):
 
         notifications.send_update(self.context, self.instance, self.instance)
         self.assertEquals(0, len(test_notifier.NOTIFICATIONS))
+
+    def test_send_update_without_drivers(self):
+        def fail_sending(context, instance, **kwargs):
+            self.fail('payload built without a driver to send it')
+        self.stubs.Set(notifications, '_send_instance_update_notification',
+                       fail_sending)
+        notifier_api._reset_drivers()
+        self.flags(notification_driver=[
+                'nova.openstack.common.notifier.no_op_notifier'])
+
+        self.assertFalse(notifications.enabled())
+        notifications.send_update(self.context, self.instance, self.instance)
+        skipped = notifications.get_stats()['skipped']
+        notifications.notify(self.context, 'compute.testhost', 'test.event',
+                             notifier_api.INFO, {})
+        self.assertEquals(skipped + 1, notifications.get_stats()['skipped'])
+
+
+class NotifierSenderTestCase(test.TestCase):
+
+    def setUp(self):
+        super(NotifierSenderTestCase, self).setUp()
+        self.flags(
+          notification_driver=['nova.openstack.common.notifier.test_notifier'],
+                   notification_send_async=True)
+        notifications._reset_sender()
+        test_notifier.NOTIFICATIONS = []
+        self.context = context.get_admin_context()
+
+    def tearDown(self):
+        notifications._reset_sender()
+        notifier_api._reset_drivers()
+        super(NotifierSenderTestCase, self).tearDown()
+
+    def _notify(self, count):
+        for i in xrange(count):
+            notifications.notify(self.context, 'compute.testhost',
+                                 'test.event', notifier_api.INFO, {'i': i})
+
+    def test_send_in_background(self):
+        self._notify(3)
+        self.assertEquals(0, len(test_notifier.NOTIFICATIONS))
+        self.assertEquals(3, notifications.get_stats()['queued'])
+
+        eventlet.sleep(0)
+        self.assertEquals([0, 1, 2], [n['payload']['i'] for n in
+                                      test_notifier.NOTIFICATIONS])
+        stats = notifications.get_stats()
+        self.assertEquals(0, stats['queued'])
+        self.assertEquals(3, stats['sent'])
+
+    def test_drop_when_queue_full(self):
+        self.flags(notification_queue_size=2)
+        self._notify(3)
+        eventlet.sleep(0)
+
+        self.assertEquals(2, len(test_notifier.NOTIFICATIONS))
+        stats = notifications.get_stats()
+        self.assertEquals(1, stats['dropped'])
+        self.assertEquals(2, stats['sent'])
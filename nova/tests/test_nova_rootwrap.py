@@ -14,12 +14,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import os
+import shutil
+import socket
 import subprocess
+import tempfile
 
+import eventlet
+
+from nova import exception
+from nova.rootwrap import client
+from nova.rootwrap import daemon
 from nova.rootwrap import filters
 from nova.rootwrap import wrapper
 from nova import test
+from nova import utils
 
 
 class RootwrapTestCase(test.TestCase):
@@ -127,3 +137,169 @@ class RootwrapTestCase(test.TestCase):
         usercmd = ["cat", "/"]
         filtermatch = wrapper.match_filter(self.filters, usercmd)
         self.assertTrue(filtermatch is self.filters[-1])
+
+    def test_FilterIndex_matches_like_match_filter(self):
+        self.filters.insert(0, filters.DnsmasqFilter("/usr/bin/dnsmasq",
+                                                     "root"))
+        self.filters.append(filters.RegExpFilter("/bin/echo", "root",
+                                                 'ech.', 'foo'))
+        index = wrapper.FilterIndex(self.filters)
+        for usercmd in (["ls", "/root"], ["ls", "root"], ["cat", "/"],
+                        ["foo_bar_not_exist"], ["echo", "foo"],
+                        ['FLAGFILE=A', 'NETWORK_ID=foobar', 'dnsmasq'],
+                        ["unknown"], []):
+            expected = None
+            if usercmd:
+                expected = wrapper.match_filter(self.filters, usercmd)
+            self.assertTrue(index.match(usercmd) is expected)
+
+    def test_get_exec_name(self):
+        self.assertEqual(self.filters[0].get_exec_name(), 'ls')
+        self.assertEqual(self.filters[1].get_exec_name(), 'foo_bar_not_exist')
+        f = filters.RegExpFilter("/sbin/mkfs", "root", 'mkfs.ext[34]', '.*')
+        self.assertEqual(f.get_exec_name(), None)
+        f = filters.KillFilter("root", "/bin/sleep")
+        self.assertEqual(f.get_exec_name(), 'kill')
+
+
+class RootwrapDaemonTestCase(test.TestCase):
+
+    def setUp(self):
+        super(RootwrapDaemonTestCase, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.client = client.Client('/fake/rootwrap.conf')
+        self.client._socket_path = os.path.join(tmpdir, 'rootwrap.sock')
+        self.client._authkey = 'secret'
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.client._socket_path)
+        self.server.listen(1)
+        self.daemon = daemon.RootwrapDaemon(
+                [filters.CommandFilter("/bin/cat", "root")],
+                os.getuid(), 'secret')
+        self.server_thread = eventlet.spawn(self.daemon.serve, self.server)
+
+        self.daemons_started = 0
+        self.daemons_forgotten = 0
+
+        def fake_ensure_daemon():
+            self.daemons_started += 1
+            return self.client._socket_path, self.client._authkey
+
+        def fake_forget_daemon():
+            self.daemons_forgotten += 1
+
+        self.stubs.Set(self.client, '_ensure_daemon', fake_ensure_daemon)
+        self.stubs.Set(self.client, '_forget_daemon', fake_forget_daemon)
+
+    def tearDown(self):
+        self.server_thread.kill()
+        self.server.close()
+        super(RootwrapDaemonTestCase, self).tearDown()
+
+    def test_run_allowed_command(self):
+        returncode, stdout, stderr = self.client._run(['cat'], 'hello\0')
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, 'hello\0')
+
+    def test_run_unauthorized_command(self):
+        returncode, stdout, stderr = self.client._run(['ls', '/'], '')
+        self.assertEqual(returncode, daemon.RC_UNAUTHORIZED)
+        self.assertEqual(stdout, '')
+
+    def test_run_missing_executable(self):
+        self.daemon.index = wrapper.FilterIndex(
+                [filters.CommandFilter("/nonexistent/cat", "root")])
+        returncode, stdout, stderr = self.client._run(['cat'], '')
+        self.assertEqual(returncode, daemon.RC_EXEC_FAILED)
+        self.assertTrue('/nonexistent/cat' in stderr)
+
+    def test_wrong_authkey_is_refused(self):
+        self.client._authkey = 'wrong'
+        self.assertRaises(exception.ProcessExecutionError,
+                          self.client.execute, ['cat'])
+        self.assertEqual(self.daemons_started, 1)
+        self.assertEqual(self.daemons_forgotten, 0)
+
+    def test_lost_reply_is_not_retried(self):
+        runs = []
+        real_run = self.daemon.run
+
+        def counting_run(userargs, stdin):
+            runs.append(userargs)
+            return real_run(userargs, stdin)
+
+        real_recv_message = daemon.recv_message
+        client_thread = eventlet.getcurrent()
+
+        def fake_recv_message(sock):
+            # Only the reply to the client gets lost
+            if eventlet.getcurrent() is client_thread:
+                raise EOFError()
+            return real_recv_message(sock)
+
+        self.stubs.Set(self.daemon, 'run', counting_run)
+        self.stubs.Set(daemon, 'recv_message', fake_recv_message)
+        self.assertRaises(exception.ProcessExecutionError,
+                          self.client.execute, ['cat'], 'hello')
+        eventlet.sleep(0.1)
+        self.assertEqual(runs, [['cat']])
+        self.assertEqual(self.daemons_started, 1)
+
+    def test_unreachable_daemon_is_replaced(self):
+        socket_path = self.client._socket_path
+        self.client._socket_path = socket_path + '.gone'
+
+        def fake_forget_daemon():
+            self.daemons_forgotten += 1
+            self.client._socket_path = socket_path
+
+        self.stubs.Set(self.client, '_forget_daemon', fake_forget_daemon)
+        returncode, stdout, stderr = self.client.execute(['cat'], 'hello')
+        self.assertEqual(stdout, 'hello')
+        self.assertEqual(self.daemons_started, 2)
+        self.assertEqual(self.daemons_forgotten, 1)
+
+
+class RootwrapDaemonExecuteTestCase(test.TestCase):
+
+    def test_execute_uses_daemon(self):
+        self.flags(rootwrap_config='/fake/rootwrap.conf',
+                   use_rootwrap_daemon=True)
+        calls = []
+
+        class FakeClient(object):
+            def execute(self, args, process_input=None):
+                calls.append((args, process_input))
+                return 0, 'out', 'err'
+
+        self.stubs.Set(utils, '_get_rootwrap_client', FakeClient)
+        self.assertEqual(utils.execute('cat', 'x', run_as_root=True,
+                                       process_input='in'),
+                         ('out', 'err'))
+        self.assertEqual(calls, [(['cat', 'x'], 'in')])
+
+    def test_execute_daemon_failure(self):
+        self.flags(rootwrap_config='/fake/rootwrap.conf',
+                   use_rootwrap_daemon=True)
+
+        class FakeClient(object):
+            def execute(self, args, process_input=None):
+                return 1, '', 'failed'
+
+        self.stubs.Set(utils, '_get_rootwrap_client', FakeClient)
+        self.assertRaises(exception.ProcessExecutionError, utils.execute,
+                          'cat', 'x', run_as_root=True)
+
+    def test_execute_daemon_unreachable(self):
+        self.flags(rootwrap_config='/fake/rootwrap.conf',
+                   use_rootwrap_daemon=True)
+
+        class FakeClient(object):
+            def execute(self, args, process_input=None):
+                raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+
+        self.stubs.Set(utils, '_get_rootwrap_client', FakeClient)
+        self.assertRaises(exception.ProcessExecutionError, utils.execute,
+                          'cat', 'x', run_as_root=True)
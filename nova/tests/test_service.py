@@ -22,6 +22,7 @@ Unit Tests for remote procedure calls using queue
 
 import mox
 
+from eventlet import event
 from eventlet import greenthread
 
 from nova import context
@@ -194,6 +195,160 @@ class ServiceTestCase(test.TestCase):
         self.assert_(not serv.model_disconnected)
 
 
+class FakePeriodicManager(manager.Manager):
+    """Fake manager with periodic tasks for tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(FakePeriodicManager, self).__init__(*args, **kwargs)
+        self.log = []
+
+    @manager.periodic_task
+    def _every_time(self, context):
+        self.log.append('every_time')
+
+    @manager.periodic_task(spacing=30)
+    def _spaced(self, context):
+        self.log.append('spaced')
+
+    @manager.periodic_task(ticks_between_runs=2)
+    def _ticked(self, context):
+        self.log.append('ticked')
+
+
+class SlowPeriodicManager(manager.Manager):
+    """Fake manager with periodic tasks which yield while running"""
+
+    def __init__(self, *args, **kwargs):
+        super(SlowPeriodicManager, self).__init__(*args, **kwargs)
+        self.log = []
+
+    @manager.periodic_task
+    def _first(self, context):
+        self.log.append('first start')
+        greenthread.sleep(0.01)
+        self.log.append('first end')
+
+    @manager.periodic_task
+    def _second(self, context):
+        self.log.append('second start')
+        greenthread.sleep(0.01)
+        self.log.append('second end')
+
+    @manager.periodic_task(timeout=0.01)
+    def _hangs(self, context):
+        greenthread.sleep(10)
+        self.log.append('hangs end')
+
+
+class BusyPeriodicManager(manager.Manager):
+    """Fake manager with a periodic task running until released"""
+
+    def __init__(self, *args, **kwargs):
+        super(BusyPeriodicManager, self).__init__(*args, **kwargs)
+        self.log = []
+        self.release = event.Event()
+
+    @manager.periodic_task
+    def _busy(self, context):
+        self.log.append('busy start')
+        self.release.wait()
+        self.release = event.Event()
+
+    @manager.periodic_task
+    def _quick(self, context):
+        self.log.append('quick')
+
+
+class PeriodicTasksTestCase(test.TestCase):
+    def setUp(self):
+        super(PeriodicTasksTestCase, self).setUp()
+        self.flags(periodic_interval=10)
+        self.now = 1000.0
+
+        class FakeTime(object):
+            @staticmethod
+            def time():
+                return self.now
+
+        self.stubs.Set(manager, 'time', FakeTime)
+        self.context = context.get_admin_context()
+
+    def _run_tasks(self, mgr):
+        """Starts the due tasks and lets them finish."""
+        idle_for = mgr.periodic_tasks(self.context)
+        greenthread.sleep(0)
+        return idle_for
+
+    def test_tasks_run_when_due(self):
+        mgr = FakePeriodicManager()
+        idle_for = self._run_tasks(mgr)
+        self.assertEqual(sorted(mgr.log), ['every_time', 'spaced'])
+        self.assertEqual(idle_for, 10)
+
+        mgr.log = []
+        self.now += 20
+        idle_for = self._run_tasks(mgr)
+        self.assertEqual(mgr.log, ['every_time'])
+        self.assertEqual(idle_for, 10)
+
+        mgr.log = []
+        self.now += 15
+        idle_for = self._run_tasks(mgr)
+        self.assertEqual(sorted(mgr.log), ['every_time', 'spaced', 'ticked'])
+        self.assertEqual(idle_for, 10)
+        self.assertEqual(mgr._periodic_stats['_spaced']['lateness'], 5)
+        self.assertEqual(mgr._periodic_stats['_spaced']['runs'], 2)
+        self.assertEqual(mgr._periodic_stats['_ticked']['runs'], 1)
+
+    def test_unspaced_tasks_keep_periodic_interval(self):
+        mgr = FakePeriodicManager()
+        self._run_tasks(mgr)
+
+        # A wakeup before periodic_interval passed leaves them alone
+        mgr.log = []
+        self.now += 5
+        idle_for = self._run_tasks(mgr)
+        self.assertEqual(mgr.log, [])
+        self.assertEqual(idle_for, 5)
+
+    def test_tasks_run_concurrently(self):
+        mgr = SlowPeriodicManager()
+        self.assertRaises(exception.NovaException,
+                          mgr.periodic_tasks, self.context,
+                          raise_on_error=True)
+        self.assertEqual(sorted(mgr.log[:2]), ['first start', 'second start'])
+        self.assertEqual(sorted(mgr.log[2:]), ['first end', 'second end'])
+        self.assertEqual(mgr._periodic_stats['_hangs']['failures'], 1)
+        self.assertEqual(mgr._periodic_stats['_first']['failures'], 0)
+
+    def test_task_errors_are_logged(self):
+        mgr = SlowPeriodicManager()
+        self.assertEqual(mgr.periodic_tasks(self.context), 10)
+        greenthread.sleep(0.05)
+        self.assertFalse('hangs end' in mgr.log)
+        self.assertEqual(mgr._periodic_stats['_hangs']['failures'], 1)
+        self.assertEqual(mgr._periodic_running, {})
+
+    def test_running_task_is_not_waited_for(self):
+        mgr = BusyPeriodicManager()
+        self._run_tasks(mgr)
+        self.assertEqual(sorted(mgr.log), ['busy start', 'quick'])
+
+        # The busy task is still running, the quick one goes on without it
+        mgr.log = []
+        self.now += 10
+        self._run_tasks(mgr)
+        self.assertEqual(mgr.log, ['quick'])
+
+        mgr.release.send()
+        greenthread.sleep(0)
+        mgr.log = []
+        self.now += 10
+        self._run_tasks(mgr)
+        self.assertEqual(sorted(mgr.log), ['busy start', 'quick'])
+        mgr.release.send()
+
+
 class TestWSGIService(test.TestCase):
 
     def setUp(self):
@@ -20,8 +20,10 @@ import os
 from nova import exception
 from nova import flags
 from nova import test
+from nova.tests import fakeguestfs
 from nova import utils
 from nova.virt.disk import api as disk_api
+from nova.virt.disk import vfs
 from nova.virt import driver
 
 from nova.openstack.common import jsonutils
@@ -166,26 +168,178 @@ class TestVirtDiskPaths(test.TestCase):
         self.stubs.Set(utils, 'execute', nonroot_execute)
 
     def test_check_safe_path(self):
-        ret = disk_api._join_and_check_path_within_fs('/foo', 'etc',
-                                                      'something.conf')
+        fs = vfs.VFSLocalFS('/foo')
+        ret = fs._canonical_path('/etc/something.conf')
         self.assertEquals(ret, '/foo/etc/something.conf')
 
     def test_check_unsafe_path(self):
+        fs = vfs.VFSLocalFS('/foo')
         self.assertRaises(exception.Invalid,
-                          disk_api._join_and_check_path_within_fs,
-                          '/foo', 'etc/../../../something.conf')
+                          fs._canonical_path, 'etc/../../../something.conf')
+
+    def test_check_unsafe_symlink(self):
+        with utils.tempdir() as tmpdir:
+            os.symlink('/etc', os.path.join(tmpdir, 'etc'))
+            fs = vfs.VFSLocalFS(tmpdir)
+            self.assertRaises(exception.Invalid,
+                              fs._canonical_path, '/etc/passwd')
 
     def test_inject_files_with_bad_path(self):
         self.assertRaises(exception.Invalid,
                           disk_api._inject_file_into_fs,
-                          '/tmp', '/etc/../../../../etc/passwd',
-                          'hax')
+                          vfs.VFSLocalFS('/tmp'),
+                          '/etc/../../../../etc/passwd', 'hax')
 
     def test_inject_metadata(self):
         with utils.tempdir() as tmpdir:
             meta_objs = [{"key": "foo", "value": "bar"}]
             metadata = {"foo": "bar"}
-            disk_api._inject_metadata_into_fs(meta_objs, tmpdir)
+            disk_api._inject_metadata_into_fs(meta_objs,
+                                              vfs.VFSLocalFS(tmpdir))
             json_file = os.path.join(tmpdir, 'meta.js')
             json_data = jsonutils.loads(open(json_file).read())
             self.assertEqual(metadata, json_data)
+
+    def test_local_file_operations(self):
+        with utils.tempdir() as tmpdir:
+            fs = vfs.VFSLocalFS(tmpdir)
+            fs.make_path('/etc/network')
+            self.assertTrue(fs.has_file('/etc/network'))
+            self.assertFalse(fs.has_file('/etc/motd'))
+
+            fs.replace_file('/etc/motd', 'hello')
+            fs.append_file('/etc/motd', ' world')
+            self.assertEqual(fs.read_file('/etc/motd'), 'hello world')
+
+            fs.set_permissions('/etc/motd', 0751)
+            self.assertEqual(fs.get_permissions('/etc/motd'), 0751)
+
+
+class TestVirtDiskVFS(test.TestCase):
+    def setUp(self):
+        super(TestVirtDiskVFS, self).setUp()
+        self.executes = []
+        self.handles = []
+
+        def fake_execute(*cmd, **kwargs):
+            self.executes.append(cmd)
+            return None, None
+
+        self.guestfs_cls = fakeguestfs.GuestFS
+
+        def fake_guestfs():
+            handle = self.guestfs_cls()
+            self.handles.append(handle)
+            return handle
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.stubs.Set(fakeguestfs, 'GuestFS', fake_guestfs)
+        self.stubs.Set(vfs, 'guestfs', fakeguestfs)
+
+    def test_inject_data_in_process(self):
+        disk_api.inject_data('/tmp/img', key='ssh-rsa AAAA fake',
+                             net='auto eth0', admin_password='secret',
+                             metadata=[{'key': 'foo', 'value': 'bar'}],
+                             files=[('/etc/motd', 'hello')], use_cow=True)
+
+        self.assertEqual(self.executes, [])
+        handle = self.handles[0]
+        self.assertEqual(handle.drives, [('/tmp/img', 'qcow2')])
+        self.assertTrue(handle.closed)
+        self.assertEqual(handle.mounts, [])
+
+        files = handle.files
+        self.assertEqual(files['/root/.ssh']['mode'], 0700)
+        self.assertEqual(files['/root/.ssh']['uid'], 0)
+        self.assertTrue('ssh-rsa AAAA fake' in
+                        files['/root/.ssh/authorized_keys']['content'])
+        self.assertEqual(files['/etc/network']['mode'], 0755)
+        self.assertEqual(files['/etc/network/interfaces']['content'],
+                         'auto eth0')
+        self.assertEqual(jsonutils.loads(files['/meta.js']['content']),
+                         {'foo': 'bar'})
+        self.assertEqual(files['/etc/motd']['content'], 'hello')
+        self.assertFalse('$1$oldpass' in files['/etc/shadow']['content'])
+        self.assertFalse('/etc/rc.local' in files)
+
+    def test_inject_key_sets_up_selinux(self):
+        fs = vfs.VFSGuestFS('/tmp/img')
+        fs.setup()
+        fs.make_path('/etc/selinux')
+        disk_api.inject_data_into_vfs(fs, 'ssh-rsa AAAA fake', None, None,
+                                      None, None)
+        rclocal = self.handles[0].files['/etc/rc.local']
+        fs.teardown()
+
+        self.assertTrue('restorecon' in rclocal['content'])
+        self.assertEqual(rclocal['mode'] & 0111, 0111)
+
+    def test_inject_file_with_bad_path(self):
+        self.assertRaises(exception.Invalid,
+                          disk_api.inject_data, '/tmp/img',
+                          files=[('/etc/../../../etc/passwd', 'hax')])
+        self.assertTrue(self.handles[0].closed)
+
+    def test_inspect_mounts_root_first(self):
+        fs = vfs.VFSGuestFS('/tmp/img', partition=-1)
+        fs.setup()
+        mounts = list(self.handles[0].mounts)
+        fs.teardown()
+
+        self.assertEqual(mounts, [('/', '/dev/guestvgf/lv_root'),
+                                  ('/boot', '/dev/vda1')])
+
+    def test_inject_data_falls_back_to_mount(self):
+        def fake_launch(handle):
+            raise RuntimeError('appliance failed to start')
+
+        self.mounted = False
+
+        def fake_mount(img):
+            self.mounted = True
+            return False
+
+        self.stubs.Set(self.guestfs_cls, 'launch', fake_launch)
+        self.stubs.Set(disk_api._DiskImage, 'mount', fake_mount)
+
+        self.assertRaises(exception.NovaException,
+                          disk_api.inject_data, '/tmp/img', key='key')
+        self.assertTrue(self.handles[0].closed)
+        self.assertTrue(self.mounted)
+
+    def test_inject_data_in_process_disabled(self):
+        self.flags(img_inject_in_process=False)
+        self.stubs.Set(disk_api._DiskImage, 'mount', lambda img: False)
+
+        self.assertRaises(exception.NovaException,
+                          disk_api.inject_data, '/tmp/img', key='key')
+        self.assertEqual(self.handles, [])
+
+    def test_missing_guestfs_is_imported_once(self):
+        imports = []
+
+        def fake_import_module(name):
+            imports.append(name)
+            raise ImportError()
+
+        self.stubs.Set(vfs, 'guestfs', None)
+        self.stubs.Set(vfs, '_guestfs_missing', False)
+        self.stubs.Set(vfs.importutils, 'import_module', fake_import_module)
+        self.assertFalse(vfs.is_available())
+        self.assertFalse(vfs.is_available())
+        self.assertEqual(imports, ['guestfs'])
+
+    def test_can_resize_fs_does_not_launch_appliance(self):
+        self.mounted = False
+
+        def fake_mount(img):
+            self.mounted = True
+            return True
+
+        self.stubs.Set(disk_api, 'get_disk_size', lambda image: 1)
+        self.stubs.Set(disk_api._DiskImage, 'mount', fake_mount)
+        self.stubs.Set(disk_api._DiskImage, 'umount', lambda img: None)
+
+        self.assertTrue(disk_api.can_resize_fs('/tmp/img', 2, use_cow=True))
+        self.assertTrue(self.mounted)
+        self.assertEqual(self.handles, [])
@@ -20,12 +20,14 @@ import sys
 import traceback
 
 from nova.compute.manager import ComputeManager
+from nova.compute import power_state
 from nova import exception
 from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
 from nova import test
 from nova.tests.image import fake as fake_image
 from nova.tests import utils as test_utils
+from nova.virt import event as virtevent
 
 LOG = logging.getLogger(__name__)
 
@@ -404,6 +406,21 @@ class _VirtDriverTestCase(_FakeDriverBackendTestCase):
                           self.connection.get_info,
                           {'name': 'I just made this name up'})
 
+    @catch_notimplementederror
+    def test_get_all_power_states(self):
+        instance_ref, network_info = self._get_running_instance()
+        states = self.connection.get_all_power_states()
+        self.assertEqual(states[instance_ref['name']],
+                         self.connection.get_info(instance_ref)['state'])
+
+    def test_emit_event(self):
+        events = []
+        self.connection.register_event_listener(events.append)
+        event = virtevent.LifecycleEvent('fake-uuid', power_state.RUNNING)
+        self.connection.emit_event(event)
+        self.assertEqual(events, [event])
+        self.assertRaises(ValueError, self.connection.emit_event, 'event')
+
     @catch_notimplementederror
     def test_get_diagnostics(self):
         instance_ref, network_info = self._get_running_instance()
@@ -19,6 +19,7 @@
 import ast
 import contextlib
 import cPickle as pickle
+import errno
 import functools
 import os
 import re
@@ -40,6 +41,7 @@ from nova.tests import fake_network
 from nova.tests import fake_utils
 import nova.tests.image.fake as fake_image
 from nova.tests.xenapi import stubs
+from nova import utils
 from nova.virt.xenapi import agent
 from nova.virt.xenapi import driver as xenapi_conn
 from nova.virt.xenapi import fake as xenapi_fake
@@ -322,6 +324,29 @@ class XenAPIVMTestCase(stubs.XenAPITestBase):
         instances = self.conn.list_instances()
         self.assertEquals(instances, [])
 
+    def test_get_all_power_states(self):
+        instance = self._create_instance()
+        self.mox.StubOutWithMock(self.conn._session, 'get_rec')
+        self.mox.ReplayAll()
+        states = self.conn.get_all_power_states()
+        self.assertEqual(states, {instance['name']: power_state.RUNNING})
+
+    def test_watch_vm_events(self):
+        instance = self._create_instance()
+        vm_ref = vm_utils.lookup(self.conn._session, instance['name'])
+        vm_rec = xenapi_fake.get_record('VM', vm_ref)
+        halted = dict(vm_rec, power_state='Halted',
+                      resident_on='OpaqueRef:NULL')
+        elsewhere = dict(vm_rec, resident_on='OpaqueRef:other-host')
+        self.stubs.Set(self.conn._vmops, '_vm_events',
+                       lambda timeout: [vm_rec, vm_rec, elsewhere, halted])
+
+        events = []
+        self.conn._vmops.watch_vm_events(events.append)
+        self.assertEqual([(e.uuid, e.power_state) for e in events],
+                         [(instance['uuid'], power_state.RUNNING),
+                          (instance['uuid'], power_state.SHUTDOWN)])
+
     def test_get_rrd_server(self):
         self.flags(xenapi_connection_url='myscheme://myaddress/')
         server_info = vm_utils._get_rrd_server()
@@ -1454,6 +1479,43 @@ class XenAPIBWUsageTestCase(stubs.XenAPITestBase):
                                             timeutils.utcnow())
         self.assertEqual(result, [])
 
+    def test_get_all_bw_usage(self):
+        vm_ref = xenapi_fake.create_vm('instance-0001', 'Running',
+                                       other_config={'nova_uuid': '1-2-3'})
+        vif_ref = xenapi_fake._create_object('VIF', {'device': '0',
+                                                     'MAC': 'aa:bb:cc',
+                                                     'VM': vm_ref})
+        vm_rec = xenapi_fake.get_record('VM', vm_ref)
+        vm_rec['VIFs'] = [vif_ref]
+
+        def fake_compile_metrics(start_time, stop_time=None):
+            return {vm_rec['uuid']: {'vif_0_tx': 10.6, 'vif_0_rx': 20.0,
+                                     'cpu0': 0.5},
+                    'not-a-nova-vm': {'cpu0': 0.1}}
+        self.stubs.Set(vm_utils, 'compile_metrics', fake_compile_metrics)
+
+        result = self.conn._vmops.get_all_bw_usage(0)
+        self.assertEqual(result, {'instance-0001': {'aa:bb:cc': {
+            'bw_in': 20, 'bw_out': 10}}})
+
+    def test_parse_rrd_update(self):
+        xml = """<xport><meta><start>100</start><step>5</step>
+<end>115</end><rows>3</rows><columns>2</columns><legend>
+<entry>AVERAGE:vm:vm-uuid:cpu0</entry>
+<entry>AVERAGE:vm:vm-uuid:vif_0_tx</entry>
+</legend></meta><data>
+<row><t>115</t><v>NaN</v><v>4.0</v></row>
+<row><t>110</t><v>0.5</v><v>NaN</v></row>
+<row><t>105</t><v>0.25</v><v>2.0</v></row>
+</data></xport>"""
+
+        data = vm_utils._parse_rrd_update(xml, 100)
+        self.assertEqual(data, {'vm-uuid': {'cpu0': 0.375,
+                                            'vif_0_tx': 25.0}})
+
+        data = vm_utils._parse_rrd_update(xml, 100, until=110)
+        self.assertEqual(data['vm-uuid']['vif_0_tx'], 15.0)
+
 
 # TODO(salvatore-orlando): this class and
 # nova.tests.test_libvirt.IPTablesFirewallDriverTestCase share a lot of code.
@@ -1808,6 +1870,79 @@ class XenAPISRSelectionTestCase(stubs.XenAPITestBase):
                          expected)
 
 
+class XenAPIVHDChainTestCase(stubs.XenAPITestBase):
+    """Unit tests for walking VHD chains from the SR index."""
+    def setUp(self):
+        super(XenAPIVHDChainTestCase, self).setUp()
+        stubs.stubout_session(self.stubs, stubs.FakeSessionForVMTests)
+        self.session = xenapi_conn.XenAPISession('test_url', 'root',
+                                                 'test_pass')
+        self.sr_ref = xenapi_fake.create_sr(name_label='Fake Storage',
+                                            type='ext')
+        self.base_ref = self._create_vdi('base')
+        self.parent_ref = self._create_vdi('parent', self.base_ref)
+        self.leaf_ref = self._create_vdi('leaf', self.parent_ref)
+
+        self.calls = []
+        orig_call_xenapi = self.session.call_xenapi
+
+        def fake_call_xenapi(method, *args):
+            self.calls.append(method)
+            return orig_call_xenapi(method, *args)
+        self.stubs.Set(self.session, 'call_xenapi', fake_call_xenapi)
+
+    def _create_vdi(self, name_label, parent_ref=None):
+        sm_config = {}
+        if parent_ref:
+            sm_config['vhd-parent'] = self._uuid(parent_ref)
+        return xenapi_fake.create_vdi(name_label, self.sr_ref,
+                                      sm_config=sm_config)
+
+    def _uuid(self, vdi_ref):
+        return xenapi_fake.get_record('VDI', vdi_ref)['uuid']
+
+    def test_walk_vdi_chain(self):
+        chain = [rec['name_label'] for rec in
+                 vm_utils._walk_vdi_chain(self.session,
+                                          self._uuid(self.leaf_ref))]
+        self.assertEqual(chain, ['leaf', 'parent', 'base'])
+        self.assertEqual(self.calls.count('VDI.get_all_records_where'), 1)
+        self.assertFalse('VDI.get_record' in self.calls)
+
+    def test_child_vhds(self):
+        sibling_ref = self._create_vdi('sibling', self.parent_ref)
+        children = vm_utils._child_vhds(self.session, self.sr_ref,
+                                        self._uuid(self.parent_ref))
+        self.assertEqual(children, set([self._uuid(self.leaf_ref),
+                                        self._uuid(sibling_ref)]))
+
+    def test_wait_for_vhd_coalesce(self):
+        parent_uuid, base_uuid = vm_utils._wait_for_vhd_coalesce(
+                self.session, None, self.sr_ref, self.leaf_ref,
+                self._uuid(self.parent_ref))
+        self.assertEqual(parent_uuid, self._uuid(self.parent_ref))
+        self.assertEqual(base_uuid, self._uuid(self.base_ref))
+        self.assertFalse('VDI.get_record' in self.calls)
+
+    def test_wait_for_vhd_coalesce_with_sibling(self):
+        self._create_vdi('sibling', self.base_ref)
+        self.flags(xenapi_vhd_coalesce_max_attempts=0)
+        parent_uuid, base_uuid = vm_utils._wait_for_vhd_coalesce(
+                self.session, None, self.sr_ref, self.leaf_ref,
+                self._uuid(self.base_ref))
+        self.assertEqual(parent_uuid, self._uuid(self.parent_ref))
+        self.assertEqual(base_uuid, self._uuid(self.base_ref))
+
+    def test_wait_for_vhd_coalesce_gives_up(self):
+        self.flags(xenapi_vhd_coalesce_max_attempts=2,
+                   xenapi_vhd_coalesce_poll_interval=0)
+        self.assertRaises(exception.NovaException,
+                          vm_utils._wait_for_vhd_coalesce,
+                          self.session, None, self.sr_ref, self.leaf_ref,
+                          self._uuid(self.base_ref))
+        self.assertEqual(self.calls.count('VDI.get_all_records_where'), 3)
+
+
 def _create_service_entries(context, values={'avail_zone1': ['fake_host1',
                                                          'fake_host2'],
                                          'avail_zone2': ['fake_host3'], }):
@@ -2106,6 +2241,52 @@ class VmUtilsTestCase(test.TestCase):
         self.assertEquals(expected, actual)
 
 
+class SparseCopyTestCase(test.TestCase):
+    """Unit tests for vm_utils._sparse_copy."""
+
+    def _copy(self, src_data, virtual_size, block_size):
+        with utils.tempdir() as tmpdir:
+            src_path = os.path.join(tmpdir, 'src')
+            dst_path = os.path.join(tmpdir, 'dst')
+            with open(src_path, 'wb') as f:
+                f.write(src_data)
+            # The destination is a device, so unwritten blocks read as zero.
+            with open(dst_path, 'wb') as f:
+                f.truncate(virtual_size)
+
+            vm_utils._sparse_copy(src_path, dst_path, virtual_size,
+                                  block_size=block_size)
+
+            with open(dst_path, 'rb') as f:
+                return f.read()
+
+    def test_sparse_copy(self):
+        src_data = ('a' * 10 + '\0' * 30 + 'b' * 5 + '\0' * 20 +
+                    'c' * 7 + 'd' * 8)
+        self.assertEqual(self._copy(src_data, 80, 10), src_data[:80])
+
+    def test_sparse_copy_skips_zero_blocks(self):
+        written = []
+        orig_write_all = vm_utils._write_all
+
+        def fake_write_all(fd, data):
+            written.append(data)
+            orig_write_all(fd, data)
+        self.stubs.Set(vm_utils, '_write_all', fake_write_all)
+
+        src_data = 'a' * 8 + '\0' * 16 + 'b' * 8
+        self.assertEqual(self._copy(src_data, 32, 8), src_data)
+        self.assertEqual(written, ['a' * 8, 'b' * 8])
+
+    def test_data_extents_whole_file_without_seek_data(self):
+        def fake_lseek(fd, offset, whence):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        self.stubs.Set(os, 'lseek', fake_lseek)
+        self.stubs.Set(vm_utils.sys, 'platform', 'linux2')
+        self.assertEqual(list(vm_utils._data_extents(None, 100)),
+                         [(0, 100)])
+
+
 class XenAPILiveMigrateTestCase(stubs.XenAPITestBase):
     """Unit tests for live_migration."""
     def setUp(self):
@@ -56,6 +56,7 @@ from nova.openstack.common import excutils
 from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
 from nova.openstack.common import timeutils
+from nova.rootwrap import client as rootwrap_client
 
 
 LOG = logging.getLogger(__name__)
@@ -114,6 +115,18 @@ def vpn_ping(address, port, timeout=0.05, session_id=None):
         return server_sess
 
 
+_ROOTWRAP_CLIENTS = {}
+
+
+def _get_rootwrap_client():
+    """Returns the rootwrap daemon client for the configured rootwrap
+    config, so that a single daemon serves the whole process."""
+    config = FLAGS.rootwrap_config
+    if config not in _ROOTWRAP_CLIENTS:
+        _ROOTWRAP_CLIENTS[config] = rootwrap_client.Client(config)
+    return _ROOTWRAP_CLIENTS[config]
+
+
 def execute(*cmd, **kwargs):
     """Helper method to execute command with optional retry.
 
@@ -132,7 +145,8 @@ def execute(*cmd, **kwargs):
     :param attempts:           How many times to retry cmd.
     :param run_as_root:        True | False. Defaults to False. If set to True,
                                the command is prefixed by the command specified
-                               in the root_helper FLAG.
+                               in the root_helper FLAG, or sent to the
+                               rootwrap daemon if use_rootwrap_daemon is set.
 
     :raises exception.NovaException: on receiving unknown arguments
     :raises exception.ProcessExecutionError:
@@ -157,6 +171,7 @@ def execute(*cmd, **kwargs):
         raise exception.NovaException(_('Got unknown keyword args '
                                         'to utils.execute: %r') % kwargs)
 
+    use_daemon = False
     if run_as_root:
 
         if FLAGS.rootwrap_config is None or FLAGS.root_helper != 'sudo':
@@ -166,7 +181,10 @@ def execute(*cmd, **kwargs):
                               'You should use the rootwrap_config option '
                               'instead.'))
 
-        if (FLAGS.rootwrap_config is not None):
+        if (FLAGS.rootwrap_config is not None and FLAGS.use_rootwrap_daemon
+            and not shell):
+            use_daemon = True
+        elif (FLAGS.rootwrap_config is not None):
             cmd = ['sudo', 'nova-rootwrap', FLAGS.rootwrap_config] + list(cmd)
         else:
             cmd = shlex.split(FLAGS.root_helper) + list(cmd)
@@ -175,21 +193,37 @@ def execute(*cmd, **kwargs):
     while attempts > 0:
         attempts -= 1
         try:
-            LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
-            _PIPE = subprocess.PIPE  # pylint: disable=E1101
-            obj = subprocess.Popen(cmd,
-                                   stdin=_PIPE,
-                                   stdout=_PIPE,
-                                   stderr=_PIPE,
-                                   close_fds=True,
-                                   shell=shell)
-            result = None
-            if process_input is not None:
-                result = obj.communicate(process_input)
+            if use_daemon:
+                LOG.debug(_('Running cmd (rootwrap daemon): %s'),
+                          ' '.join(cmd))
+                try:
+                    _returncode, stdout, stderr = \
+                            _get_rootwrap_client().execute(cmd, process_input)
+                except exception.ProcessExecutionError:
+                    raise
+                except (EOFError, EnvironmentError, ValueError), e:
+                    raise exception.ProcessExecutionError(
+                            stderr=str(e),
+                            cmd=' '.join(cmd),
+                            description=_('Could not run command through '
+                                          'the rootwrap daemon.'))
+                result = (stdout, stderr)
             else:
-                result = obj.communicate()
-            obj.stdin.close()  # pylint: disable=E1101
-            _returncode = obj.returncode  # pylint: disable=E1101
+                LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
+                _PIPE = subprocess.PIPE  # pylint: disable=E1101
+                obj = subprocess.Popen(cmd,
+                                       stdin=_PIPE,
+                                       stdout=_PIPE,
+                                       stderr=_PIPE,
+                                       close_fds=True,
+                                       shell=shell)
+                result = None
+                if process_input is not None:
+                    result = obj.communicate(process_input)
+                else:
+                    result = obj.communicate()
+                obj.stdin.close()  # pylint: disable=E1101
+                _returncode = obj.returncode  # pylint: disable=E1101
             if _returncode:
                 LOG.debug(_('Result was %s') % _returncode)
                 if not ignore_exit_code and _returncode not in check_exit_code:
@@ -562,6 +596,49 @@ class LoopingCall(object):
         return self.done.wait()
 
 
+class DynamicLoopingCall(LoopingCall):
+    """A looping call which sleeps as long as its function asks for.
+
+    The function returns how many seconds to wait before calling it
+    again, or None to wait periodic_interval_max seconds.
+    """
+
+    def start(self, initial_delay=None, periodic_interval_max=None):
+        self._running = True
+        done = event.Event()
+
+        def _inner():
+            if initial_delay:
+                greenthread.sleep(initial_delay)
+
+            try:
+                while self._running:
+                    idle = self.f(*self.args, **self.kw)
+                    if not self._running:
+                        break
+                    if idle is None:
+                        idle = periodic_interval_max
+                    elif periodic_interval_max is not None:
+                        idle = min(idle, periodic_interval_max)
+                    LOG.debug(_('Dynamic looping call sleeping for %.02f '
+                                'seconds'), idle)
+                    greenthread.sleep(idle)
+            except LoopingCallDone, e:
+                self.stop()
+                done.send(e.retvalue)
+            except Exception:
+                LOG.exception(_('in dynamic looping call'))
+                done.send_exception(*sys.exc_info())
+                return
+            else:
+                done.send(True)
+
+        self.done = done
+
+        greenthread.spawn(_inner)
+        return self.done
+
+
 def xhtml_escape(value):
     """Escapes a string so it is valid within XML or XHTML.
 
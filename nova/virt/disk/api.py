@@ -39,6 +39,7 @@ from nova import utils
 from nova.virt.disk import guestfs
 from nova.virt.disk import loop
 from nova.virt.disk import nbd
+from nova.virt.disk import vfs
 from nova.virt import images
 
 
@@ -51,6 +52,11 @@ disk_opts = [
     cfg.ListOpt('img_handlers',
                 default=['loop', 'nbd', 'guestfs'],
                 help='Order of methods used to mount disk images'),
+    cfg.BoolOpt('img_inject_in_process',
+                default=True,
+                help='Inject data by editing the image in process with '
+                     'libguestfs, when its python bindings are installed, '
+                     'before falling back to mounting it'),
 
     # NOTE(yamahata): ListOpt won't work because the command may include a
     #                 comma. For example:
@@ -110,6 +116,10 @@ def get_disk_size(path):
     :returns: Size (in bytes) of the given disk image as it would be seen
               by a virtual machine.
     """
+    header = images.read_image_header(path)
+    if header is not None:
+        return header['virtual_size']
+
     size = images.qemu_img_info(path)['virtual size']
     size = size.split('(')[1].split()[0]
     return int(size)
@@ -135,9 +145,13 @@ def can_resize_fs(image, size, use_cow=False):
 
     # Check the image is unpartitioned
     if use_cow:
-        # Try to mount an unpartitioned qcow2 image
+        # Try to mount an unpartitioned qcow2 image. Nothing is written,
+        # so don't pay for a libguestfs appliance launch here.
         try:
-            inject_data(image, use_cow=True)
+            img = _DiskImage(image=image, use_cow=True)
+            if not img.mount():
+                return False
+            img.umount()
         except exception.NovaException:
             return False
     else:
@@ -297,7 +311,25 @@ def inject_data(image,
 
     If partition is not specified it mounts the image as a single partition.
 
+    When the libguestfs python bindings are installed the image is edited
+    in process instead, and only mounted if libguestfs can't open it.
+
     """
+    if FLAGS.img_inject_in_process and vfs.is_available():
+        fs = vfs.VFSGuestFS(image, partition=partition, use_cow=use_cow)
+        try:
+            fs.setup()
+        except exception.NovaException, e:
+            LOG.debug(_('Falling back to mounting %(image)s: %(e)s') %
+                      locals())
+        else:
+            try:
+                inject_data_into_vfs(fs, key, net, metadata,
+                                     admin_password, files)
+            finally:
+                fs.teardown()
+            return
+
     img = _DiskImage(image=image, partition=partition, use_cow=use_cow)
     if img.mount():
         try:
@@ -342,6 +374,12 @@ def inject_data_into_fs(fs, key, net, metadata, admin_password, files):
     Virt connections can call this directly if they mount their fs
     in a different way to inject_data
     """
+    inject_data_into_vfs(vfs.VFSLocalFS(fs), key, net, metadata,
+                         admin_password, files)
+
+
+def inject_data_into_vfs(fs, key, net, metadata, admin_password, files):
+    """Injects data through a vfs.VFS already set up by the caller."""
     if key:
         _inject_key_into_fs(key, fs)
     if net:
@@ -355,36 +393,13 @@ def inject_data_into_fs(fs, key, net, metadata, admin_password, files):
             _inject_file_into_fs(fs, path, contents)
 
 
-def _join_and_check_path_within_fs(fs, *args):
-    '''os.path.join() with safety check for injected file paths.
-
-    Join the supplied path components and make sure that the
-    resulting path we are injecting into is within the
-    mounted guest fs.  Trying to be clever and specifying a
-    path with '..' in it will hit this safeguard.
-    '''
-    absolute_path, _err = utils.execute('readlink', '-nm',
-                                        os.path.join(fs, *args),
-                                        run_as_root=True)
-    if not absolute_path.startswith(os.path.realpath(fs) + '/'):
-        raise exception.Invalid(_('injected file path not valid'))
-    return absolute_path
-
-
 def _inject_file_into_fs(fs, path, contents, append=False):
-    absolute_path = _join_and_check_path_within_fs(fs, path.lstrip('/'))
-
-    parent_dir = os.path.dirname(absolute_path)
-    utils.execute('mkdir', '-p', parent_dir, run_as_root=True)
-
-    args = []
+    path = vfs.guest_path(path)
+    fs.make_path(os.path.dirname(path))
     if append:
-        args.append('-a')
-    args.append(absolute_path)
-
-    kwargs = dict(process_input=contents, run_as_root=True)
-
-    utils.execute('tee', *args, **kwargs)
+        fs.append_file(path, contents)
+    else:
+        fs.replace_file(path, contents)
 
 
 def _inject_metadata_into_fs(metadata, fs):
@@ -394,20 +409,13 @@ def _inject_metadata_into_fs(metadata, fs):
 
 def _setup_selinux_for_keys(fs):
     """Get selinux guests to ensure correct context on injected keys."""
-
-    se_cfg = _join_and_check_path_within_fs(fs, 'etc', 'selinux')
-    se_cfg, _err = utils.trycmd('readlink', '-e', se_cfg, run_as_root=True)
-    if not se_cfg:
+    if not fs.has_file('/etc/selinux'):
         return
 
-    rclocal = _join_and_check_path_within_fs(fs, 'etc', 'rc.local')
-
+    rclocal = '/etc/rc.local'
     # Support systemd based systems
-    rc_d = _join_and_check_path_within_fs(fs, 'etc', 'rc.d')
-    rclocal_e, _err = utils.trycmd('readlink', '-e', rclocal, run_as_root=True)
-    rc_d_e, _err = utils.trycmd('readlink', '-e', rc_d, run_as_root=True)
-    if not rclocal_e and rc_d_e:
-        rclocal = os.path.join(rc_d, 'rc.local')
+    if not fs.has_file(rclocal) and fs.has_file('/etc/rc.d'):
+        rclocal = '/etc/rc.d/rc.local'
 
     # Note some systems end rc.local with "exit 0"
     # and so to append there you'd need something like:
@@ -418,23 +426,20 @@ def _setup_selinux_for_keys(fs):
         'restorecon -RF /root/.ssh/ 2>/dev/null || :\n',
     ]
 
-    rclocal_rel = os.path.relpath(rclocal, fs)
-    _inject_file_into_fs(fs, rclocal_rel, ''.join(restorecon), append=True)
-    utils.execute('chmod', 'a+x', rclocal, run_as_root=True)
+    _inject_file_into_fs(fs, rclocal, ''.join(restorecon), append=True)
+    fs.set_permissions(rclocal, fs.get_permissions(rclocal) | 0111)
 
 
 def _inject_key_into_fs(key, fs):
     """Add the given public ssh key to root's authorized_keys.
 
     key is an ssh key string.
-    fs is the path to the base of the filesystem into which to inject the key.
+    fs is the vfs.VFS of the filesystem into which to inject the key.
     """
-    sshdir = _join_and_check_path_within_fs(fs, 'root', '.ssh')
-    utils.execute('mkdir', '-p', sshdir, run_as_root=True)
-    utils.execute('chown', 'root', sshdir, run_as_root=True)
-    utils.execute('chmod', '700', sshdir, run_as_root=True)
-
-    keyfile = os.path.join('root', '.ssh', 'authorized_keys')
+    sshdir = '/root/.ssh'
+    fs.make_path(sshdir)
+    fs.set_ownership(sshdir, 0, 0)
+    fs.set_permissions(sshdir, 0700)
 
     key_data = ''.join([
         '\n',
@@ -444,31 +449,30 @@ def _inject_key_into_fs(key, fs):
         '\n',
     ])
 
-    _inject_file_into_fs(fs, keyfile, key_data, append=True)
+    _inject_file_into_fs(fs, os.path.join(sshdir, 'authorized_keys'),
+                         key_data, append=True)
 
     _setup_selinux_for_keys(fs)
 
 
 def _inject_net_into_fs(net, fs):
-    """Inject /etc/network/interfaces into the filesystem rooted at fs.
+    """Inject /etc/network/interfaces into the filesystem of fs.
 
     net is the contents of /etc/network/interfaces.
     """
-    netdir = _join_and_check_path_within_fs(fs, 'etc', 'network')
-    utils.execute('mkdir', '-p', netdir, run_as_root=True)
-    utils.execute('chown', 'root:root', netdir, run_as_root=True)
-    utils.execute('chmod', 755, netdir, run_as_root=True)
+    netdir = '/etc/network'
+    fs.make_path(netdir)
+    fs.set_ownership(netdir, 0, 0)
+    fs.set_permissions(netdir, 0755)
 
-    netfile = os.path.join('etc', 'network', 'interfaces')
-    _inject_file_into_fs(fs, netfile, net)
+    _inject_file_into_fs(fs, os.path.join(netdir, 'interfaces'), net)
 
 
 def _inject_admin_password_into_fs(admin_passwd, fs):
     """Set the root password to admin_passwd
 
     admin_password is a root password
-    fs is the path to the base of the filesystem into which to inject
-    the key.
+    fs is the vfs.VFS of the filesystem into which to inject the key.
 
     This method modifies the instance filesystem directly,
     and does not require a guest agent running in the instance.
@@ -480,21 +484,18 @@ def _inject_admin_password_into_fs(admin_passwd, fs):
 
     admin_user = 'root'
 
-    fd, tmp_passwd = tempfile.mkstemp()
-    os.close(fd)
-    fd, tmp_shadow = tempfile.mkstemp()
-    os.close(fd)
-
-    passwd_path = _join_and_check_path_within_fs(fs, 'etc', 'passwd')
-    shadow_path = _join_and_check_path_within_fs(fs, 'etc', 'shadow')
-
-    utils.execute('cp', passwd_path, tmp_passwd, run_as_root=True)
-    utils.execute('cp', shadow_path, tmp_shadow, run_as_root=True)
-    _set_passwd(admin_user, admin_passwd, tmp_passwd, tmp_shadow)
-    utils.execute('cp', tmp_passwd, passwd_path, run_as_root=True)
-    os.unlink(tmp_passwd)
-    utils.execute('cp', tmp_shadow, shadow_path, run_as_root=True)
-    os.unlink(tmp_shadow)
+    with utils.tempdir() as tmpdir:
+        tmp_passwd = os.path.join(tmpdir, 'passwd')
+        tmp_shadow = os.path.join(tmpdir, 'shadow')
+        with open(tmp_passwd, 'wb') as passwd_file:
+            passwd_file.write(fs.read_file('/etc/passwd'))
+        with open(tmp_shadow, 'wb') as shadow_file:
+            shadow_file.write(fs.read_file('/etc/shadow'))
+
+        _set_passwd(admin_user, admin_passwd, tmp_passwd, tmp_shadow)
+
+        with open(tmp_shadow, 'rb') as shadow_file:
+            fs.replace_file('/etc/shadow', shadow_file.read())
 
 
 def _set_passwd(username, admin_passwd, passwd_file, shadow_file):
@@ -0,0 +1,259 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Access to the file system inside a disk image
+
+VFSGuestFS opens the image in process through the libguestfs python
+bindings, so no block device, mount point or root command is needed to
+change a few files in it. VFSLocalFS offers the same operations on a
+file system the caller has already mounted on the host.
+"""
+
+import os
+import posixpath
+
+from eventlet import tpool
+
+from nova import exception
+from nova.openstack.common import excutils
+from nova.openstack.common import importutils
+from nova.openstack.common import log as logging
+from nova import utils
+
+LOG = logging.getLogger(__name__)
+
+guestfs = None
+_guestfs_missing = False
+
+
+def is_available():
+    """Returns True if the libguestfs python bindings can be loaded.
+
+    The import is only tried once.
+    """
+    global guestfs, _guestfs_missing
+    if guestfs is None and not _guestfs_missing:
+        try:
+            guestfs = importutils.import_module('guestfs')
+        except ImportError:
+            _guestfs_missing = True
+    return guestfs is not None
+
+
+def guest_path(*args):
+    """Joins path components into an absolute path within the guest.
+
+    Paths trying to climb above the guest root with '..' are refused.
+    """
+    path = posixpath.normpath(posixpath.join(*args).lstrip('/'))
+    if path == '..' or path.startswith('../'):
+        raise exception.Invalid(_('injected file path not valid'))
+    return posixpath.join('/', path)
+
+
+class VFS(object):
+    """File operations on the file system of a guest.
+
+    Paths are absolute paths within the guest.
+    """
+
+    def setup(self):
+        """Makes the file system ready for the other operations."""
+        pass
+
+    def teardown(self):
+        """Releases whatever setup acquired."""
+        pass
+
+    def make_path(self, path):
+        raise NotImplementedError()
+
+    def has_file(self, path):
+        raise NotImplementedError()
+
+    def read_file(self, path):
+        raise NotImplementedError()
+
+    def replace_file(self, path, content):
+        raise NotImplementedError()
+
+    def append_file(self, path, content):
+        raise NotImplementedError()
+
+    def get_permissions(self, path):
+        raise NotImplementedError()
+
+    def set_permissions(self, path, mode):
+        raise NotImplementedError()
+
+    def set_ownership(self, path, uid, gid):
+        raise NotImplementedError()
+
+
+class VFSGuestFS(VFS):
+    """File operations on the file system inside a disk image."""
+
+    def __init__(self, image, partition=None, use_cow=False):
+        self.image = image
+        self.partition = partition
+        self.imgfmt = use_cow and 'qcow2' or 'raw'
+        self.handle = None
+
+    def _mount_root(self):
+        if self.partition == -1:
+            roots = self.handle.inspect_os()
+            if len(roots) != 1:
+                raise exception.NovaException(
+                        _('Found %(count)d operating systems in %(image)s, '
+                          'expected one') %
+                        {'count': len(roots), 'image': self.image})
+            mounts = sorted(self.handle.inspect_get_mountpoints(roots[0]),
+                            key=lambda mount: len(mount[0]))
+            for mountpoint, device in mounts:
+                self.handle.mount_options('', device, mountpoint)
+        elif self.partition:
+            self.handle.mount_options('', '/dev/sda%d' % self.partition, '/')
+        else:
+            self.handle.mount_options('', '/dev/sda', '/')
+
+    def setup(self):
+        """Opens the image and mounts its file system in the appliance."""
+        if not is_available():
+            raise exception.NovaException(
+                    _('libguestfs python bindings are not installed'))
+
+        LOG.debug(_('Opening %(image)s with libguestfs'),
+                  {'image': self.image})
+        # Launching the appliance and every call after that block, so run
+        # them in a native thread rather than stall other greenthreads
+        self.handle = tpool.Proxy(guestfs.GuestFS())
+        try:
+            self.handle.add_drive_opts(self.image, format=self.imgfmt)
+            self.handle.launch()
+            self._mount_root()
+        except RuntimeError, e:
+            self.teardown()
+            raise exception.NovaException(
+                    _('Error mounting %(image)s with libguestfs: %(e)s') %
+                    {'image': self.image, 'e': e})
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.teardown()
+
+    def teardown(self):
+        """Flushes changes to the image and closes it."""
+        if self.handle is None:
+            return
+        try:
+            self.handle.umount_all()
+            self.handle.sync()
+        except RuntimeError, e:
+            LOG.warning(_('Failed to unmount %(image)s: %(e)s') %
+                        {'image': self.image, 'e': e})
+        finally:
+            try:
+                self.handle.close()
+            except AttributeError:
+                # Bindings before libguestfs 1.19.33 close on deletion
+                pass
+            self.handle = None
+
+    def make_path(self, path):
+        self.handle.mkdir_p(path)
+
+    def has_file(self, path):
+        return bool(self.handle.exists(path))
+
+    def read_file(self, path):
+        return self.handle.read_file(path)
+
+    def replace_file(self, path, content):
+        self.handle.write(path, content)
+
+    def append_file(self, path, content):
+        self.handle.write_append(path, content)
+
+    def get_permissions(self, path):
+        return self.handle.stat(path)['mode'] & 07777
+
+    def set_permissions(self, path, mode):
+        self.handle.chmod(mode, path)
+
+    def set_ownership(self, path, uid, gid):
+        self.handle.chown(uid, gid, path)
+
+
+class VFSLocalFS(VFS):
+    """File operations on a guest file system mounted on the host.
+
+    Every path is resolved on the host first, so that neither '..' nor
+    a symlink in the guest can lead outside of the mount point.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _canonical_path(self, path):
+        canonpath, _err = utils.execute(
+                'readlink', '-nm',
+                os.path.join(self.root, guest_path(path).lstrip('/')),
+                run_as_root=True)
+        root = os.path.realpath(self.root)
+        if canonpath != root and not canonpath.startswith(root + '/'):
+            raise exception.Invalid(_('injected file path not valid'))
+        return canonpath
+
+    def make_path(self, path):
+        utils.execute('mkdir', '-p', self._canonical_path(path),
+                      run_as_root=True)
+
+    def has_file(self, path):
+        canonpath, _err = utils.trycmd('readlink', '-e',
+                                       self._canonical_path(path),
+                                       run_as_root=True)
+        return bool(canonpath)
+
+    def read_file(self, path):
+        # Copy into a file we own, as the guest file may not be readable
+        # by us and a file created by the copy would be owned by root
+        with utils.tempdir() as tmpdir:
+            tmp_path = os.path.join(tmpdir, 'file')
+            open(tmp_path, 'wb').close()
+            utils.execute('cp', self._canonical_path(path), tmp_path,
+                          run_as_root=True)
+            with open(tmp_path, 'rb') as tmp_file:
+                return tmp_file.read()
+
+    def replace_file(self, path, content):
+        utils.execute('tee', self._canonical_path(path),
+                      process_input=content, run_as_root=True)
+
+    def append_file(self, path, content):
+        utils.execute('tee', '-a', self._canonical_path(path),
+                      process_input=content, run_as_root=True)
+
+    def get_permissions(self, path):
+        mode, _err = utils.execute('stat', '-c', '%a',
+                                   self._canonical_path(path),
+                                   run_as_root=True)
+        return int(mode.strip(), 8)
+
+    def set_permissions(self, path, mode):
+        utils.execute('chmod', '%o' % mode, self._canonical_path(path),
+                      run_as_root=True)
+
+    def set_ownership(self, path, uid, gid):
+        utils.execute('chown', '%d:%d' % (uid, gid),
+                      self._canonical_path(path), run_as_root=True)
@@ -25,6 +25,7 @@ Driver base-classes:
 from nova.compute import power_state
 from nova import flags
 from nova.openstack.common import log as logging
+from nova.virt import event as virtevent
 
 
 LOG = logging.getLogger(__name__)
@@ -89,6 +90,8 @@ class ComputeDriver(object):
 
     """
 
+    _compute_event_callback = None
+
     def init_host(self, host):
         """Initialize anything that is necessary for the driver to function,
         including catching up with currently running VM's on the given host."""
@@ -109,6 +112,40 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def get_all_power_states(self):
+        """Return the power state of every instance on the hypervisor.
+
+        Returns a dict mapping instance names to power_state codes, so
+        callers that need the state of many instances can get them with
+        one call instead of calling get_info() per instance.
+        """
+        raise NotImplementedError()
+
+    def register_event_listener(self, callback):
+        """Register a callback to receive events.
+
+        The callback is invoked with a nova.virt.event.Event for every
+        change the driver notices on the hypervisor. Drivers which cannot
+        watch their hypervisor simply never emit anything.
+        """
+        self._compute_event_callback = callback
+
+    def emit_event(self, event):
+        """Dispatches an event to the registered listener, if any."""
+        if not self._compute_event_callback:
+            LOG.debug(_("Discarding event %s"), event)
+            return
+
+        if not isinstance(event, virtevent.Event):
+            raise ValueError(_("Event must be an instance of "
+                               "nova.virt.event.Event"))
+
+        try:
+            LOG.debug(_("Emitting event %s"), event)
+            self._compute_event_callback(event)
+        except Exception:
+            LOG.exception(_("Exception dispatching event %s"), event)
+
     def get_num_instances(self):
         """Return the total number of virtual machines.
 
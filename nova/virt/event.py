@@ -0,0 +1,64 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Asynchronous event notifications from virtualization drivers.
+
+Drivers which can watch their hypervisor for changes emit these events
+through ComputeDriver.emit_event() so the compute manager can react to a
+change as it happens instead of waiting for the next periodic poll.
+"""
+
+import time
+
+
+class Event(object):
+    """Base class for all events emitted by a hypervisor."""
+
+    def __init__(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.timestamp)
+
+
+class InstanceEvent(Event):
+    """Base class for events about a single instance."""
+
+    def __init__(self, uuid, timestamp=None):
+        super(InstanceEvent, self).__init__(timestamp)
+        self.uuid = uuid
+
+    def __repr__(self):
+        return "<%s: %s, %s>" % (self.__class__.__name__, self.timestamp,
+                                 self.uuid)
+
+
+class LifecycleEvent(InstanceEvent):
+    """Reports that an instance's power state has changed.
+
+    :param uuid: the uuid of the instance
+    :param power_state: the new power_state code of the instance
+    """
+
+    def __init__(self, uuid, power_state, timestamp=None):
+        super(LifecycleEvent, self).__init__(uuid, timestamp)
+        self.power_state = power_state
+
+    def __repr__(self):
+        return "<%s: %s, %s => %s>" % (self.__class__.__name__,
+                                       self.timestamp, self.uuid,
+                                       self.power_state)
@@ -31,6 +31,7 @@ from nova import exception
 from nova.openstack.common import log as logging
 from nova import utils
 from nova.virt import driver
+from nova.virt import event as virtevent
 
 
 LOG = logging.getLogger(__name__)
@@ -180,6 +181,9 @@ class FakeDriver(driver.ComputeDriver):
                 'num_cpu': 2,
                 'cpu_time': 0}
 
+    def get_all_power_states(self):
+        return dict((name, i.state) for name, i in self.instances.items())
+
     def get_diagnostics(self, instance_name):
         return 'FAKE_DIAGNOSTICS'
 
@@ -283,6 +287,12 @@ class FakeDriver(driver.ComputeDriver):
         """ Removes the named VM, as if it crashed. For testing"""
         self.instances.pop(instance_name)
 
+    def test_set_power_state(self, instance, state):
+        """Changes the power state of a VM behind nova's back, emitting a
+        lifecycle event like a real hypervisor would. For testing"""
+        self.instances[instance['name']].state = state
+        self.emit_event(virtevent.LifecycleEvent(instance['uuid'], state))
+
     def update_host_status(self):
         """Return fake Host Status of ram, disk, network."""
         return self.host_status
@@ -22,6 +22,7 @@ Handling of VM disk images.
 """
 
 import os
+import struct
 
 from nova import exception
 from nova import flags
@@ -60,6 +61,85 @@ def qemu_img_info(path):
     return data
 
 
+QCOW2_MAGIC = 'QFI\xfb'
+
+# magic, version, backing_file_offset, backing_file_size, cluster_bits, size
+_QCOW2_HEADER = struct.Struct('>4sIQIIQ')
+
+# Leading bytes of the other formats qemu-img can probe. Anything else is
+# what qemu-img itself would call raw.
+_OTHER_FORMAT_MAGICS = ('QED\x00', 'KDMV', 'COWD', '# Disk DescriptorFile',
+                        'conectix', 'OOOM', 'Bochs Virtual HD Image',
+                        'WithoutFreeSpace', '#!/bin/sh\n#V2.0 Format',
+                        '<<< ')
+
+_MAX_HEADER_CACHE = 1024
+
+# path -> (mtime, size, header info)
+_header_cache = {}
+
+
+def _parse_image_header(path, st_size):
+    with open(path, 'rb') as f:
+        header = f.read(_QCOW2_HEADER.size)
+        if not header.startswith(QCOW2_MAGIC):
+            for magic in _OTHER_FORMAT_MAGICS:
+                if header.startswith(magic):
+                    return None
+            return {'format': 'raw',
+                    'virtual_size': st_size,
+                    'backing_file': None,
+                    'cluster_size': None}
+
+        if len(header) < _QCOW2_HEADER.size:
+            return None
+        (_magic, version, backing_offset, backing_size,
+         cluster_bits, size) = _QCOW2_HEADER.unpack(header)
+        if version < 2:
+            # Leave the original qcow format to qemu-img
+            return None
+
+        backing_file = None
+        if backing_offset and backing_size:
+            f.seek(backing_offset)
+            backing_file = f.read(backing_size)
+
+    return {'format': 'qcow2',
+            'virtual_size': size,
+            'backing_file': backing_file,
+            'cluster_size': 1 << cluster_bits}
+
+
+def read_image_header(path):
+    """Return the format, virtual size, backing file and cluster size of a
+    disk image, read directly from its header.
+
+    Returns None when the image could not be understood without qemu-img,
+    in which case qemu_img_info() should be used instead. Results are
+    cached until the file's mtime or size changes.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        _header_cache.pop(path, None)
+        return None
+
+    cached = _header_cache.get(path)
+    if cached and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+
+    try:
+        info = _parse_image_header(path, st.st_size)
+    except (IOError, struct.error):
+        info = None
+
+    if info is not None:
+        if len(_header_cache) >= _MAX_HEADER_CACHE:
+            _header_cache.clear()
+        _header_cache[path] = (st.st_mtime, st.st_size, info)
+    return info
+
+
 def fetch(context, image_href, path, _user_id, _project_id):
     # TODO(vish): Improve context handling and add owner and auth data
     #             when it is added to glance.  Right now there is no
@@ -45,12 +45,17 @@ import glob
 import hashlib
 import multiprocessing
 import os
+import re
 import shutil
 import sys
 import tempfile
+import time
 import uuid
 
+from eventlet import greenio
+from eventlet import greenpool
 from eventlet import greenthread
+from eventlet import patcher
 from eventlet import tpool
 from lxml import etree
 from xml.dom import minidom
@@ -74,6 +79,7 @@ from nova import utils
 from nova.virt import configdrive
 from nova.virt.disk import api as disk
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova.virt.libvirt import config
 from nova.virt.libvirt import firewall
 from nova.virt.libvirt import imagebackend
@@ -81,6 +87,9 @@ from nova.virt.libvirt import imagecache
 from nova.virt.libvirt import utils as libvirt_utils
 from nova.virt import netutils
 
+native_threading = patcher.original("threading")
+native_Queue = patcher.original("Queue")
+
 libvirt = None
 
 LOG = logging.getLogger(__name__)
@@ -187,6 +196,10 @@ libvirt_opts = [
                default='$instances_path/snapshots',
                help='Location where libvirt driver will store snapshots '
                     'before uploading them to image service'),
+    cfg.IntOpt('libvirt_image_fetch_workers',
+               default=4,
+               help='Number of images and local disks fetched or created '
+                    'concurrently while spawning an instance'),
     ]
 
 FLAGS = flags.FLAGS
@@ -246,6 +259,10 @@ MIN_LIBVIRT_VERSION = (0, 9, 6)
 # delete it & corresponding code using it
 MIN_LIBVIRT_HOST_CPU_VERSION = (0, 9, 10)
 
+# Bases fetched from the image service, named after the sha1 of the image
+# id and optionally resized to _<size>
+_IMAGE_BASE_RE = re.compile('^[0-9a-f]{40}(_[0-9]+)?$')
+
 
 def _get_eph_disk(ephemeral):
     return 'disk.eph' + str(ephemeral['num'])
@@ -263,6 +280,10 @@ class LibvirtDriver(driver.ComputeDriver):
         self._host_state = None
         self._initiator = None
         self._wrapped_conn = None
+        self._caps = None
+        self._instance_types = {}
+        self._event_queue = None
+        self._domain_samples = {}
         self.read_only = read_only
         if FLAGS.firewall_driver not in firewall.drivers:
             FLAGS.set_default('firewall_driver', firewall.drivers[0])
@@ -322,7 +343,129 @@ class LibvirtDriver(driver.ComputeDriver):
 
         return True
 
+    def _native_thread(self):
+        """Receives async events coming in from libvirtd.
+
+        This is a native thread which runs the default libvirt event loop
+        implementation. It processes any incoming async events from
+        libvirtd and queues them for later dispatch. This thread is only
+        permitted to use libvirt python APIs, and the driver._queue_event
+        method. In particular any use of logging is forbidden, since it
+        will confuse eventlet's greenthread integration.
+        """
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def _dispatch_thread(self):
+        """Dispatches async events coming in from libvirtd.
+
+        This is a green thread which waits for events to arrive from the
+        libvirt event loop thread. This then dispatches the events to the
+        compute manager.
+        """
+        while True:
+            self._dispatch_events()
+
+    @staticmethod
+    def _event_lifecycle_callback(conn, dom, event, detail, opaque):
+        """Receives lifecycle events from libvirt.
+
+        NB: this method is executing in a native thread, not an eventlet
+        coroutine. It can only invoke other libvirt APIs, or use self's
+        _queue_event method. Any use of logging APIs in particular is
+        forbidden.
+        """
+        self = opaque
+
+        transition = None
+        if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            transition = power_state.SHUTDOWN
+        elif event in (libvirt.VIR_DOMAIN_EVENT_STARTED,
+                       libvirt.VIR_DOMAIN_EVENT_RESUMED):
+            transition = power_state.RUNNING
+        elif event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED:
+            transition = power_state.PAUSED
+
+        if transition is not None:
+            self._queue_event(virtevent.LifecycleEvent(dom.UUIDString(),
+                                                       transition))
+
+    def _queue_event(self, event):
+        """Puts an event on the queue for dispatch.
+
+        This method is called by the native event thread to put events on
+        the queue for later dispatch by the green thread.
+        """
+        if self._event_queue is None:
+            return
+
+        self._event_queue.put(event)
+
+        # Wake up the green thread waiting on the pipe
+        self._event_notify_send.write(' ')
+        self._event_notify_send.flush()
+
+    def _dispatch_events(self):
+        """Wait for & dispatch events from the native thread.
+
+        Blocks until the native thread indicates some events are ready,
+        then dispatches all queued events.
+        """
+        self._event_notify_recv.read(1)
+
+        while not self._event_queue.empty():
+            try:
+                event = self._event_queue.get(block=False)
+            except native_Queue.Empty:
+                break
+            self.emit_event(event)
+
+    def _init_events_pipe(self):
+        """Create a self-pipe for the native thread to synchronize on.
+
+        This code is taken from the eventlet tpool module, under terms
+        of the Apache License v2.0.
+        """
+        self._event_queue = native_Queue.Queue()
+        rpipe, wpipe = os.pipe()
+        self._event_notify_send = greenio.GreenPipe(wpipe, 'wb', 0)
+        self._event_notify_recv = greenio.GreenPipe(rpipe, 'rb', 0)
+
+    def _init_events(self):
+        """Initializes the libvirt events subsystem.
+
+        This requires running a native thread to provide the libvirt event
+        loop integration. This forwards events to a green thread which does
+        the actual dispatching.
+        """
+        self._init_events_pipe()
+
+        LOG.debug(_("Starting native event thread"))
+        event_thread = native_threading.Thread(target=self._native_thread)
+        event_thread.setDaemon(True)
+        event_thread.start()
+
+        LOG.debug(_("Starting green dispatch thread"))
+        greenthread.spawn_n(self._dispatch_thread)
+
+    def _register_events(self, conn):
+        """Asks a new connection for domain lifecycle events."""
+        try:
+            conn.domainEventRegisterAny(None,
+                                        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self._event_lifecycle_callback,
+                                        self)
+        except Exception as e:
+            LOG.warn(_("URI %(uri)s does not support events: %(error)s"),
+                     {'uri': self.uri, 'error': e})
+
     def init_host(self, host):
+        # NOTE: the event loop implementation has to be registered before
+        # the first connection is opened for that connection to get events.
+        if hasattr(libvirt, 'virEventRegisterDefaultImpl'):
+            libvirt.virEventRegisterDefaultImpl()
+            self._init_events()
+
         if not self.has_min_version(MIN_LIBVIRT_VERSION):
             major = MIN_LIBVIRT_VERSION[0]
             minor = MIN_LIBVIRT_VERSION[1]
@@ -334,6 +477,9 @@ class LibvirtDriver(driver.ComputeDriver):
     def _get_connection(self):
         if not self._wrapped_conn or not self._test_connection():
             LOG.debug(_('Connecting to libvirt: %s'), self.uri)
+            # The host may have changed under a new connection, e.g. after
+            # a libvirtd restart, so its capabilities have to be read again
+            self._caps = None
             if not FLAGS.libvirt_nonblocking:
                 self._wrapped_conn = self._connect(self.uri,
                                                self.read_only)
@@ -342,13 +488,16 @@ class LibvirtDriver(driver.ComputeDriver):
                     (libvirt.virDomain, libvirt.virConnect),
                     self._connect, self.uri, self.read_only)
 
+            if self._event_queue is not None:
+                self._register_events(self._wrapped_conn)
+
         return self._wrapped_conn
 
     _conn = property(_get_connection)
 
     def _test_connection(self):
         try:
-            self._wrapped_conn.getCapabilities()
+            self._wrapped_conn.getLibVersion()
             return True
         except libvirt.libvirtError as e:
             if (e.get_error_code() == libvirt.VIR_ERR_SYSTEM_ERROR and
@@ -1245,40 +1394,50 @@ class LibvirtDriver(driver.ComputeDriver):
                            'kernel_id': instance['kernel_id'],
                            'ramdisk_id': instance['ramdisk_id']}
 
+        # NOTE: None of the images and disks below depend on each other, so
+        # they are collected as (name, function) stages and run concurrently.
+        stages = []
+
         if disk_images['kernel_id']:
             fname = disk_images['kernel_id']
-            raw('kernel').cache(fn=libvirt_utils.fetch_image,
+            stages.append(('kernel', functools.partial(
+                                raw('kernel').cache,
+                                fn=libvirt_utils.fetch_image,
                                 context=context,
                                 fname=fname,
                                 image_id=disk_images['kernel_id'],
                                 user_id=instance['user_id'],
-                                project_id=instance['project_id'])
+                                project_id=instance['project_id'])))
             if disk_images['ramdisk_id']:
                 fname = disk_images['ramdisk_id']
-                raw('ramdisk').cache(fn=libvirt_utils.fetch_image,
-                                     context=context,
-                                     fname=fname,
-                                     image_id=disk_images['ramdisk_id'],
-                                     user_id=instance['user_id'],
-                                     project_id=instance['project_id'])
+                stages.append(('ramdisk', functools.partial(
+                                raw('ramdisk').cache,
+                                fn=libvirt_utils.fetch_image,
+                                context=context,
+                                fname=fname,
+                                image_id=disk_images['ramdisk_id'],
+                                user_id=instance['user_id'],
+                                project_id=instance['project_id'])))
 
         root_fname = hashlib.sha1(str(disk_images['image_id'])).hexdigest()
         size = instance['root_gb'] * 1024 * 1024 * 1024
 
         inst_type_id = instance['instance_type_id']
-        inst_type = instance_types.get_instance_type(inst_type_id)
+        inst_type = self._get_instance_type(inst_type_id)
         if size == 0 or suffix == '.rescue':
             size = None
 
         if not self._volume_in_mapping(self.default_root_device,
                                        block_device_info):
-            image('disk').cache(fn=libvirt_utils.fetch_image,
+            stages.append(('disk', functools.partial(
+                                image('disk').cache,
+                                fn=libvirt_utils.fetch_image,
                                 context=context,
                                 fname=root_fname,
                                 size=size,
                                 image_id=disk_images['image_id'],
                                 user_id=instance['user_id'],
-                                project_id=instance['project_id'])
+                                project_id=instance['project_id'])))
 
         ephemeral_gb = instance['ephemeral_gb']
         if ephemeral_gb and not self._volume_in_mapping(
@@ -1291,10 +1450,12 @@ class LibvirtDriver(driver.ComputeDriver):
                                             ephemeral_gb,
                                             instance["os_type"])
             size = ephemeral_gb * 1024 * 1024 * 1024
-            image('disk.local').cache(fn=fn,
-                                      fname=fname,
-                                      size=size,
-                                      ephemeral_size=ephemeral_gb)
+            stages.append(('disk.local', functools.partial(
+                                image('disk.local').cache,
+                                fn=fn,
+                                fname=fname,
+                                size=size,
+                                ephemeral_size=ephemeral_gb)))
         else:
             swap_device = self.default_second_device
 
@@ -1306,10 +1467,12 @@ class LibvirtDriver(driver.ComputeDriver):
             fname = "ephemeral_%s_%s_%s" % (eph['num'],
                                             eph['size'],
                                             instance["os_type"])
-            image(_get_eph_disk(eph)).cache(fn=fn,
-                                            fname=fname,
-                                            size=size,
-                                            ephemeral_size=eph['size'])
+            stages.append((_get_eph_disk(eph), functools.partial(
+                                image(_get_eph_disk(eph)).cache,
+                                fn=fn,
+                                fname=fname,
+                                size=size,
+                                ephemeral_size=eph['size'])))
 
         swap_mb = 0
 
@@ -1322,10 +1485,12 @@ class LibvirtDriver(driver.ComputeDriver):
 
         if swap_mb > 0:
             size = swap_mb * 1024 * 1024
-            image('disk.swap').cache(fn=self._create_swap,
-                                     fname="swap_%s" % swap_mb,
-                                     size=size,
-                                     swap_mb=swap_mb)
+            stages.append(('disk.swap', functools.partial(
+                                image('disk.swap').cache,
+                                fn=self._create_swap,
+                                fname="swap_%s" % swap_mb,
+                                size=size,
+                                swap_mb=swap_mb)))
 
         # target partition for file injection
         target_partition = None
@@ -1357,16 +1522,22 @@ class LibvirtDriver(driver.ComputeDriver):
 
             inst_md = instance_metadata.InstanceMetadata(instance,
                 content=files, extra_md=extra_md)
-            cdb = configdrive.ConfigDriveBuilder(instance_md=inst_md)
-            try:
-                configdrive_path = basepath(fname='disk.config')
-                LOG.info(_('Creating config drive at %(path)s'),
-                         {'path': configdrive_path}, instance=instance)
-                cdb.make_drive(configdrive_path)
-            finally:
-                cdb.cleanup()
 
-        elif any((key, net, metadata, admin_pass, files)):
+            def _make_config_drive():
+                cdb = configdrive.ConfigDriveBuilder(instance_md=inst_md)
+                try:
+                    configdrive_path = basepath(fname='disk.config')
+                    LOG.info(_('Creating config drive at %(path)s'),
+                             {'path': configdrive_path}, instance=instance)
+                    cdb.make_drive(configdrive_path)
+                finally:
+                    cdb.cleanup()
+            stages.append(('disk.config', _make_config_drive))
+
+        self._run_image_stages(instance, stages)
+
+        if (not using_config_drive and
+            any((key, net, metadata, admin_pass, files))):
             # If we're not using config_drive, inject into root fs
             injection_path = image('disk').path
             img_id = instance['image_ref']
@@ -1396,6 +1567,41 @@ class LibvirtDriver(driver.ComputeDriver):
         if FLAGS.libvirt_type == 'uml':
             libvirt_utils.chown(basepath('disk'), 'root')
 
+    def _run_image_stages(self, instance, stages):
+        """Runs (name, function) image stages concurrently, at most
+        libvirt_image_fetch_workers at a time, and waits for all of them.
+
+        How long each stage took is logged. If any stage failed, the first
+        failure is raised once the others are done.
+        """
+        timings = {}
+
+        def _timed(name, fn):
+            start = time.time()
+            try:
+                fn()
+            finally:
+                timings[name] = time.time() - start
+
+        start = time.time()
+        pool = greenpool.GreenPool(max(1, FLAGS.libvirt_image_fetch_workers))
+        threads = [pool.spawn(_timed, name, fn) for name, fn in stages]
+        exc_info = None
+        for thread in threads:
+            try:
+                thread.wait()
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+
+        timings['total'] = time.time() - start
+        LOG.debug(_('Image stage timings: %s'),
+                  ', '.join('%s=%.2fs' % (name, secs)
+                            for name, secs in sorted(timings.items())),
+                  instance=instance)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
     @staticmethod
     def _volume_in_mapping(mount_device, block_device_info):
         block_device_list = [block_device.strip_dev(vol['mount_device'])
@@ -1416,12 +1622,29 @@ class LibvirtDriver(driver.ComputeDriver):
 
     def get_host_capabilities(self):
         """Returns an instance of config.LibvirtConfigCaps representing
-           the capabilities of the host"""
-        xmlstr = self._conn.getCapabilities()
+           the capabilities of the host.
+
+           They are parsed once per libvirt connection, callers must not
+           modify the returned object."""
+        if not self._caps:
+            xmlstr = self._conn.getCapabilities()
 
-        caps = config.LibvirtConfigCaps()
-        caps.parse_str(xmlstr)
-        return caps
+            caps = config.LibvirtConfigCaps()
+            caps.parse_str(xmlstr)
+            self._caps = caps
+        return self._caps
+
+    def _get_instance_type(self, inst_type_id):
+        """Returns the instance type with id inst_type_id.
+
+        Instance types can not be changed once created, so they are looked
+        up once and then served from memory.
+        """
+        inst_type = self._instance_types.get(inst_type_id)
+        if inst_type is None:
+            inst_type = instance_types.get_instance_type(inst_type_id)
+            self._instance_types[inst_type_id] = inst_type
+        return inst_type
 
     def get_host_cpu_for_guest(self):
         """Returns an instance of config.LibvirtConfigGuestCPU
@@ -1635,7 +1858,7 @@ class LibvirtDriver(driver.ComputeDriver):
         """
         # FIXME(vish): stick this in db
         inst_type_id = instance['instance_type_id']
-        inst_type = instance_types.get_instance_type(inst_type_id)
+        inst_type = self._get_instance_type(inst_type_id)
 
         guest = config.LibvirtConfigGuest()
         guest.virt_type = FLAGS.libvirt_type
@@ -1955,6 +2178,79 @@ class LibvirtDriver(driver.ComputeDriver):
         stats = libvirt_utils.get_fs_info(FLAGS.instances_path)
         return stats['total'] / (1024 ** 3)
 
+    @staticmethod
+    def _get_file_disks(xml):
+        """Returns (path, driver type) of the file backed disks in xml."""
+        disks = []
+        doc = etree.fromstring(xml)
+        for disk_node in doc.findall('.//devices/disk'):
+            source = disk_node.find('source')
+            driver_node = disk_node.find('driver')
+            if (disk_node.get('type') != 'file' or source is None or
+                not source.get('file')):
+                continue
+            disk_type = driver_node is not None and driver_node.get('type')
+            disks.append((source.get('file'), disk_type))
+        return disks
+
+    def _sample_domain(self, dom):
+        """Gathers the data of a domain which doesn't change while it runs.
+        """
+        vcpus = dom.vcpus()
+        if vcpus is None:
+            # dom.vcpus is not implemented for lxc, but returning 0 for
+            # a used count is hardly useful for something measuring usage
+            vcpu_count = 1
+        else:
+            vcpu_count = len(vcpus[1])
+
+        disks = []
+        for path, disk_type in self._get_file_disks(dom.XMLDesc(0)):
+            if disk_type == 'qcow2':
+                virt_size = disk.get_disk_size(path)
+            else:
+                virt_size = 0
+            disks.append({'path': path, 'virt_disk_size': virt_size})
+
+        return {'name': dom.name(), 'vcpus': vcpu_count, 'disks': disks}
+
+    def _sample_domains(self):
+        """Returns the static data of every running domain.
+
+        Domains are listed once per call. Their vcpus, disk paths and
+        virtual disk sizes are cached by uuid and only gathered again when
+        the domain got a new id, which libvirt hands out every time a
+        domain is started, so once it was restarted or redefined.
+        """
+        samples = {}
+        for dom_id in self.list_instance_ids():
+            # We skip domains with ID 0 (hypervisors).
+            if dom_id == 0:
+                continue
+            try:
+                dom = self._conn.lookupByID(dom_id)
+                uuid = dom.UUIDString()
+                cached = self._domain_samples.get(uuid)
+                if cached is not None and cached[0] == dom_id:
+                    samples[uuid] = cached
+                else:
+                    samples[uuid] = (dom_id, self._sample_domain(dom))
+            except libvirt.libvirtError:
+                # Domain was deleted while listing... ignore it
+                continue
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                LOG.error(_("Getting disk size of domain %(dom_id)s: %(e)s")
+                          % locals())
+
+        self._domain_samples = samples
+        return [sample for _dom_id, sample in samples.itervalues()]
+
+    @staticmethod
+    def _vcpus_used(samples):
+        return sum(sample['vcpus'] for sample in samples)
+
     def get_vcpu_used(self):
         """ Get vcpu usage number of physical computer.
 
@@ -1962,17 +2258,7 @@ class LibvirtDriver(driver.ComputeDriver):
 
         """
 
-        total = 0
-        for dom_id in self.list_instance_ids():
-            dom = self._conn.lookupByID(dom_id)
-            vcpus = dom.vcpus()
-            if vcpus is None:
-                # dom.vcpus is not implemented for lxc, but returning 0 for
-                # a used count is hardly useful for something measuring usage
-                total += 1
-            else:
-                total += len(vcpus[1])
-        return total
+        return self._vcpus_used(self._sample_domains())
 
     def get_memory_mb_used(self):
         """Get the free memory size(MB) of physical computer.
@@ -2149,11 +2435,14 @@ class LibvirtDriver(driver.ComputeDriver):
         except exception.NotFound:
             raise exception.ComputeServiceUnavailable(host=host)
 
+        # List the domains once for every value derived from them
+        samples = self._sample_domains()
+
         # Updating host information
         dic = {'vcpus': self.get_vcpu_total(),
                'memory_mb': self.get_memory_mb_total(),
                'local_gb': self.get_local_gb_total(),
-               'vcpus_used': self.get_vcpu_used(),
+               'vcpus_used': self._vcpus_used(samples),
                'memory_mb_used': self.get_memory_mb_used(),
                'local_gb_used': self.get_local_gb_used(),
                'hypervisor_type': self.get_hypervisor_type(),
@@ -2161,7 +2450,7 @@ class LibvirtDriver(driver.ComputeDriver):
                'hypervisor_hostname': self.get_hypervisor_hostname(),
                'cpu_info': self.get_cpu_info(),
                'service_id': service_ref['id'],
-               'disk_available_least': self.get_disk_available_least()}
+               'disk_available_least': self._disk_available_least(samples)}
 
         compute_node_ref = service_ref['compute_node']
         if not compute_node_ref:
@@ -2660,29 +2949,26 @@ class LibvirtDriver(driver.ComputeDriver):
         of the virtual disk of all instances.
 
         """
+        return self._disk_available_least(self._sample_domains())
+
+    def _disk_available_least(self, samples):
         # available size of the disk
         dk_sz_gb = self.get_local_gb_total() - self.get_local_gb_used()
 
         # Disk size that all instance uses : virtual_size - disk_size
-        instances_name = self.list_instances()
         instances_sz = 0
-        for i_name in instances_name:
-            try:
-                disk_infos = jsonutils.loads(
-                        self.get_instance_disk_info(i_name))
-                for info in disk_infos:
-                    i_vt_sz = int(info['virt_disk_size'])
-                    i_dk_sz = int(info['disk_size'])
-                    instances_sz += i_vt_sz - i_dk_sz
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    LOG.error(_("Getting disk size of %(i_name)s: %(e)s") %
-                              locals())
-                else:
+        for sample in samples:
+            for info in sample['disks']:
+                # Only the allocated size changes while a domain runs
+                try:
+                    i_dk_sz = os.path.getsize(info['path'])
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        LOG.error(_("Getting disk size of %(i_name)s: %(e)s")
+                                  % {'i_name': sample['name'], 'e': e})
+                        continue
                     raise
-            except exception.InstanceNotFound:
-                # Instance was deleted during the check so ignore it
-                pass
+                instances_sz += info['virt_disk_size'] - i_dk_sz
 
         # Disk available least size
         available_least_size = dk_sz_gb * (1024 ** 3) - instances_sz
@@ -2731,6 +3017,89 @@ class LibvirtDriver(driver.ComputeDriver):
         """Manage the local cache of images."""
         self.image_cache_manager.verify_base_images(context)
 
+    def _update_instance_progress(self, context, instance, step, total_steps):
+        """Update instance progress percent to reflect current step number
+        """
+        progress = round(float(step) / total_steps * 100)
+        LOG.debug(_("Updating progress to %(progress)d"), locals(),
+                  instance=instance)
+        db.instance_update(context, instance['uuid'], {'progress': progress})
+
+    @staticmethod
+    def _cached_base_path(backing_file):
+        return os.path.join(FLAGS.instances_path, '_base', backing_file)
+
+    def _dest_has_cached_base(self, dest, backing_file):
+        """Checks whether dest already caches the base image an overlay is
+        backed by.
+
+        Only bases fetched from the image service qualify. Ephemeral and
+        swap bases are made by mkfs or mkswap on each host, so they differ
+        between hosts even when their names match. The sha1 of the base
+        is compared on both hosts, using the one recorded by the image
+        cache where there is one.
+
+        The base is touched first, so that the image cache of dest does not
+        age it out while the overlay is being copied.
+        """
+        if not _IMAGE_BASE_RE.match(backing_file):
+            return False
+        base_path = self._cached_base_path(backing_file)
+        if not os.path.exists(base_path):
+            return False
+        try:
+            utils.execute('ssh', dest, 'touch', '-c', base_path)
+            out, _err = utils.execute('ssh', dest, 'stat', '-c', '%s',
+                                      base_path)
+            if int(out.strip()) != os.path.getsize(base_path):
+                return False
+
+            checksum = (imagecache.read_stored_checksum(base_path) or
+                        imagecache.hash_file(base_path))
+            return checksum == self._dest_base_checksum(dest, base_path)
+        except (exception.ProcessExecutionError, ValueError, IndexError):
+            return False
+
+    @staticmethod
+    def _dest_base_checksum(dest, base_path):
+        """Returns the sha1 of a base file on dest."""
+        info_path = libvirt_utils.get_info_filename(base_path)
+        try:
+            out, _err = utils.execute('ssh', dest, 'cat', info_path)
+            checksum = jsonutils.loads(out).get('sha1')
+            if checksum:
+                return checksum
+        except (exception.ProcessExecutionError, ValueError):
+            pass
+
+        out, _err = utils.execute('ssh', dest, 'sha1sum', base_path)
+        return out.split()[0]
+
+    def _migrate_disk(self, info, from_path, dest, same_host):
+        """Copies one disk of a migrating instance to dest.
+
+        A qcow2 overlay is shipped as is when its image base is cached at
+        dest, and is otherwise merged with its base into a standalone image
+        first.
+        """
+        img_path = info['path']
+        if info['type'] == 'qcow2' and info['backing_file']:
+            if same_host or self._dest_has_cached_base(dest,
+                                                       info['backing_file']):
+                LOG.debug(_("Copying only the overlay of %s"), img_path)
+                libvirt_utils.copy_image(from_path, img_path, host=dest)
+                return
+
+            tmp_path = from_path + "_rbase"
+            # merge backing file
+            utils.execute('qemu-img', 'convert', '-f', 'qcow2',
+                          '-O', 'qcow2', from_path, tmp_path)
+            libvirt_utils.copy_image(tmp_path, img_path, host=dest)
+            utils.execute('rm', '-f', tmp_path)
+
+        else:  # raw or qcow2 with no backing file
+            libvirt_utils.copy_image(from_path, img_path, host=dest)
+
     @exception.wrap_exception()
     def migrate_disk_and_power_off(self, context, instance, dest,
                                    instance_type, network_info):
@@ -2738,8 +3107,17 @@ class LibvirtDriver(driver.ComputeDriver):
                    instance=instance)
         disk_info_text = self.get_instance_disk_info(instance['name'])
         disk_info = jsonutils.loads(disk_info_text)
+        # One step for powering off, then one per disk copied
+        total_steps = 1 + len(disk_info)
+        steps_done = [0]
+
+        def _step_done():
+            steps_done[0] += 1
+            self._update_instance_progress(context, instance,
+                                           steps_done[0], total_steps)
 
         self.power_off(instance)
+        _step_done()
 
         # copy disks to destination
         # rename instance dir to +_resize at first for using
@@ -2754,25 +3132,18 @@ class LibvirtDriver(driver.ComputeDriver):
                 utils.execute('mkdir', '-p', inst_base)
             else:
                 utils.execute('ssh', dest, 'mkdir', '-p', inst_base)
-            for info in disk_info:
+
+            def _copy_disk(info):
                 # assume inst_base == dirname(info['path'])
-                img_path = info['path']
-                fname = os.path.basename(img_path)
+                fname = os.path.basename(info['path'])
                 from_path = os.path.join(inst_base_resize, fname)
-                if info['type'] == 'qcow2' and info['backing_file']:
-                    tmp_path = from_path + "_rbase"
-                    # merge backing file
-                    utils.execute('qemu-img', 'convert', '-f', 'qcow2',
-                                  '-O', 'qcow2', from_path, tmp_path)
-
-                    if same_host:
-                        utils.execute('mv', tmp_path, img_path)
-                    else:
-                        libvirt_utils.copy_image(tmp_path, img_path, host=dest)
-                        utils.execute('rm', '-f', tmp_path)
+                self._migrate_disk(info, from_path, dest, same_host)
+                _step_done()
 
-                else:  # raw or qcow2 with no backing file
-                    libvirt_utils.copy_image(from_path, img_path, host=dest)
+            self._run_image_stages(instance,
+                    [(os.path.basename(info['path']),
+                      functools.partial(_copy_disk, info))
+                     for info in disk_info])
         except Exception, e:
             try:
                 if os.path.exists(inst_base_resize):
@@ -33,7 +33,6 @@ from nova import db
 from nova import flags
 from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
-from nova import utils
 from nova.virt.libvirt import utils as virtutils
 
 
@@ -54,6 +53,30 @@ imagecache_opts = [
     cfg.BoolOpt('checksum_base_images',
                 default=False,
                 help='Write a checksum for files in _base to disk'),
+    cfg.BoolOpt('image_cache_shared_instances_path',
+                default=False,
+                help='Whether instances_path is shared with other compute '
+                     'nodes, in which case instances on every host are '
+                     'considered when looking for backing files in use'),
+    cfg.IntOpt('checksum_interval_seconds',
+               default=86400,
+               help='How often base images which have not changed since '
+                    'their checksum was last verified are hashed again. '
+                    '0 means every image cache manager pass'),
+    cfg.IntOpt('checksum_io_budget_mb',
+               default=0,
+               help='Maximum number of megabytes of unchanged base images '
+                    'hashed per image cache manager pass; the rest are '
+                    'verified on later passes. 0 means unlimited'),
+    cfg.IntOpt('checksum_max_read_rate_mb',
+               default=0,
+               help='Maximum rate, in megabytes per second, at which base '
+                    'images are read while hashing them. 0 means unlimited'),
+    cfg.IntOpt('checksum_sample_blocks',
+               default=0,
+               help='Number of blocks of an unchanged base image which are '
+                    'hashed on passes between full verifications. 0 '
+                    'disables sampled verification'),
     ]
 
 flags.DECLARE('instances_path', 'nova.compute.manager')
@@ -61,6 +84,8 @@ flags.DECLARE('base_dir_name', 'nova.compute.manager')
 FLAGS = flags.FLAGS
 FLAGS.register_opts(imagecache_opts)
 
+_HASH_CHUNK_SIZE = 65536
+
 
 def read_stored_checksum(target):
     """Read the checksum.
@@ -74,11 +99,56 @@ def write_stored_checksum(target):
     """Write a checksum to disk for a file in _base."""
 
     if not read_stored_checksum(target):
-        img_file = open(target, 'r')
-        checksum = utils.hash_file(img_file)
-        img_file.close()
-
+        checksum = hash_file(target)
         virtutils.write_stored_info(target, field='sha1', value=checksum)
+        record_verified_checksum(target)
+
+
+def get_file_stat(target):
+    """Return the size, mtime and inode used to tell if a file changed."""
+    st = os.stat(target)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def record_verified_checksum(target):
+    """Note that the stored checksum of a file was just verified."""
+    virtutils.write_stored_info(target, field='sha1_stat',
+                                value=get_file_stat(target))
+    virtutils.write_stored_info(target, field='sha1_verified_at',
+                                value=time.time())
+    if FLAGS.checksum_sample_blocks:
+        virtutils.write_stored_info(target, field='sha1_sample',
+                                    value=hash_file_sample(target))
+
+
+def hash_file(target):
+    """Hash a file, reading no faster than checksum_max_read_rate_mb."""
+    max_rate = FLAGS.checksum_max_read_rate_mb * 1024 * 1024
+    checksum = hashlib.sha1()
+    start = time.time()
+    read = 0
+    with open(target, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), ''):
+            checksum.update(chunk)
+            read += len(chunk)
+            if max_rate:
+                ahead = float(read) / max_rate - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+    return checksum.hexdigest()
+
+
+def hash_file_sample(target):
+    """Hash checksum_sample_blocks blocks spread evenly through a file."""
+    size = os.path.getsize(target)
+    blocks = FLAGS.checksum_sample_blocks
+    stride = max(size / blocks, _HASH_CHUNK_SIZE)
+    checksum = hashlib.sha1()
+    with open(target, 'rb') as f:
+        for offset in xrange(0, size, stride):
+            f.seek(offset)
+            checksum.update(f.read(_HASH_CHUNK_SIZE))
+    return checksum.hexdigest()
 
 
 class ImageCacheManager(object):
@@ -98,6 +168,8 @@ class ImageCacheManager(object):
         self.removable_base_files = []
         self.unexplained_images = []
 
+        self._checksum_budget = FLAGS.checksum_io_budget_mb * 1024 * 1024
+
     def _store_image(self, base_dir, ent, original=False):
         """Store a base image for later examination."""
         entpath = os.path.join(base_dir, ent)
@@ -128,12 +200,21 @@ class ImageCacheManager(object):
                 self._store_image(base_dir, ent, original=False)
 
     def _list_running_instances(self, context):
-        """List running instances (on all compute nodes)."""
+        """List running instances.
+
+        Only instances on this node or being resized are loaded, unless
+        instances_path is shared with other nodes. Usage counts across all
+        compute nodes come from a single aggregate query.
+        """
         self.used_images = {}
         self.image_popularity = {}
         self.instance_names = set()
 
-        instances = db.instance_get_all(context)
+        host = FLAGS.host
+        if FLAGS.image_cache_shared_instances_path:
+            host = None
+
+        instances = db.instance_get_all_for_image_cache(context, host=host)
         for instance in instances:
             self.instance_names.add(instance['name'])
 
@@ -141,22 +222,33 @@ class ImageCacheManager(object):
                              task_states.RESIZE_MIGRATING,
                              task_states.RESIZE_MIGRATED,
                              task_states.RESIZE_FINISH]
+            is_local = instance['host'] == FLAGS.host
             if instance['task_state'] in resize_states or \
                 instance['vm_state'] == vm_states.RESIZED:
-                self.instance_names.add(instance['name'] + '_resize')
+                resize_name = instance['name'] + '_resize'
+                self.instance_names.add(resize_name)
+                # The source of a resize keeps the old disk, backed by our
+                # base file, until the resize is confirmed or reverted
+                if os.path.exists(os.path.join(FLAGS.instances_path,
+                                               resize_name)):
+                    is_local = True
 
             image_ref_str = str(instance['image_ref'])
             local, remote, insts = self.used_images.get(image_ref_str,
                                                         (0, 0, []))
-            if instance['host'] == FLAGS.host:
+            if is_local:
                 local += 1
-            else:
-                remote += 1
             insts.append(instance['name'])
             self.used_images[image_ref_str] = (local, remote, insts)
 
-            self.image_popularity.setdefault(image_ref_str, 0)
-            self.image_popularity[image_ref_str] += 1
+        counts = db.instance_count_by_image(context)
+        for image_ref, count in counts.iteritems():
+            image_ref_str = str(image_ref)
+            local, remote, insts = self.used_images.get(image_ref_str,
+                                                        (0, 0, []))
+            remote = max(count - local, 0)
+            self.used_images[image_ref_str] = (local, remote, insts)
+            self.image_popularity[image_ref_str] = count
 
     def _list_backing_images(self):
         """List the backing images currently in use."""
@@ -228,9 +320,29 @@ class ImageCacheManager(object):
 
         stored_checksum = read_stored_checksum(base_file)
         if stored_checksum:
-            f = open(base_file, 'r')
-            current_checksum = utils.hash_file(f)
-            f.close()
+            info = virtutils.read_stored_info(base_file)
+            size, _mtime, _inode = current_stat = get_file_stat(base_file)
+
+            # Files which have not changed since they were last verified
+            # are only hashed again once checksum_interval_seconds have
+            # passed, and then only as the I/O budget for this pass allows.
+            if info.get('sha1_stat') == current_stat:
+                age = time.time() - info.get('sha1_verified_at', 0)
+                if age < FLAGS.checksum_interval_seconds:
+                    return self._verify_checksum_sample(img_id, base_file,
+                                                        info)
+
+                if FLAGS.checksum_io_budget_mb:
+                    if size > self._checksum_budget:
+                        LOG.debug(_('%(id)s (%(base_file)s): image '
+                                    'verification deferred, I/O budget '
+                                    'exhausted'),
+                                  {'id': img_id,
+                                   'base_file': base_file})
+                        return None
+                    self._checksum_budget -= size
+
+            current_checksum = hash_file(base_file)
 
             if current_checksum != stored_checksum:
                 LOG.error(_('%(id)s (%(base_file)s): image verification '
@@ -240,6 +352,7 @@ class ImageCacheManager(object):
                 return False
 
             else:
+                record_verified_checksum(base_file)
                 return True
 
         else:
@@ -256,6 +369,19 @@ class ImageCacheManager(object):
 
             return None
 
+    def _verify_checksum_sample(self, img_id, base_file, info):
+        """Verify the sampled blocks of an unchanged base image."""
+        if not FLAGS.checksum_sample_blocks or 'sha1_sample' not in info:
+            return True
+
+        if hash_file_sample(base_file) != info['sha1_sample']:
+            LOG.error(_('%(id)s (%(base_file)s): sampled image verification '
+                        'failed'),
+                      {'id': img_id,
+                       'base_file': base_file})
+            return False
+        return True
+
     def _remove_base_file(self, base_file):
         """Remove a single base file if it is old enough.
 
@@ -354,9 +480,22 @@ class ImageCacheManager(object):
                           {'id': img_id,
                            'base_file': base_file})
                 if os.path.exists(base_file):
+                    # Touching the file must not make it look modified
+                    # to the next checksum verification, including when
+                    # its verification was deferred by the I/O budget.
+                    stored_stat = virtutils.read_stored_info(
+                        base_file, field='sha1_stat')
+                    unchanged = (stored_stat and
+                                 stored_stat == get_file_stat(base_file))
+
                     virtutils.chown(base_file, os.getuid())
                     os.utime(base_file, None)
 
+                    if unchanged:
+                        virtutils.write_stored_info(
+                            base_file, field='sha1_stat',
+                            value=get_file_stat(base_file))
+
     def verify_base_images(self, context):
         """Verify that base images are in a reasonable state."""
 
@@ -178,6 +178,10 @@ def get_disk_size(path):
     :returns: Size (in bytes) of the given disk image as it would be seen
               by a virtual machine.
     """
+    header = images.read_image_header(path)
+    if header is not None:
+        return header['virtual_size']
+
     size = images.qemu_img_info(path)['virtual size']
     size = size.split('(')[1].split()[0]
     return int(size)
@@ -189,7 +193,11 @@ def get_disk_backing_file(path):
     :param path: Path to the disk image
     :returns: a path to the image's backing store
     """
-    backing_file = images.qemu_img_info(path).get('backing file')
+    header = images.read_image_header(path)
+    if header is not None:
+        backing_file = header['backing_file']
+    else:
+        backing_file = images.qemu_img_info(path).get('backing file')
 
     if backing_file:
         if 'actual path: ' in backing_file:
@@ -482,7 +490,7 @@ def write_stored_info(target, field=None, value=None):
     info_file = get_info_filename(target)
     ensure_tree(os.path.dirname(info_file))
 
-    d = read_stored_info(info_file)
+    d = read_stored_info(target)
     d[field] = value
     serialized = jsonutils.dumps(d)
 
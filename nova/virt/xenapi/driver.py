@@ -42,6 +42,7 @@ import time
 import urlparse
 import xmlrpclib
 
+from eventlet import greenthread
 from eventlet import queue
 from eventlet import timeout
 
@@ -122,6 +123,11 @@ xenapi_opts = [
     cfg.IntOpt('xenapi_login_timeout',
                default=10,
                help='Timeout in seconds for XenAPI login.'),
+    cfg.BoolOpt('xenapi_vm_events',
+                default=False,
+                help='Watch for VM power state changes with event.from and '
+                     'report them to the compute manager as they happen. '
+                     'Requires XenServer 6.1 / XCP 1.6 or later'),
     ]
 
 FLAGS = flags.FLAGS
@@ -167,6 +173,9 @@ class XenAPIDriver(driver.ComputeDriver):
         except Exception:
             LOG.exception(_('Failure while cleaning up attached VDIs'))
 
+        if FLAGS.xenapi_vm_events:
+            greenthread.spawn_n(self._vmops.watch_vm_events, self.emit_event)
+
     def list_instances(self):
         """List VM instances"""
         return self._vmops.list_instances()
@@ -289,6 +298,10 @@ class XenAPIDriver(driver.ComputeDriver):
         """Return data about VM instance"""
         return self._vmops.get_info(instance)
 
+    def get_all_power_states(self):
+        """Return the power state of every VM"""
+        return self._vmops.get_all_power_states()
+
     def get_diagnostics(self, instance):
         """Return data about VM diagnostics"""
         return self._vmops.get_diagnostics(instance)
@@ -542,6 +555,12 @@ class XenAPIDriver(driver.ComputeDriver):
         """
         return self._vmops.refresh_instance_security_rules(instance)
 
+    def filter_defer_apply_on(self):
+        self._vmops.firewall_driver.filter_defer_apply_on()
+
+    def filter_defer_apply_off(self):
+        self._vmops.firewall_driver.filter_defer_apply_off()
+
     def refresh_provider_fw_rules(self):
         return self._vmops.refresh_provider_fw_rules()
 
@@ -749,13 +768,9 @@ class XenAPISession(object):
     def get_all_refs_and_recs(self, record_type):
         """Retrieve all refs and recs for a Xen record type.
 
-        Handles race-conditions where the record may be deleted between
-        the `get_all` call and the `get_record` call.
+        All records are fetched with a single `get_all_records` call.
         """
 
-        for ref in self.call_xenapi('%s.get_all' % record_type):
-            rec = self.get_rec(record_type, ref)
-            # Check to make sure the record still exists. It may have
-            # been deleted between the get_all call and get_record call
-            if rec:
-                yield ref, rec
+        records = self.call_xenapi('%s.get_all_records' % record_type)
+        for ref, rec in records.iteritems():
+            yield ref, rec
@@ -469,6 +469,13 @@ class SessionBase(object):
     def SR_scan(self, _1, sr_ref):
         return
 
+    def VDI_get_all_records_where(self, _1, expr):
+        # NOTE: Only understands the 'field "SR" = "<ref>"' filter
+        sr_ref = expr.split('"')[3]
+        return dict((vdi_ref, vdi_rec)
+                    for vdi_ref, vdi_rec in _db_content['VDI'].iteritems()
+                    if vdi_rec.get('SR') == sr_ref)
+
     def PIF_get_all_records_where(self, _1, _2):
         # TODO(salvatore-orlando): filter table on _2
         return _db_content['PIF']
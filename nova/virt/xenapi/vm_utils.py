@@ -21,11 +21,16 @@ Helper methods for operations related to the management of VM records and
 their attributes like VDIs, VIFs, as well as their lookup functions.
 """
 
+import array
 import contextlib
 import cPickle as pickle
-import decimal
+import cStringIO
+import errno
+import itertools
+import math
 import os
 import re
+import sys
 import time
 import urllib
 import urlparse
@@ -34,6 +39,7 @@ from xml.dom import minidom
 from xml.parsers import expat
 
 from eventlet import greenthread
+from lxml import etree
 
 from nova import block_device
 from nova.compute import instance_types
@@ -79,6 +85,10 @@ xenapi_vm_utils_opts = [
                      'resize down (False will use standard dd). This speeds '
                      'up resizes down considerably since large runs of zeros '
                      'won\'t have to be rsynced'),
+    cfg.IntOpt('xenapi_sparse_copy_block_size',
+               default=1024 * 1024,
+               help='Size in bytes of the chunks sparse_copy reads and '
+                    'compares against zeros at a time'),
     cfg.IntOpt('xenapi_num_vbd_unplug_retries',
                default=10,
                help='Maximum number of retries to unplug VBD'),
@@ -522,7 +532,7 @@ def snapshot_attached_here(session, instance, vm_ref, label):
 
     # Memorize the original_parent_uuid so we can poll for coalesce
     vm_vdi_ref, vm_vdi_rec = get_vdi_for_vm_safely(session, vm_ref)
-    original_parent_uuid = _get_vhd_parent_uuid(session, vm_vdi_ref)
+    original_parent_uuid = vm_vdi_rec['sm_config'].get('vhd-parent')
 
     template_vm_ref, template_vdi_uuid = _create_snapshot(
             session, instance, vm_ref, label)
@@ -586,6 +596,9 @@ def destroy_cached_images(session, sr_ref, all_cached=False, dry_run=False):
     cached_images = _find_cached_images(session, sr_ref)
     destroyed = set()
 
+    _scan_sr(session, sr_ref)
+    index = _VHDIndex(session, sr_ref)
+
     def destroy_cached_vdi(vdi_uuid, vdi_ref):
         LOG.debug(_("Destroying cached VDI '%(vdi_uuid)s'"))
         if not dry_run:
@@ -593,7 +606,7 @@ def destroy_cached_images(session, sr_ref, all_cached=False, dry_run=False):
         destroyed.add(vdi_uuid)
 
     for vdi_ref in cached_images.values():
-        vdi_uuid = session.call_xenapi('VDI.get_uuid', vdi_ref)
+        vdi_uuid = index.get_uuid(vdi_ref)
 
         if all_cached:
             destroy_cached_vdi(vdi_uuid, vdi_ref)
@@ -604,13 +617,14 @@ def destroy_cached_images(session, sr_ref, all_cached=False, dry_run=False):
         # Chain length greater than two implies a VM must be holding a ref to
         # the base-copy (otherwise it would have coalesced), so consider this
         # cached image used.
-        chain = list(_walk_vdi_chain(session, vdi_uuid))
+        chain = list(_walk_vdi_chain(session, vdi_uuid, index=index))
         if len(chain) > 2:
             continue
         elif len(chain) == 2:
             # Siblings imply cached image is used
             root_vdi_rec = chain[-1]
-            children = _child_vhds(session, sr_ref, root_vdi_rec['uuid'])
+            children = _child_vhds(session, sr_ref, root_vdi_rec['uuid'],
+                                   index=index)
             if len(children) > 1:
                 continue
 
@@ -1363,8 +1377,7 @@ def compile_metrics(start_time, stop_time=None):
 
     xml = _get_rrd_updates(_get_rrd_server(), start_time)
     if xml:
-        doc = minidom.parseString(xml)
-        return _parse_rrd_update(doc, start_time, stop_time)
+        return _parse_rrd_update(xml, start_time, stop_time)
 
     raise exception.CouldNotFetchMetrics()
 
@@ -1505,141 +1518,171 @@ def _get_rrd_updates(server, start_time):
         return None
 
 
-def _parse_rrd_meta(doc):
-    data = {}
-    meta = doc.getElementsByTagName('meta')[0]
-    for tag in ('start', 'end', 'step'):
-        data[tag] = int(meta.getElementsByTagName(tag)[0].firstChild.data)
-    legend = meta.getElementsByTagName('legend')[0]
-    data['legend'] = [child.firstChild.data for child in legend.childNodes]
-    return data
-
+def _parse_rrd_value(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return float('nan')
 
-def _parse_rrd_data(doc):
-    dnode = doc.getElementsByTagName('data')[0]
-    return [dict(
-            time=int(child.getElementsByTagName('t')[0].firstChild.data),
-            values=[decimal.Decimal(valnode.firstChild.data)
-                  for valnode in child.getElementsByTagName('v')])
-            for child in dnode.childNodes]
 
+def _parse_rrd_columns(xml, until=None):
+    """Stream the rows of an rrd_updates document into one array per column.
 
-def _parse_rrd_update(doc, start, until=None):
+    Returns the column legend, the row times and the column arrays. Rows
+    are kept in the (newest first) order xapi sends them in.
+    """
+    legend = []
+    times = []
+    columns = None
+    for _event, elem in etree.iterparse(cStringIO.StringIO(xml)):
+        if elem.tag == 'entry':
+            legend.append(elem.text)
+        elif elem.tag == 'row':
+            row_time = int(elem.findtext('t'))
+            if not until or row_time <= until:
+                values = [_parse_rrd_value(v.text) for v in elem.iter('v')]
+                if columns is None:
+                    columns = [array.array('d') for _v in values]
+                for column, value in itertools.izip(columns, values):
+                    column.append(value)
+                times.append(row_time)
+            # Rows are not needed once read, so don't build up a tree
+            elem.clear()
+    return legend, times, columns or [array.array('d') for _l in legend]
+
+
+def _parse_rrd_update(xml, start, until=None):
     sum_data = {}
-    meta = _parse_rrd_meta(doc)
-    data = _parse_rrd_data(doc)
-    for col, collabel in enumerate(meta['legend']):
+    legend, times, columns = _parse_rrd_columns(xml, until)
+    for collabel, values in itertools.izip(legend, columns):
         _datatype, _objtype, uuid, name = collabel.split(':')
-        vm_data = sum_data.get(uuid, dict())
+        vm_data = sum_data.setdefault(uuid, {})
         if name.startswith('vif'):
-            vm_data[name] = _integrate_series(data, col, start, until)
+            vm_data[name] = _integrate_series(times, values, start)
         else:
-            vm_data[name] = _average_series(data, col, until)
-        sum_data[uuid] = vm_data
+            vm_data[name] = _average_series(values)
     return sum_data
 
 
-def _average_series(data, col, until=None):
-    vals = [row['values'][col] for row in data
-            if (not until or (row['time'] <= until)) and
-                row['values'][col].is_finite()]
+def _average_series(values):
+    # NOTE(mdragon): Xenserver occasionally returns odd values in the data
+    # (see bug 918490), so only finite samples are averaged.
+    vals = [val for val in values
+            if not (math.isnan(val) or math.isinf(val))]
     if vals:
-        try:
-            return (sum(vals) / len(vals)).quantize(decimal.Decimal('1.0000'))
-        except decimal.InvalidOperation:
-            # (mdragon) Xenserver occasionally returns odd values in
-            # data that will throw an error on averaging (see bug 918490)
-            # These are hard to find, since, whatever those values are,
-            # Decimal seems to think they are a valid number, sortof.
-            # We *think* we've got the the cases covered, but just in
-            # case, log and return NaN, so we don't break reporting of
-            # other statistics.
-            LOG.error(_("Invalid statistics data from Xenserver: %s")
-                      % str(vals))
-            return decimal.Decimal('NaN')
+        return round(math.fsum(vals) / len(vals), 4)
     else:
-        return decimal.Decimal('0.0000')
-
-
-def _integrate_series(data, col, start, until=None):
-    total = decimal.Decimal('0.0000')
-    prev_time = int(start)
-    prev_val = None
-    for row in reversed(data):
-        if not until or (row['time'] <= until):
-            time = row['time']
-            val = row['values'][col]
-            if val.is_nan():
-                val = decimal.Decimal('0.0000')
-            if prev_val is None:
-                prev_val = val
-            if prev_val >= val:
-                total += ((val * (time - prev_time)) +
-                          (decimal.Decimal('0.5000') * (prev_val - val) *
-                          (time - prev_time)))
-            else:
-                total += ((prev_val * (time - prev_time)) +
-                          (decimal.Decimal('0.5000') * (val - prev_val) *
-                          (time - prev_time)))
-            prev_time = time
-            prev_val = val
-    return total.quantize(decimal.Decimal('1.0000'))
+        return 0.0
+
+
+def _integrate_series(times, values, start):
+    """Integrate a series over time with the trapezoidal rule, starting
+    from start and treating missing samples as zero.
+    """
+    if not times:
+        return 0.0
+    # Walk the samples oldest first
+    times = [int(start)] + times[::-1]
+    vals = [0.0 if math.isnan(val) else val for val in reversed(values)]
+    vals.insert(0, vals[0])
+    total = math.fsum((v0 + v1) * 0.5 * (t1 - t0)
+                      for t0, t1, v0, v1 in itertools.izip(
+                          times, times[1:], vals, vals[1:]))
+    return round(total, 4)
 
 
 def _get_all_vdis_in_sr(session, sr_ref):
-    for vdi_ref in session.call_xenapi('SR.get_VDIs', sr_ref):
+    expr = 'field "SR" = "%s"' % sr_ref
+    vdis = session.call_xenapi('VDI.get_all_records_where', expr)
+    for vdi_ref, vdi_rec in vdis.iteritems():
+        yield vdi_ref, vdi_rec
+
+
+class _VHDIndex(object):
+    """Parent/child map of every VHD in an SR.
+
+    The records are fetched with a single VDI.get_all_records_where call,
+    so walking chains and looking for siblings costs no further XenAPI
+    calls.  Build a new index whenever the SR may have changed, e.g. after
+    each SR.scan while waiting for a coalesce.
+    """
+
+    def __init__(self, session, sr_ref):
+        self._session = session
+        self._by_uuid = {}
+        self._uuids = {}
+        self._children = {}
+        for vdi_ref, vdi_rec in _get_all_vdis_in_sr(session, sr_ref):
+            self._add(vdi_ref, vdi_rec)
+
+    def _add(self, vdi_ref, vdi_rec):
+        vdi_uuid = vdi_rec['uuid']
+        self._by_uuid[vdi_uuid] = vdi_rec
+        self._uuids[vdi_ref] = vdi_uuid
+        parent_uuid = vdi_rec['sm_config'].get('vhd-parent')
+        if parent_uuid:
+            self._children.setdefault(parent_uuid, set()).add(vdi_uuid)
+
+    def get_record(self, vdi_uuid):
+        """Return the vdi_rec for a VDI, fetching any VDI which was not
+        in the SR when the index was built.
+        """
         try:
-            vdi_rec = session.call_xenapi('VDI.get_record', vdi_ref)
-            yield vdi_ref, vdi_rec
-        except session.XenAPI.Failure:
-            continue
+            return self._by_uuid[vdi_uuid]
+        except KeyError:
+            vdi_ref = self._session.call_xenapi('VDI.get_by_uuid', vdi_uuid)
+            vdi_rec = self._session.call_xenapi('VDI.get_record', vdi_ref)
+            self._add(vdi_ref, vdi_rec)
+            return vdi_rec
 
+    def get_uuid(self, vdi_ref):
+        try:
+            return self._uuids[vdi_ref]
+        except KeyError:
+            vdi_rec = self._session.call_xenapi('VDI.get_record', vdi_ref)
+            self._add(vdi_ref, vdi_rec)
+            return vdi_rec['uuid']
 
-def _get_vhd_parent_uuid(session, vdi_ref):
-    vdi_rec = session.call_xenapi("VDI.get_record", vdi_ref)
+    def parent_uuid(self, vdi_uuid):
+        if not vdi_uuid:
+            return None
+        return self.get_record(vdi_uuid)['sm_config'].get('vhd-parent')
 
-    if 'vhd-parent' not in vdi_rec['sm_config']:
-        return None
+    def children(self, vdi_uuid):
+        return set(self._children.get(vdi_uuid, ()))
 
-    parent_uuid = vdi_rec['sm_config']['vhd-parent']
-    vdi_uuid = vdi_rec['uuid']
-    LOG.debug(_("VHD %(vdi_uuid)s has parent %(parent_uuid)s") % locals())
-    return parent_uuid
 
+def _walk_vdi_chain(session, vdi_uuid, index=None):
+    """Yield vdi_recs for each element in a VDI chain
 
-def _walk_vdi_chain(session, vdi_uuid):
-    """Yield vdi_recs for each element in a VDI chain"""
-    scan_default_sr(session)
-    while True:
+    Without an index the SR holding the VDI is rescanned and indexed first.
+    """
+    if index is None:
+        scan_default_sr(session)
         vdi_ref = session.call_xenapi("VDI.get_by_uuid", vdi_uuid)
-        vdi_rec = session.call_xenapi("VDI.get_record", vdi_ref)
-        yield vdi_rec
+        sr_ref = session.call_xenapi("VDI.get_SR", vdi_ref)
+        index = _VHDIndex(session, sr_ref)
 
-        parent_uuid = _get_vhd_parent_uuid(session, vdi_ref)
-        if not parent_uuid:
-            break
+    while vdi_uuid:
+        vdi_rec = index.get_record(vdi_uuid)
+        yield vdi_rec
 
-        vdi_uuid = parent_uuid
+        vdi_uuid = vdi_rec['sm_config'].get('vhd-parent')
+        if vdi_uuid:
+            child_uuid = vdi_rec['uuid']
+            LOG.debug(_("VHD %(child_uuid)s has parent %(vdi_uuid)s") %
+                      locals())
 
 
-def _child_vhds(session, sr_ref, vdi_uuid):
+def _child_vhds(session, sr_ref, vdi_uuid, index=None):
     """Return the immediate children of a given VHD.
 
     This is not recursive, only the immediate children are returned.
     """
-    children = set()
-    for ref, rec in _get_all_vdis_in_sr(session, sr_ref):
-        rec_uuid = rec['uuid']
-
-        if rec_uuid == vdi_uuid:
-            continue
-
-        parent_uuid = _get_vhd_parent_uuid(session, ref)
-        if parent_uuid != vdi_uuid:
-            continue
-
-        children.add(rec_uuid)
-
+    if index is None:
+        index = _VHDIndex(session, sr_ref)
+    children = index.children(vdi_uuid)
+    children.discard(vdi_uuid)
     return children
 
 
@@ -1655,31 +1698,33 @@ def _wait_for_vhd_coalesce(session, instance, sr_ref, vdi_ref,
     After coalesce:
         * parent_vhd
             snapshot
+
+    Each poll indexes the SR with one XenAPI call rather than fetching the
+    record of every VDI in it.
     """
-    def _another_child_vhd():
+    vdi_uuid = session.call_xenapi('VDI.get_uuid', vdi_ref)
+
+    def _parent_and_base(index):
+        parent_uuid = index.parent_uuid(vdi_uuid)
+        base_uuid = index.parent_uuid(parent_uuid)
+        return parent_uuid, base_uuid
+
+    def _another_child_vhd(index):
         if not original_parent_uuid:
             return False
 
         # Search for any other vdi which parents to original parent and is not
         # in the active vm/instance vdi chain.
-        vdi_uuid = session.call_xenapi('VDI.get_record', vdi_ref)['uuid']
-        parent_vdi_uuid = _get_vhd_parent_uuid(session, vdi_ref)
-        for _ref, rec in _get_all_vdis_in_sr(session, sr_ref):
-            if ((rec['uuid'] != vdi_uuid) and
-               (rec['uuid'] != parent_vdi_uuid) and
-               (rec['sm_config'].get('vhd-parent') == original_parent_uuid)):
-                # Found another vhd which too parents to original parent.
-                return True
-        # Found no other vdi with the same parent.
-        return False
+        siblings = index.children(original_parent_uuid)
+        siblings.discard(vdi_uuid)
+        siblings.discard(index.parent_uuid(vdi_uuid))
+        return bool(siblings)
 
     # Check if original parent has any other child. If so, coalesce will
     # not take place.
-    if _another_child_vhd():
-        parent_uuid = _get_vhd_parent_uuid(session, vdi_ref)
-        parent_ref = session.call_xenapi("VDI.get_by_uuid", parent_uuid)
-        base_uuid = _get_vhd_parent_uuid(session, parent_ref)
-        return parent_uuid, base_uuid
+    index = _VHDIndex(session, sr_ref)
+    if _another_child_vhd(index):
+        return _parent_and_base(index)
 
     # NOTE(sirp): This rescan is necessary to ensure the VM's `sm_config`
     # matches the underlying VHDs.
@@ -1688,15 +1733,14 @@ def _wait_for_vhd_coalesce(session, instance, sr_ref, vdi_ref,
     max_attempts = FLAGS.xenapi_vhd_coalesce_max_attempts
     for i in xrange(max_attempts):
         _scan_sr(session, sr_ref)
-        parent_uuid = _get_vhd_parent_uuid(session, vdi_ref)
+        index = _VHDIndex(session, sr_ref)
+        parent_uuid = index.parent_uuid(vdi_uuid)
         if original_parent_uuid and (parent_uuid != original_parent_uuid):
             LOG.debug(_("Parent %(parent_uuid)s doesn't match original parent"
                         " %(original_parent_uuid)s, waiting for coalesce..."),
                       locals(), instance=instance)
         else:
-            parent_ref = session.call_xenapi("VDI.get_by_uuid", parent_uuid)
-            base_uuid = _get_vhd_parent_uuid(session, parent_ref)
-            return parent_uuid, base_uuid
+            return _parent_and_base(index)
 
         greenthread.sleep(FLAGS.xenapi_vhd_coalesce_poll_interval)
 
@@ -1914,13 +1958,56 @@ def _resize_part_and_fs(dev, start, old_sectors, new_sectors):
     utils.execute('tune2fs', '-j', partition_path, run_as_root=True)
 
 
-def _sparse_copy(src_path, dst_path, virtual_size, block_size=4096):
-    """Copy data, skipping long runs of zeros to create a sparse file."""
+# NOTE: os only exposes these from python 3.3, these are the Linux values.
+_SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+_SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+
+def _data_extents(fd, size):
+    """Yield (offset, length) for each region of fd which may hold data.
+
+    Holes are found with SEEK_DATA/SEEK_HOLE so they need not be read at
+    all. Where the platform or the filesystem does not support them the
+    whole of fd is reported as data.
+    """
+    if not (hasattr(os, 'SEEK_DATA') or sys.platform.startswith('linux')):
+        yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, _SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                yield offset, size - offset
+            # ENXIO means there is no more data past offset
+            return
+        if data >= size:
+            return
+        hole = min(os.lseek(fd, data, _SEEK_HOLE), size)
+        yield data, hole - data
+        offset = hole
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _sparse_copy(src_path, dst_path, virtual_size, block_size=None):
+    """Copy data, skipping runs of zeros to create a sparse file.
+
+    The source is read in large chunks, skipping any holes it reports, and
+    chunks which are entirely zero are not written to the destination.
+    """
+    if block_size is None:
+        block_size = FLAGS.xenapi_sparse_copy_block_size
     start_time = time.time()
     EMPTY_BLOCK = '\0' * block_size
     bytes_read = 0
-    skipped_bytes = 0
-    left = virtual_size
+    bytes_written = 0
 
     LOG.debug(_("Starting sparse_copy src=%(src_path)s dst=%(dst_path)s "
                 "virtual_size=%(virtual_size)d block_size=%(block_size)d"),
@@ -1931,30 +2018,38 @@ def _sparse_copy(src_path, dst_path, virtual_size, block_size=4096):
     # ownership of the devices.
     with utils.temporary_chown(src_path):
         with utils.temporary_chown(dst_path):
-            with open(src_path, "r") as src:
-                with open(dst_path, "w") as dst:
-                    data = src.read(min(block_size, left))
-                    while data:
-                        if data == EMPTY_BLOCK:
-                            dst.seek(block_size, os.SEEK_CUR)
-                            left -= block_size
-                            bytes_read += block_size
-                            skipped_bytes += block_size
-                        else:
-                            dst.write(data)
+            src = os.open(src_path, os.O_RDONLY)
+            try:
+                dst = os.open(dst_path, os.O_WRONLY)
+                try:
+                    for offset, length in _data_extents(src, virtual_size):
+                        os.lseek(src, offset, os.SEEK_SET)
+                        end = offset + length
+                        while offset < end:
+                            data = os.read(src, min(block_size, end - offset))
+                            if not data:
+                                break
                             data_len = len(data)
-                            left -= data_len
+                            # NOTE: a full length slice of a str is the str
+                            # itself, so this is a single memcmp per chunk.
+                            if data != EMPTY_BLOCK[:data_len]:
+                                os.lseek(dst, offset, os.SEEK_SET)
+                                _write_all(dst, data)
+                                bytes_written += data_len
+                            offset += data_len
                             bytes_read += data_len
-
-                        if left <= 0:
-                            break
-
-                        data = src.read(min(block_size, left))
+                finally:
+                    os.close(dst)
+            finally:
+                os.close(src)
 
     duration = time.time() - start_time
-    compression_pct = float(skipped_bytes) / bytes_read * 100
+    skipped_bytes = virtual_size - bytes_written
+    compression_pct = float(skipped_bytes) / max(virtual_size, 1) * 100
+    throughput = virtual_size / max(duration, 0.001) / (1024 * 1024)
 
-    LOG.debug(_("Finished sparse_copy in %(duration).2f secs, "
+    LOG.debug(_("Finished sparse_copy in %(duration).2f secs "
+                "(%(throughput).2f MB/s), read %(bytes_read)d bytes, "
                 "%(compression_pct).2f%% reduction in size"), locals())
 
 
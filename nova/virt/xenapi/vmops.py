@@ -43,6 +43,7 @@ from nova.openstack.common import log as logging
 from nova.openstack.common import timeutils
 from nova import utils
 from nova.virt import driver
+from nova.virt import event as virtevent
 from nova.virt.xenapi import agent
 from nova.virt.xenapi import firewall
 from nova.virt.xenapi import pool_states
@@ -1184,6 +1185,60 @@ class VMOps(object):
         vm_rec = self._session.call_xenapi("VM.get_record", vm_ref)
         return vm_utils.compile_info(vm_rec)
 
+    def get_all_power_states(self):
+        """Return a dict of VM name labels to power states."""
+        host_ref = self._session.get_xenapi_host()
+        states = {}
+        for vm_ref, vm_rec in self._session.get_all_refs_and_recs('VM'):
+            if vm_rec["is_a_template"] or vm_rec["is_control_domain"]:
+                continue
+            name_label = vm_rec["name_label"]
+            # NOTE: get_info() looks VMs up by name label wherever they
+            # reside, so do the same but prefer the VM on this host.
+            if name_label in states and vm_rec["resident_on"] != host_ref:
+                continue
+            states[name_label] = vm_utils.XENAPI_POWER_STATE[
+                    vm_rec["power_state"]]
+        return states
+
+    def _vm_events(self, timeout):
+        """Yield the VM records xapi reports changes to, forever."""
+        token = ''
+        while True:
+            try:
+                result = self._session.call_xenapi('event.from', ['vm'],
+                                                   token, float(timeout))
+            except Exception:
+                LOG.exception(_("Failed to wait for VM events"))
+                greenthread.sleep(timeout)
+                continue
+
+            token = result['token']
+            for event in result['events']:
+                if (event['operation'] in ('add', 'mod') and
+                    'snapshot' in event):
+                    yield event['snapshot']
+
+    def watch_vm_events(self, emit_event, timeout=30):
+        """Emit a lifecycle event whenever a VM on this host changes power
+        state. Never returns, so run it in its own greenthread.
+        """
+        host_ref = self._session.get_xenapi_host()
+        last_states = {}
+        for vm_rec in self._vm_events(timeout):
+            if vm_rec["is_a_template"] or vm_rec["is_control_domain"]:
+                continue
+            uuid = vm_rec["other_config"].get('nova_uuid')
+            # Halted VMs are not resident anywhere
+            if not uuid or vm_rec["resident_on"] not in (host_ref,
+                                                          'OpaqueRef:NULL'):
+                continue
+
+            state = vm_utils.XENAPI_POWER_STATE[vm_rec["power_state"]]
+            if last_states.get(uuid) != state:
+                last_states[uuid] = state
+                emit_event(virtevent.LifecycleEvent(uuid, state))
+
     def get_diagnostics(self, instance):
         """Return data about VM diagnostics."""
         vm_ref = self._get_vm_opaque_ref(instance)
@@ -1198,17 +1253,21 @@ class VMOps(object):
         except exception.CouldNotFetchMetrics:
             LOG.exception(_("Could not get bandwidth info."))
             return {}
+        vm_recs = dict((vm_rec['uuid'], vm_rec) for _vm_ref, vm_rec in
+                       self._session.get_all_refs_and_recs('VM'))
+        vif_recs = dict(self._session.get_all_refs_and_recs('VIF'))
+
         bw = {}
         for uuid, data in metrics.iteritems():
-            vm_ref = self._session.call_xenapi("VM.get_by_uuid", uuid)
-            vm_rec = self._session.call_xenapi("VM.get_record", vm_ref)
+            vm_rec = vm_recs.get(uuid)
+            if not vm_rec or 'nova_uuid' not in vm_rec['other_config']:
+                continue
             vif_map = {}
-            for vif in [self._session.call_xenapi("VIF.get_record", vrec)
-                        for vrec in vm_rec['VIFs']]:
-                vif_map[vif['device']] = vif['MAC']
+            for vif_ref in vm_rec['VIFs']:
+                vif = vif_recs.get(vif_ref)
+                if vif:
+                    vif_map[vif['device']] = vif['MAC']
             name = vm_rec['name_label']
-            if 'nova_uuid' not in vm_rec['other_config']:
-                continue
             vifs_bw = bw.setdefault(name, {})
             for key, val in data.iteritems():
                 if key.startswith('vif_'):
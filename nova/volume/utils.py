@@ -17,6 +17,7 @@
 """Volume-related Utilities and helpers."""
 
 from nova import flags
+from nova import notifications
 from nova.openstack.common import log as logging
 from nova.openstack.common.notifier import api as notifier_api
 from nova.openstack.common import timeutils
@@ -70,6 +71,9 @@ def _usage_from_volume(context, volume_ref, **kw):
 
 def notify_about_volume_usage(context, volume, event_suffix,
                                 extra_usage_info=None, host=None):
+    if not notifications.enabled():
+        return
+
     if not host:
         host = FLAGS.host
 
@@ -79,6 +83,6 @@ def notify_about_volume_usage(context, volume, event_suffix,
     usage_info = _usage_from_volume(
             context, volume, **extra_usage_info)
 
-    notifier_api.notify(context, 'volume.%s' % host,
-                        'volume.%s' % event_suffix,
-                        notifier_api.INFO, usage_info)
+    notifications.notify(context, 'volume.%s' % host,
+                         'volume.%s' % event_suffix,
+                         notifier_api.INFO, usage_info)
@@ -53,6 +53,7 @@ setuptools.setup(name='nova',
                'bin/nova-novncproxy',
                'bin/nova-objectstore',
                'bin/nova-rootwrap',
+               'bin/nova-rootwrap-daemon',
                'bin/nova-scheduler',
                'bin/nova-volume',
                'bin/nova-volume-usage-audit',